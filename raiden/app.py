@@ -2,6 +2,7 @@
 from __future__ import print_function
 
 import codecs
+import functools
 import sys
 import signal
 
@@ -11,7 +12,7 @@ from ethereum import slogging
 
 from raiden.raiden_service import RaidenService
 from raiden.network.discovery import Discovery
-from raiden.network.transport import UDPTransport
+from raiden.network.transport import ShardedUDPTransport, UDPTransport
 from raiden.network.rpc.client import BlockChainService
 
 log = slogging.get_logger(__name__)  # pylint: disable=invalid-name
@@ -28,7 +29,14 @@ class App(object):  # pylint: disable=too-few-public-methods
         # timespan a node requires to learn the secret before the lock expires for him (time in #blocks):
         reveal_timeout=3,
         # how long to wait for a transfer until CancelTransfer is sent (time in milliseconds):
-        msg_timeout=100.00
+        msg_timeout=100.00,
+        # directory for the append-only logs of all channel transfers, disabled if None:
+        transfer_log_dir=None,
+        # use the array based channel graph, for networks too large for networkx:
+        compact_channelgraph=False,
+        # the process serves the shard `shard` of the `shards` that share the port:
+        shard=0,
+        shards=1,
     )
 
     def __init__(self, config, chain, discovery, transport_class=UDPTransport):
@@ -40,7 +48,22 @@ class App(object):  # pylint: disable=too-few-public-methods
         discovery.register(self.raiden.address, self.transport.host, self.transport.port)
 
     def stop(self):
-        self.transport.server.start()
+        self.transport.stop()
+        self.raiden.stop()
+
+
+def fork_shards(shards):
+    """ Fork the current process into `shards` processes.
+
+    Returns:
+        int: The shard of the current process, the original process is the
+            shard 0.
+    """
+    for shard in range(1, shards):
+        if gevent.fork() == 0:
+            return shard
+
+    return 0
 
 
 def main():
@@ -62,6 +85,13 @@ def main():
         default=INITIAL_PORT,
         help='Local port that the raiden app will bind to',
     )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        default=1,
+        type=int,
+        help='Number of processes sharing the port, the peers are split among them',
+    )
 
     args = parser.parse_args()
 
@@ -81,13 +111,25 @@ def main():
         print('Missing "privkey" in the configuration file, cannot proceed')
         sys.exit(1)
 
+    transport_class = UDPTransport
+    if args.workers > 1:
+        # must happen before any connection or greenlet is created
+        shard = fork_shards(args.workers)
+        config['shard'] = shard
+        config['shards'] = args.workers
+        transport_class = functools.partial(
+            ShardedUDPTransport,
+            shard=shard,
+            shards=args.workers,
+        )
+
     blockchain_server = BlockChainService(rpc_connection, args.registry_address)
     discovery = Discovery()
 
     for node in config['nodes']:
         discovery.register(node['nodeid'], node['host'], node['port'])
 
-    app = App(config, blockchain_server, discovery)
+    app = App(config, blockchain_server, discovery, transport_class)
 
     for asset_address in blockchain_server.asset_addresses:
         app.raiden.setup_asset(asset_address, app.config['reveal_timeout'])
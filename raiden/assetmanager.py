@@ -2,6 +2,7 @@
 from ethereum import slogging
 
 from raiden import messages
+from raiden.channelgraph import RouteCache
 from raiden.transfermanager import TransferManager
 from raiden.utils import isaddress
 
@@ -16,13 +17,15 @@ class AssetManager(object):
         Args:
             raiden (RaidenService): a node's service
             asset_address (address): the asset address managed by this instance
-            channelgraph (networkx.Graph): a graph representing the raiden network
+            channelgraph (ChannelGraph): a graph representing the raiden network
         """
         if not isaddress(asset_address):
             raise ValueError('asset_address must be a valid address')
 
+        self.raiden = raiden
         self.asset_address = asset_address
         self.channelgraph = channel_graph
+        self.routecache = RouteCache(channel_graph)  #: routes and connectivity of the graph
 
         transfermanager = TransferManager(self, raiden)
         self.channels = dict()  #: mapping form partner_address -> channel object
@@ -30,6 +33,33 @@ class AssetManager(object):
 
     def add_channel(self, partner_address, channel):
         self.channels[partner_address] = channel
+        self.raiden.hashlock_index.register_channel(self.asset_address, channel)
+
+    def get_best_routes(self, target, amount):
+        """ Return the routes from this node to `target` that can be used to
+        transfer `amount`, ordered from the best to the worst.
+
+        The capacity and status of our own channels are the only ones known
+        locally, they are refreshed before the routes are computed. The routes
+        starting with a channel that is not in `channels` are skipped.
+        """
+        our_address = self.raiden.address
+
+        for partner_address, channel in self.channels.items():
+            if self.channelgraph.has_channel(our_address, partner_address):
+                self.channelgraph.update_status(our_address, partner_address, channel.isopen)
+                self.channelgraph.update_capacity(
+                    our_address,
+                    partner_address,
+                    channel.distributable,
+                )
+
+        # the first hop must be one of the channels managed by this node
+        return [
+            route
+            for route in self.routecache.get_best_routes(our_address, target, amount)
+            if len(route) > 1 and route[1] in self.channels
+        ]
 
     def channel_isactive(self, partner_address):
         network_activity = True  # FIXME
@@ -38,5 +68,7 @@ class AssetManager(object):
     def on_secret(self, msg):
         assert isinstance(msg, messages.Secret)
 
-        for channel in self.channels.values():
-            channel.claim_locked(msg.secret)
+        # only the channels that have a lock for the secret need to be updated
+        for asset_address, channel in self.raiden.hashlock_index.get_channels(msg.hashlock):
+            if asset_address == self.asset_address:
+                channel.claim_locked(msg.secret)
@@ -4,10 +4,11 @@ from __future__ import print_function
 import contextlib
 import timeit
 
+from raiden.encoding import messages
 from raiden.utils import privtoaddr, sha3
 from raiden.messages import (
     Ack, Ping, SecretRequest, Secret, DirectTransfer, Lock, LockedTransfer,
-    MediatedTransfer, CancelTransfer, TransferTimeout, ConfirmTransfer, decode,
+    MediatedTransfer, CancelTransfer, TransferTimeout, ConfirmTransfer,
 )
 
 
@@ -24,12 +25,23 @@ def run_timeit(message_name, message, iterations=ITERATIONS):
         message.encode()
 
     def test_decode():
-        decode(data)
+        # LockedTransfer is not in CMDID_TO_CLASS, use the class directly
+        message.decode(data)
+
+    def test_unpack():
+        # decoding without the signature recovery
+        message.unpack(messages.wrap(data))
 
     encode_time = timeit.timeit(test_encode, number=iterations)
     decode_time = timeit.timeit(test_decode, number=iterations)
-
-    print('{}: encode {} decode {}'.format(message_name, encode_time, decode_time))
+    unpack_time = timeit.timeit(test_unpack, number=iterations)
+
+    print('{}: encode {} decode {} unpack {}'.format(
+        message_name,
+        encode_time,
+        decode_time,
+        unpack_time,
+    ))
 
 
 def test_ack(iterations=ITERATIONS):
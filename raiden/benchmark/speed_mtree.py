@@ -0,0 +1,101 @@
+# -*- coding: utf8 -*-
+""" Cost of the incremental updates of `MerkleTree` against a `merkleroot`
+over all the leaves.
+
+The leaves are sorted, a change rehashes the nodes to the right of the
+changed leaf, so the cost depends on the position of the lock::
+
+    python raiden/benchmark/speed_mtree.py -s 1000 -s 10000
+"""
+from __future__ import print_function
+
+import random
+import timeit
+
+from raiden import mtree
+from raiden.mtree import MerkleTree, merkleroot
+from raiden.utils import sha3
+
+ITERATIONS = 1000
+SIZES = (100, 1000, 10000)
+
+
+class CountingHashPair(object):
+    """ Replaces `mtree.hash_pair` to count the hashes of the updates. """
+
+    def __init__(self):
+        self.calls = 0
+        self.hash_pair = mtree.hash_pair
+
+    def __call__(self, first, second):
+        self.calls += 1
+        return self.hash_pair(first, second)
+
+
+def make_leaves(size):
+    return sorted(sha3('leaf:{}'.format(number)) for number in range(size))
+
+
+def run_position(tree, name, elements, iterations):
+    counter = CountingHashPair()
+    mtree.hash_pair = counter
+
+    try:
+        def add_remove():
+            element = elements()
+            tree.add(element)
+            tree.remove(element)
+
+        elapsed = timeit.timeit(add_remove, number=iterations)
+    finally:
+        mtree.hash_pair = counter.hash_pair
+
+    print('  {:<8} {:>8.1f} hashes {:>10.2f} us per add and remove'.format(
+        name,
+        counter.calls / float(iterations),
+        elapsed / iterations * 1e6,
+    ))
+
+
+def test_size(size, iterations=ITERATIONS):
+    leaves = make_leaves(size)
+    tree = MerkleTree(leaves)
+
+    def first():
+        return b'\x00' * 32
+
+    def last():
+        return b'\xff' * 32
+
+    def middle():
+        return sha3(str(random.random()))
+
+    print('{} leaves:'.format(size))
+    run_position(tree, 'last', last, iterations)
+    run_position(tree, 'random', middle, iterations)
+    run_position(tree, 'first', first, iterations)
+
+    elapsed = timeit.timeit(lambda: merkleroot(leaves), number=max(iterations // 10, 1))
+    print('  {:<8} {:>8} hashes {:>10.2f} us'.format(
+        'rebuild',
+        size - 1,
+        elapsed / max(iterations // 10, 1) * 1e6,
+    ))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--size', action='append', type=int)
+    parser.add_argument('-i', '--iterations', default=ITERATIONS, type=int)
+
+    args = parser.parse_args()
+
+    random.seed(7)
+    for size in args.size or SIZES:
+        test_size(size, iterations=args.iterations)
+
+
+if __name__ == '__main__':
+    main()
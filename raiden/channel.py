@@ -1,10 +1,18 @@
 # -*- coding: utf8 -*-
+import heapq
+import os
+import struct
+from array import array
+
 from ethereum import slogging
 
-from raiden.messages import CancelTransfer, DirectTransfer, LockedTransfer, BaseError, Lock
-from raiden.mtree import merkleroot, get_proof
+from raiden.messages import (
+    CancelTransfer, DirectTransfer, LockedTransfer, BaseError, Lock, decode,
+)
+from raiden.mtree import MerkleTree
 from raiden.utils import sha3
 from raiden.blockchain.net_contract import NettingChannelContract
+from raiden.encoding.messages import LOCKEDTRANSFER
 
 log = slogging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -38,10 +46,15 @@ class LockedTransfers(object):
     merkle root or proof that a given lock is included in the set.
     """
 
+    max_pruned_candidates = 8
+    ''' number of expirations tried by `find_pruned` '''
+
     def __init__(self):
         self.locked = dict()  #: A mapping from hashlock to the transfer
-        self._cached_lock_hashes = []  #: lock's hash cache `sha3(amount || expiration || hashlock)`
-        self._cached_root = None  #: the merkle proof of the current transfers
+        self._tree = MerkleTree()  #: tree of lock hashes `sha3(amount || expiration || hashlock)`
+        self._outstanding = 0  #: sum of the amounts of all locks
+        self._expirations = []  #: min-heap of `(expiration, hashlock)`, may have stale entries
+        self.callbacks = []  #: called with `(hashlock, added)` after a lock is added or removed
 
     def __contains__(self, hashlock):
         """ Return True if there is a pending transfer with the given hashlock, False otherwise. """
@@ -85,8 +98,12 @@ class LockedTransfers(object):
         """
         assert transfer.lock.hashlock not in self.locked
         self.locked[transfer.lock.hashlock] = transfer
-        self._cached_lock_hashes.append(sha3(transfer.lock.as_bytes))
-        self._cached_root = None
+        self._tree.add(sha3(transfer.lock.as_bytes))
+        self._outstanding += transfer.lock.amount
+        heapq.heappush(self._expirations, (transfer.lock.expiration, transfer.lock.hashlock))
+
+        for callback in self.callbacks:
+            callback(transfer.lock.hashlock, True)
 
     get = __getitem__
 
@@ -96,25 +113,144 @@ class LockedTransfers(object):
         Args:
             hashlock: The hashlock of the corresponding transfer.
         """
-        self._cached_lock_hashes.remove(sha3(self.get(hashlock).lock.as_bytes))
-        self._cached_root = None
+        lock = self.get(hashlock).lock
+        self._tree.remove(sha3(lock.as_bytes))
+        self._outstanding -= lock.amount
         del self.locked[hashlock]
 
+        for callback in self.callbacks:
+            callback(hashlock, False)
+
     @property
     def outstanding(self):
         """ Return the amount of asset that is locked in this container. """
-        return sum(
-            transfer.lock.amount
-            for transfer in self.locked.values()
-        )
+        return self._outstanding
+
+    def expired(self, block_number):
+        """ Return the transfers with a lock that expired before `block_number`
+        sorted by expiration, the container is not changed.
+        """
+        expirations = self._expirations
+        expired = dict()
+
+        # the entries smaller than `block_number` are a subtree at the top of the heap
+        indexes = [0]
+        while indexes:
+            index = indexes.pop()
+
+            if index < len(expirations) and expirations[index][0] < block_number:
+                expiration, hashlock = expirations[index]
+                transfer = self.locked.get(hashlock)
+
+                if transfer is not None and transfer.lock.expiration == expiration:
+                    expired[hashlock] = transfer
+
+                indexes.extend((2 * index + 1, 2 * index + 2))
+
+        return sorted(expired.values(), key=lambda transfer: transfer.lock.expiration)
+
+    def find_pruned(self, locksroot, block_number, lock=None):
+        """ Search for the expired locks that the partner dropped from `locksroot`.
+
+        The sender of a transfer drops its expired locks from the locksroot, it
+        must only drop locks that already expired before `block_number`. The
+        sender drops all the locks that expired before its own block number,
+        so the dropped locks are the ones expiring up to some block.
+
+        Only the `max_pruned_candidates` latest expirations are tried, from the
+        latest, on a copy of the tree that is updated incrementally. Any peer
+        can send a bad locksroot, the work done for it must be bounded.
+
+        Args:
+            locksroot: The locksroot of the received transfer.
+            block_number: Our current block number.
+            lock: The lock of the received transfer, if any.
+
+        Returns:
+            int: The value for `remove_expired` that makes our root equal to
+                `locksroot`, None if no set of expired locks does.
+        """
+        expired = self.expired(block_number)
+
+        if not expired:
+            return None
+
+        # locks with the same expiration are dropped together
+        groups = list()  # (expiration, leaves), sorted by expiration
+        for transfer in expired:
+            leaf = sha3(transfer.lock.as_bytes)
+
+            if groups and groups[-1][0] == transfer.lock.expiration:
+                groups[-1][1].append(leaf)
+            else:
+                groups.append((transfer.lock.expiration, [leaf]))
+
+        include = sha3(lock.as_bytes) if lock is not None else None
 
-    # XXX: Remove expired transfers?
+        tree = self._tree.copy()
+        tree.remove_many(leaf for _, leaves in groups for leaf in leaves)
+
+        candidates = groups[-self.max_pruned_candidates:]
+        for position in range(len(candidates) - 1, -1, -1):
+            expiration, leaves = candidates[position]
+
+            if tree.root_with(include) == locksroot:
+                return expiration + 1
+
+            # the next candidate keeps the locks of this expiration
+            if position:
+                for leaf in leaves:
+                    tree.add(leaf)
+
+        return None
+
+    def remove_expired(self, block_number):
+        """ Remove all transfers with a lock that expired before `block_number`.
+
+        The merkle tree and the outstanding amount are updated once for all
+        the expired locks.
+
+        Returns:
+            List[LockedTransfer]: The removed transfers.
+        """
+        expirations = self._expirations
+        expired = []
+
+        while expirations and expirations[0][0] < block_number:
+            expiration, hashlock = heapq.heappop(expirations)
+            transfer = self.locked.get(hashlock)
+
+            # the lock might have been removed or replaced since it was pushed
+            if transfer is not None and transfer.lock.expiration == expiration:
+                expired.append(self.locked.pop(hashlock))
+
+        if expired:
+            self._tree.remove_many(
+                sha3(expired_transfer.lock.as_bytes)
+                for expired_transfer in expired
+            )
+            self._outstanding -= sum(
+                expired_transfer.lock.amount
+                for expired_transfer in expired
+            )
+
+            for expired_transfer in expired:
+                for callback in self.callbacks:
+                    callback(expired_transfer.lock.hashlock, False)
+
+        # drop the entries of removed locks once they dominate the heap
+        if len(expirations) > 2 * len(self.locked) + 16:
+            self._expirations = [
+                (pending.lock.expiration, pending.lock.hashlock)
+                for pending in self.locked.values()
+            ]
+            heapq.heapify(self._expirations)
+
+        return expired
 
     @property
     def root(self):
-        if not self._cached_root:
-            self._cached_root = merkleroot(self._cached_lock_hashes)
-        return self._cached_root
+        return self._tree.root
 
     def root_with(self, lock=None, exclude=None):
         """ Calculate the merkle root of the hashes in the container.
@@ -133,28 +269,13 @@ class LockedTransfers(object):
 
         lock_hash = exclude_hash = None
 
-        # temporarily add
         if lock:
             lock_hash = sha3(lock.as_bytes)
-            self._cached_lock_hashes.append(lock_hash)
 
-        # temporarily remove
         if exclude:
             exclude_hash = sha3(exclude.as_bytes)
-            self._cached_lock_hashes.remove(exclude_hash)
-
-        root = merkleroot(self._cached_lock_hashes)
 
-        # remove the temporarily added hash
-        if lock_hash:
-            assert lock_hash in self._cached_lock_hashes
-            self._cached_lock_hashes.remove(lock_hash)
-
-        # reinclude the temporarily removed hash
-        if exclude:
-            self._cached_lock_hashes.append(exclude_hash)
-
-        return root
+        return self._tree.root_with(lock_hash, exclude_hash)
 
     def get_proof(self, transfer):
         """ Return the merkle proof that transfer is one of the locked
@@ -163,9 +284,120 @@ class LockedTransfers(object):
         hashlock = transfer.lock.hashlock
         transfer = self.locked[hashlock]
         proof_for = sha3(transfer.lock.as_bytes)
-        proof = get_proof(self._cached_lock_hashes, proof_for)
+        proof = self._tree.get_proof(proof_for)
         return proof
 
+    def get_proofs(self, transfers):
+        """ Return the merkle proofs for all of `transfers`, in the same order.
+
+        Used when many pending locks need to be unlocked at once, e.g. when
+        closing the channel.
+        """
+        proofs_for = [
+            sha3(self.locked[transfer.lock.hashlock].lock.as_bytes)
+            for transfer in transfers
+        ]
+        return self._tree.get_proofs(proofs_for)
+
+
+class TransferHistory(object):
+    """ The transfers of one direction of a channel.
+
+    Only the transfers required for settlement are kept in memory, the latest
+    transfer (the current balance proof) and the transfers with a lock that
+    is still pending. Optionally every transfer is also appended to a log
+    file, older transfers can then still be read back by position.
+
+    The positions are the ones of the current run, the state of the channel
+    is not restored on a restart, so an existing log is truncated.
+    """
+
+    def __init__(self, log_path=None):
+        self.latest = None  #: the last registered transfer
+        self.pending = dict()  #: hashlock -> position of the transfers with unresolved locks
+        self.log_path = log_path
+
+        self._count = 0
+        self._log = None
+        self._retained = dict()  #: position -> transfer, for the unresolved locks
+        self._offsets = array('L')  #: position -> offset of the transfer in the log
+
+        if log_path is not None:
+            self._log = open(log_path, 'w+b')
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        """ Iterate over the transfers kept in memory, oldest first. """
+        retained = dict(self._retained)
+
+        if self.latest is not None:
+            retained[self._count - 1] = self.latest
+
+        for position in sorted(retained):
+            yield retained[position]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+
+        if not 0 <= index < self._count:
+            raise IndexError('transfer index out of range')
+
+        if index == self._count - 1:
+            return self.latest
+
+        transfer = self._retained.get(index)
+        if transfer is not None:
+            return transfer
+
+        if self._log is None:
+            raise IndexError('transfer {} was compacted'.format(index))
+
+        return self._read_log(index)
+
+    def append(self, transfer):
+        if isinstance(transfer, LockedTransfer):
+            self.pending[transfer.lock.hashlock] = self._count
+            self._retained[self._count] = transfer
+
+        self.latest = transfer
+        self._count += 1
+
+        if self._log is not None:
+            data = transfer.encode()
+
+            self._log.seek(0, os.SEEK_END)
+            self._offsets.append(self._log.tell())
+            self._log.write(struct.pack('>H', len(data)))
+            self._log.write(data)
+
+    def close(self):
+        """ Close the log file, the compacted transfers can't be read anymore. """
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def on_lock_changed(self, hashlock, added):
+        """ `LockedTransfers` callback, forgets transfers with resolved locks. """
+        if not added:
+            position = self.pending.pop(hashlock, None)
+
+            if position is not None:
+                del self._retained[position]
+
+    def _read_log(self, index):
+        self._log.seek(self._offsets[index])
+        size, = struct.unpack('>H', self._log.read(2))
+        data = self._log.read(size)
+
+        # LockedTransfer is not exchanged between nodes, so decode() doesn't know it
+        if data[0] == LOCKEDTRANSFER:
+            return LockedTransfer.decode(data)
+
+        return decode(data)
+
 
 class ChannelEndState(object):
     """ Tracks the state of one of the participants in a channel. """
@@ -178,6 +410,11 @@ class ChannelEndState(object):
         self.nonce = 0  #: sequential nonce, current value has not been used
         self.locked = LockedTransfers()  #: locked received
 
+    def update_deposit(self, deposit):
+        """ Update the balance with the participant's new total `deposit`. """
+        self.balance += deposit - self.initial_balance
+        self.initial_balance = deposit
+
     def distributable(self, other):
         """ Return the available amount of the asset that can be transfered in
         the channel `(total - locked)`.
@@ -237,7 +474,7 @@ class Channel(object):
     # pylint: disable=too-many-instance-attributes,too-many-arguments
 
     def __init__(self, chain, asset_address, nettingcontract_address,
-                 our_state, partner_state, reveal_timeout):
+                 our_state, partner_state, reveal_timeout, transfer_log_dir=None):
         self.chain = chain
         self.asset_address = asset_address
         self.nettingcontract_address = nettingcontract_address
@@ -248,11 +485,29 @@ class Channel(object):
         self.settle_timeout = NettingChannelContract.settle_timeout
         ''' the contract's `locked_time`, all locks need to expire with less than this value '''
 
+        self.expiration_margin = 2
+        ''' blocks waited to drop our expired locks, the partner's chain view may lag behind '''
+
         self.wasclosed = False
-        self.received_transfers = []
-        self.sent_transfers = []  #: transfers that were sent, required for settling
+        sent_log = received_log = None
+        if transfer_log_dir is not None:
+            name = nettingcontract_address.encode('hex')
+            sent_log = os.path.join(transfer_log_dir, '{}_sent.log'.format(name))
+            received_log = os.path.join(transfer_log_dir, '{}_received.log'.format(name))
+
+        self.received_transfers = TransferHistory(received_log)
+        self.sent_transfers = TransferHistory(sent_log)  #: sent transfers, required for settling
+
+        # locks sent by us are registered in the partner's end and vice-versa
+        partner_state.locked.callbacks.append(self.sent_transfers.on_lock_changed)
+        our_state.locked.callbacks.append(self.received_transfers.on_lock_changed)
         self.transfer_callbacks = []  # list of (Transfer, callback) tuples
 
+    def stop(self):
+        """ Close the transfer logs. """
+        self.sent_transfers.close()
+        self.received_transfers.close()
+
     @property
     def isopen(self):
         if self.wasclosed:
@@ -298,6 +553,19 @@ class Channel(object):
         """
         return self.our_state.locked.outstanding
 
+    def remove_expired_locks(self):
+        """ Drop the locks sent by us that expired before the current block.
+
+        Expired locks cannot be claimed anymore, removing them frees the
+        locked amount and keeps the merkle tree small. The locks are part of
+        the signed locksroot, only the sender drops them when creating a
+        transfer, the receiver drops them once it receives a transfer without
+        them. `expiration_margin` blocks are waited so that the lock is
+        already expired in the partner's view of the chain.
+        """
+        block_number = self.chain.block_number - self.expiration_margin
+        self.partner_state.locked.remove_expired(block_number)
+
     def handle_callbacks(self, transfer):
         # TODO: dict mapping transfer -> callback + cleanup
         # TODO: handle the callbacks somewhere!
@@ -326,7 +594,6 @@ class Channel(object):
 
     def register_transfer(self, transfer, callback=None):
         """ Register a signed transfer, updating the channel's state accordingly. """
-
         if transfer.recipient == self.partner_state.address:
             self.register_transfer_from_to(
                 transfer,
@@ -392,6 +659,11 @@ class Channel(object):
         if transfer_amount > distributable:
             raise InsufficientBalance(transfer)
 
+        # As a receiver: The sender drops its expired locks from the
+        # locksroot, this is accepted only for locks that are expired in our
+        # view of the chain, `prune_before` is the block used to drop them
+        prune_before = None
+
         if isinstance(transfer, LockedTransfer):
             if transfer_amount + transfer.lock.amount > distributable:
                 raise InsufficientBalance(transfer)
@@ -400,7 +672,14 @@ class Channel(object):
             # the locksroot, if any hashlock is missing there is no way to
             # claim it while the channel is closing
             if to_state.locked.root_with(transfer.lock) != transfer.locksroot:
-                raise InvalidLocksRoot(transfer)
+                prune_before = to_state.locked.find_pruned(
+                    transfer.locksroot,
+                    self.chain.block_number,
+                    transfer.lock,
+                )
+
+                if prune_before is None:
+                    raise InvalidLocksRoot(transfer)
 
             # As a receiver: If the lock expiration is larger than the settling
             # time a secret could be revealed after the channel is settled and
@@ -425,10 +704,19 @@ class Channel(object):
 
                 raise ValueError('Expiration smaller than the declared reveal timeout')
 
+        elif not transfer.secret and to_state.locked.root != transfer.locksroot:
+            prune_before = to_state.locked.find_pruned(
+                transfer.locksroot,
+                self.chain.block_number,
+            )
+
         # all checks need to be done before the internal state of the channel
         # is changed, otherwise if a check fails and state was changed the
         # channel will be left trashed
 
+        if prune_before is not None:
+            to_state.locked.remove_expired(prune_before)
+
         if isinstance(transfer, LockedTransfer):
             to_state.locked.add(transfer)
 
@@ -458,6 +746,8 @@ class Channel(object):
         if not self.isopen:
             raise ValueError('The channel is closed')
 
+        self.remove_expired_locks()
+
         from_ = self.our_state
         to_ = self.partner_state
 
@@ -514,6 +804,8 @@ class Channel(object):
 
             raise ValueError('Invalid expiration')
 
+        self.remove_expired_locks()
+
         from_ = self.our_state
         to_ = self.partner_state
 
@@ -1,9 +1,77 @@
 # -*- coding: utf8 -*-
+import heapq
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from itertools import islice
+
 import networkx
+from networkx.classes.graphviews import subgraph_view
 
 from raiden.utils import isaddress
 
 
+def check_edge_list(edge_list):
+    """ Raise ValueError if `edge_list` is not a list of address pairs. """
+    for edge in edge_list:
+        if len(edge) != 2:
+            raise ValueError('All values in edge_list must be of length two (origin, destination)')
+
+        origin, destination = edge
+
+        if not isaddress(origin) or not isaddress(destination):
+            raise ValueError('All values in edge_list must be valid addresses')
+
+
+def bounded_breadth_first(neighbours, source, depth):
+    """ Breadth-first search from `source` that stops `depth` hops away.
+
+    Args:
+        neighbours (callable): Returns the neighbours of a node.
+        source: The node the search starts from.
+        depth (int): The distance of the nodes to yield.
+
+    Yields:
+        (node, parents): Each node at `depth` hops as soon as it's found, and
+        the mapping from the visited nodes to their parent in the search.
+    """
+    parents = {source: None}
+
+    if depth == 0:
+        yield source, parents
+        return
+
+    frontier = [source]
+    for level in range(1, depth + 1):
+        next_frontier = list()
+
+        for node in frontier:
+            for neighbour in neighbours(node):
+                if neighbour in parents:
+                    continue
+
+                parents[neighbour] = node
+
+                if level == depth:
+                    yield neighbour, parents
+                else:
+                    next_frontier.append(neighbour)
+
+        frontier = next_frontier
+
+
+def parents_path(parents, node):
+    """ Return the path from the search root to `node`. """
+    path = [node]
+
+    while parents[node] is not None:
+        node = parents[node]
+        path.append(node)
+
+    path.reverse()
+    return path
+
+
 def make_graph(edge_list):
     """ Return a graph that represents the connections among the netting
     contracts.
@@ -15,21 +83,16 @@ def make_graph(edge_list):
     Returns:
         Graph A networkx.Graph instance were the graph nodes are nodes in the
             network and the edges are nodes that have a channel between them.
+            Each edge has the attributes `isopen` and `capacity`, a mapping
+            from one of the participants to the amount it can transfer to
+            the other, the capacity is unknown until it's updated.
     """
-
-    for edge in edge_list:
-        if len(edge) != 2:
-            raise ValueError('All values in edge_list must be of length two (origin, destination)')
-
-        origin, destination = edge
-
-        if not isaddress(origin) or not isaddress(destination):
-            raise ValueError('All values in edge_list must be valid addresses')
+    check_edge_list(edge_list)
 
     graph = networkx.Graph()  # undirected graph, for bidirectional channels
 
     for first, second in edge_list:
-        graph.add_edge(first, second)
+        graph.add_edge(first, second, isopen=True, capacity=dict())
 
     return graph
 
@@ -37,6 +100,8 @@ def make_graph(edge_list):
 class ChannelGraph(object):
     """ Has Graph based on the channels and can find path between participants. """
 
+    max_routes = 5  #: default number of routes returned by `get_best_routes`
+
     def __init__(self, edge_list):
         """
         Args:
@@ -45,6 +110,13 @@ class ChannelGraph(object):
         """
         self.graph = make_graph(edge_list)
 
+        #: incremented every time the topology, a capacity or a status changes
+        self.version = 0
+
+        #: callbacks called with (kind, address1, address2) on every change,
+        #: kind is one of 'added', 'removed', 'opened', 'closed' or 'capacity'
+        self.callbacks = list()
+
     def get_shortest_paths(self, source, target):
         """Compute all shortest paths in the graph.
 
@@ -57,6 +129,147 @@ class ChannelGraph(object):
 
         return networkx.all_shortest_paths(self.graph, source, target)
 
+    def has_path(self, source, target):
+        """ True if there is a path from `source` to `target`. """
+        if source not in self.graph or target not in self.graph:
+            return False
+
+        return networkx.has_path(self.graph, source, target)
+
+    def has_channel(self, address1, address2):
+        return self.graph.has_edge(address1, address2)
+
+    def capacity(self, source, target):
+        """ Return the known amount that `source` can transfer to `target`,
+        None if it's unknown.
+        """
+        return self.graph[source][target]['capacity'].get(source)
+
+    def component_labels(self):
+        """ Return a mapping from each address to the label of its connected
+        component.
+        """
+        return dict(
+            (address, label)
+            for label, component in enumerate(networkx.connected_components(self.graph))
+            for address in component
+        )
+
+    def changed(self, kind, address1, address2):
+        self.version += 1
+
+        for callback in self.callbacks:
+            callback(kind, address1, address2)
+
+    def add_channel(self, address1, address2):
+        """ Add the channel between `address1` and `address2`, it's a no-op
+        if the channel is already known.
+        """
+        if not isaddress(address1) or not isaddress(address2):
+            raise ValueError('both addresses must be valid addresses')
+
+        if not self.graph.has_edge(address1, address2):
+            self.graph.add_edge(address1, address2, isopen=True, capacity=dict())
+            self.changed('added', address1, address2)
+
+    def remove_channel(self, address1, address2):
+        """ Remove the channel between `address1` and `address2`, the nodes
+        without channels are removed too.
+        """
+        if self.graph.has_edge(address1, address2):
+            self.graph.remove_edge(address1, address2)
+
+            for address in (address1, address2):
+                if not self.graph.degree(address):
+                    self.graph.remove_node(address)
+
+            self.changed('removed', address1, address2)
+
+    def update_capacity(self, source, target, capacity):
+        """ Set the amount that `source` can transfer to `target` through
+        their channel.
+        """
+        capacities = self.graph[source][target]['capacity']
+
+        if capacities.get(source) != capacity:
+            capacities[source] = capacity
+            self.changed('capacity', source, target)
+
+    def update_status(self, address1, address2, isopen):
+        """ Mark the channel between `address1` and `address2` as open or
+        closed, closed channels are not used for routing.
+        """
+        data = self.graph[address1][address2]
+
+        if data['isopen'] != isopen:
+            data['isopen'] = isopen
+            self.changed('opened' if isopen else 'closed', address1, address2)
+
+    def routing_graph(self, amount):
+        """ Return a directed read-only view with the edges that can be
+        used to transfer `amount`, the channel must be open and the capacity
+        in the direction of the transfer must be unknown or at least `amount`.
+
+        The view shares the data of the graph, nothing is copied, the edges
+        are filtered while the search walks them.
+        """
+        graph = self.graph
+
+        def usable(sender, receiver):
+            data = graph[sender][receiver]
+
+            if not data['isopen']:
+                return False
+
+            sender_capacity = data['capacity'].get(sender)
+            return sender_capacity is None or sender_capacity >= amount
+
+        return subgraph_view(graph.to_directed(as_view=True), filter_edge=usable)
+
+    def get_best_routes(self, source, target, amount, max_routes=None):
+        """ Compute the routes from `source` to `target` that can be used to
+        transfer `amount`.
+
+        The k shortest simple paths are computed with Yen's algorithm on the
+        graph of usable edges, so closed channels and channels without
+        enough capacity are never returned.
+
+        Returns:
+            List[list]: Up to `max_routes` paths, ordered by the number of hops
+            and then by the largest known capacity along the path.
+        """
+        if not isaddress(source) or not isaddress(target):
+            raise ValueError('both source and target must be valid addresses')
+
+        if max_routes is None:
+            max_routes = self.max_routes
+
+        if source not in self.graph or target not in self.graph:
+            return []
+
+        paths = networkx.shortest_simple_paths(self.routing_graph(amount), source, target)
+
+        try:
+            routes = list(islice(paths, max_routes))
+        except networkx.NetworkXNoPath:
+            return []
+
+        def route_order(path):
+            capacities = [
+                self.capacity(sender, receiver)
+                for sender, receiver in zip(path[:-1], path[1:])
+            ]
+            known_capacities = [
+                capacity
+                for capacity in capacities
+                if capacity is not None
+            ]
+            bottleneck = min(known_capacities) if known_capacities else 0
+            return (len(path), -bottleneck)
+
+        routes.sort(key=route_order)
+        return routes
+
     def get_paths_of_length(self, source, num_hops=1):
         """ Searchs for all nodes that are `num_hops` away.
 
@@ -64,13 +277,774 @@ class ChannelGraph(object):
             list of paths: A list of all shortest paths that have length lenght
             `num_hops + 1`
         """
-        # return a dictionary keyed by targets
-        # with a list of nodes in a shortest path
-        # from the source to one of the targets.
-        all_paths = networkx.shortest_path(self.graph, source)
+        return list(self.iter_paths_of_length(source, num_hops))
+
+    def iter_paths_of_length(self, source, num_hops=1):
+        """ Lazy version of `get_paths_of_length`, the search doesn't go
+        farther than `num_hops`.
+        """
+        if source not in self.graph:
+            raise networkx.NodeNotFound('Source {} not in G'.format(source.encode('hex')))
+
+        return (
+            parents_path(parents, node)
+            for node, parents in bounded_breadth_first(self.graph.neighbors, source, num_hops)
+        )
+
+    def get_nodes_at_distance(self, source, num_hops=1):
+        """ Return the set of nodes that are `num_hops` away. """
+        if source not in self.graph:
+            raise networkx.NodeNotFound('Source {} not in G'.format(source.encode('hex')))
+
+        return set(
+            node
+            for node, _ in bounded_breadth_first(self.graph.neighbors, source, num_hops)
+        )
+
+
+class CompactChannelGraph(object):
+    """ ChannelGraph backend for large networks.
+
+    The addresses are interned to integer ids and the adjacency is kept in
+    compressed sparse row arrays, the neighbours of the node `i` are
+    `neighbours[offsets[i]:offsets[i + 1]]` sorted by id. The capacity from
+    `i` to the neighbour at a position is kept at the same position of
+    `edge_capacities`. The closed channels are kept by pairs of ids.
+
+    The arrays are immutable, the channels added afterwards are kept in
+    `extra_neighbours` with their capacities in `extra_capacities`, and the
+    removed ones are masked by `removed` until these grow too large and the
+    arrays are rebuilt.
+
+    This uses a few bytes per channel instead of the dictionaries that
+    networkx keeps for every node and edge, the paths are computed with a
+    breadth-first search over the arrays.
+    """
+
+    max_routes = ChannelGraph.max_routes
+
+    # markers in `edge_capacities`, the capacities that don't fit in the
+    # array are kept in `big_capacities`
+    UNKNOWN_CAPACITY = -1
+    BIG_CAPACITY = -2
+    MAX_CAPACITY = 2 ** (8 * array('l').itemsize - 1) - 1
+
+    def __init__(self, edge_list):
+        """
+        Args:
+            edge_list (List[(address1, address2)]): all the netting contracts
+                that participate in the network.
+        """
+        check_edge_list(edge_list)
+
+        self.addresses = list()  #: id -> address
+        self.address_ids = dict()  #: address -> id
+
+        channels = set()
+        for address1, address2 in edge_list:
+            id1 = self.intern(address1)
+            id2 = self.intern(address2)
+
+            if id1 != id2:
+                channels.add((min(id1, id2), max(id1, id2)))
+
+        self.build(channels)
+
+        self.closed = set()  #: (smaller id, bigger id) of the closed channels
+
+        #: incremented every time the topology, a capacity or a status changes
+        self.version = 0
+
+        #: callbacks called with (kind, address1, address2) on every change,
+        #: kind is one of 'added', 'removed', 'opened', 'closed' or 'capacity'
+        self.callbacks = list()
+
+    def build(self, channels):
+        """ Build the arrays from `channels`, a set of id pairs. """
+        degrees = [0] * len(self.addresses)
+        for id1, id2 in channels:
+            degrees[id1] += 1
+            degrees[id2] += 1
+
+        offsets = array('l', [0]) * (len(self.addresses) + 1)
+        for node_id, degree in enumerate(degrees):
+            offsets[node_id + 1] = offsets[node_id] + degree
+
+        neighbours = array('i', [0]) * (2 * len(channels))
+        filled = array('l', offsets[:-1])
+        for id1, id2 in channels:
+            neighbours[filled[id1]] = id2
+            filled[id1] += 1
+            neighbours[filled[id2]] = id1
+            filled[id2] += 1
+
+        # the neighbours of a node are sorted, the channels are searched
+        # with bisect
+        for node_id in range(len(self.addresses)):
+            start, end = offsets[node_id], offsets[node_id + 1]
+            neighbours[start:end] = array('i', sorted(neighbours[start:end]))
+
+        self.offsets = offsets
+        self.neighbours = neighbours
+        self.edge_capacities = array('l', [self.UNKNOWN_CAPACITY]) * len(neighbours)
+        self.big_capacities = dict()  #: position -> capacity too large for the array
+        self.extra_neighbours = dict()  #: id -> list of ids, added after the build
+        self.extra_capacities = dict()  #: (sender id, receiver id) -> capacity, extra channels
+        self.extra_count = 0
+        self.removed = set()  #: (smaller id, bigger id) removed after the build
+
+    def rebuild(self):
+        channels = set()
+        capacities = list()
+
+        for id1 in range(len(self.addresses)):
+            for id2 in self.neighbour_ids(id1):
+                if id1 < id2:
+                    channels.add((id1, id2))
+
+                capacity = self.get_capacity(id1, id2)
+                if capacity is not None:
+                    capacities.append((id1, id2, capacity))
+
+        self.build(channels)
+
+        for id1, id2, capacity in capacities:
+            self.set_capacity(id1, id2, capacity)
+
+    def intern(self, address):
+        address_id = self.address_ids.get(address)
+
+        if address_id is None:
+            address_id = self.address_ids[address] = len(self.addresses)
+            self.addresses.append(address)
+
+        return address_id
+
+    def in_arrays(self, id1, id2):
+        """ True if the channel `id1` `id2` is in the arrays, even if it was
+        removed afterwards.
+        """
+        if id1 + 1 >= len(self.offsets):
+            return False
+
+        start, end = self.offsets[id1], self.offsets[id1 + 1]
+        position = bisect_left(self.neighbours, id2, start, end)
+        return position < end and self.neighbours[position] == id2
+
+    def edge_position(self, id1, id2):
+        """ Return the position of the channel `id1` `id2` in the arrays,
+        None if it was added after the build.
+        """
+        if id1 + 1 >= len(self.offsets):
+            return None
+
+        start, end = self.offsets[id1], self.offsets[id1 + 1]
+        position = bisect_left(self.neighbours, id2, start, end)
+
+        if position < end and self.neighbours[position] == id2:
+            return position
+
+        return None
+
+    def get_capacity(self, sender_id, receiver_id):
+        """ Return the known capacity from `sender_id` to `receiver_id`,
+        None if it's unknown.
+        """
+        position = self.edge_position(sender_id, receiver_id)
+
+        if position is None:
+            return self.extra_capacities.get((sender_id, receiver_id))
+
+        capacity = self.edge_capacities[position]
+
+        if capacity == self.UNKNOWN_CAPACITY:
+            return None
+
+        if capacity == self.BIG_CAPACITY:
+            return self.big_capacities[position]
+
+        return capacity
+
+    def set_capacity(self, sender_id, receiver_id, capacity):
+        position = self.edge_position(sender_id, receiver_id)
+
+        if position is None:
+            if capacity is None:
+                self.extra_capacities.pop((sender_id, receiver_id), None)
+            else:
+                self.extra_capacities[(sender_id, receiver_id)] = capacity
+            return
+
+        self.big_capacities.pop(position, None)
+
+        if capacity is None:
+            self.edge_capacities[position] = self.UNKNOWN_CAPACITY
+        elif 0 <= capacity <= self.MAX_CAPACITY:
+            self.edge_capacities[position] = capacity
+        else:
+            self.edge_capacities[position] = self.BIG_CAPACITY
+            self.big_capacities[position] = capacity
+
+    def neighbour_ids(self, node_id):
+        """ Yield the ids of the nodes with a channel with `node_id`. """
+        if node_id + 1 < len(self.offsets):
+            removed = self.removed
+            neighbours = self.neighbours
+
+            for position in xrange(self.offsets[node_id], self.offsets[node_id + 1]):
+                neighbour_id = neighbours[position]
+
+                if removed and (min(node_id, neighbour_id), max(node_id, neighbour_id)) in removed:
+                    continue
+
+                yield neighbour_id
+
+        for neighbour_id in self.extra_neighbours.get(node_id, ()):
+            yield neighbour_id
+
+    def channel_ids(self, address1, address2):
+        """ Return the ids of the participants, raises KeyError if there is no
+        channel between them.
+        """
+        id1 = self.address_ids.get(address1)
+        id2 = self.address_ids.get(address2)
+
+        if id1 is None or id2 is None or not self._has_channel(id1, id2):
+            raise KeyError('unknown channel')
+
+        return id1, id2
 
+    def _has_channel(self, id1, id2):
+        if id2 in self.extra_neighbours.get(id1, ()):
+            return True
+
+        return self.in_arrays(id1, id2) and (min(id1, id2), max(id1, id2)) not in self.removed
+
+    def has_channel(self, address1, address2):
+        try:
+            self.channel_ids(address1, address2)
+        except KeyError:
+            return False
+        return True
+
+    def capacity(self, source, target):
+        """ Return the known amount that `source` can transfer to `target`,
+        None if it's unknown.
+        """
+        return self.get_capacity(*self.channel_ids(source, target))
+
+    def component_labels(self):
+        """ Return a mapping from each address to the label of its connected
+        component.
+        """
+        labels = array('i', [-1]) * len(self.addresses)
+
+        for node_id in range(len(self.addresses)):
+            if labels[node_id] != -1:
+                continue
+
+            labels[node_id] = node_id
+            queue = deque([node_id])
+            while queue:
+                for neighbour_id in self.neighbour_ids(queue.popleft()):
+                    if labels[neighbour_id] == -1:
+                        labels[neighbour_id] = node_id
+                        queue.append(neighbour_id)
+
+        return dict(zip(self.addresses, labels))
+
+    def changed(self, kind, address1, address2):
+        self.version += 1
+
+        for callback in self.callbacks:
+            callback(kind, address1, address2)
+
+    def add_channel(self, address1, address2):
+        """ Add the channel between `address1` and `address2`, it's a no-op
+        if the channel is already known.
+        """
+        if not isaddress(address1) or not isaddress(address2):
+            raise ValueError('both addresses must be valid addresses')
+
+        id1 = self.intern(address1)
+        id2 = self.intern(address2)
+
+        if id1 == id2 or self._has_channel(id1, id2):
+            return
+
+        pair = (min(id1, id2), max(id1, id2))
+        if pair in self.removed:
+            self.removed.discard(pair)
+        else:
+            self.extra_neighbours.setdefault(id1, list()).append(id2)
+            self.extra_neighbours.setdefault(id2, list()).append(id1)
+            self.extra_count += 1
+
+        self.changed('added', address1, address2)
+        self.maybe_rebuild()
+
+    def remove_channel(self, address1, address2):
+        """ Remove the channel between `address1` and `address2`. """
+        try:
+            id1, id2 = self.channel_ids(address1, address2)
+        except KeyError:
+            return
+
+        pair = (min(id1, id2), max(id1, id2))
+        if id2 in self.extra_neighbours.get(id1, ()):
+            self.extra_neighbours[id1].remove(id2)
+            self.extra_neighbours[id2].remove(id1)
+            self.extra_count -= 1
+        else:
+            self.removed.add(pair)
+
+        self.set_capacity(id1, id2, None)
+        self.set_capacity(id2, id1, None)
+        self.closed.discard(pair)
+
+        self.changed('removed', address1, address2)
+        self.maybe_rebuild()
+
+    def maybe_rebuild(self):
+        """ Rebuild the arrays once the channels changed since the last build
+        are a quarter of the channels in it.
+        """
+        changes = self.extra_count + len(self.removed)
+
+        if changes > 64 and changes * 8 > len(self.neighbours):
+            self.rebuild()
+
+    def update_capacity(self, source, target, capacity):
+        """ Set the amount that `source` can transfer to `target` through
+        their channel.
+        """
+        sender_id, receiver_id = self.channel_ids(source, target)
+
+        if self.get_capacity(sender_id, receiver_id) != capacity:
+            self.set_capacity(sender_id, receiver_id, capacity)
+            self.changed('capacity', source, target)
+
+    def update_status(self, address1, address2, isopen):
+        """ Mark the channel between `address1` and `address2` as open or
+        closed, closed channels are not used for routing.
+        """
+        id1, id2 = self.channel_ids(address1, address2)
+        pair = (min(id1, id2), max(id1, id2))
+
+        if isopen and pair in self.closed:
+            self.closed.discard(pair)
+            self.changed('opened', address1, address2)
+        elif not isopen and pair not in self.closed:
+            self.closed.add(pair)
+            self.changed('closed', address1, address2)
+
+    def source_id(self, source):
+        source_id = self.address_ids.get(source)
+
+        if source_id is None:
+            raise networkx.NodeNotFound('Source {} not in G'.format(source.encode('hex')))
+
+        return source_id
+
+    def breadth_first(self, source_id, max_depth=None, usable=None):
+        """ Return the depth of the reachable nodes and their parents, indexed
+        by node id, -1 marks the unreached nodes.
+
+        Args:
+            source_id (int): The node the search starts from.
+            max_depth (int): The nodes farther than this are not searched.
+            usable (callable): Called with `(sender id, receiver id)`, the
+                channels for which it returns False are not followed.
+        """
+        depths = array('i', [-1]) * len(self.addresses)
+        parents = array('i', [-1]) * len(self.addresses)
+        depths[source_id] = 0
+
+        queue = deque([source_id])
+        while queue:
+            node_id = queue.popleft()
+            depth = depths[node_id] + 1
+
+            if max_depth is not None and depth > max_depth:
+                break
+
+            for neighbour_id in self.neighbour_ids(node_id):
+                if depths[neighbour_id] != -1:
+                    continue
+
+                if usable is not None and not usable(node_id, neighbour_id):
+                    continue
+
+                depths[neighbour_id] = depth
+                parents[neighbour_id] = node_id
+                queue.append(neighbour_id)
+
+        return depths, parents
+
+    @staticmethod
+    def tree_path(parents, node_id):
+        path = [node_id]
+
+        while parents[node_id] != -1:
+            node_id = parents[node_id]
+            path.append(node_id)
+
+        path.reverse()
+        return path
+
+    def get_shortest_paths(self, source, target):
+        """Compute all shortest paths in the graph.
+
+        Returns:
+            generator of lists: A generator of all paths between source and
+            target.
+        """
+        if not isaddress(source) or not isaddress(target):
+            raise ValueError('both source and target must be valid addresses')
+
+        source_id = self.source_id(source)
+        target_id = self.address_ids.get(target)
+
+        depths, _ = self.breadth_first(source_id)
+
+        if target_id is None or depths[target_id] == -1:
+            raise networkx.NetworkXNoPath()
+
+        return self._shortest_paths(depths, source_id, target_id)
+
+    def _shortest_paths(self, depths, source_id, target_id):
+        addresses = self.addresses
+
+        # walk back from the target through the neighbours one hop closer
+        stack = [[target_id]]
+        while stack:
+            reversed_path = stack.pop()
+            node_id = reversed_path[-1]
+
+            if node_id == source_id:
+                yield [addresses[path_id] for path_id in reversed(reversed_path)]
+                continue
+
+            for neighbour_id in self.neighbour_ids(node_id):
+                if depths[neighbour_id] == depths[node_id] - 1:
+                    stack.append(reversed_path + [neighbour_id])
+
+    def get_paths_of_length(self, source, num_hops=1):
+        """ Searchs for all nodes that are `num_hops` away.
+
+        Returns:
+            list of paths: A list of all shortest paths that have length lenght
+            `num_hops + 1`
+        """
+        return list(self.iter_paths_of_length(source, num_hops))
+
+    def iter_paths_of_length(self, source, num_hops=1):
+        """ Lazy version of `get_paths_of_length`, the search doesn't go
+        farther than `num_hops`.
+        """
+        source_id = self.source_id(source)
+        addresses = self.addresses
+
+        return (
+            [addresses[path_id] for path_id in parents_path(parents, node_id)]
+            for node_id, parents in bounded_breadth_first(self.neighbour_ids, source_id, num_hops)
+        )
+
+    def get_nodes_at_distance(self, source, num_hops=1):
+        """ Return the set of nodes that are `num_hops` away. """
+        source_id = self.source_id(source)
+
+        return set(
+            self.addresses[node_id]
+            for node_id, _ in bounded_breadth_first(self.neighbour_ids, source_id, num_hops)
+        )
+
+    def has_path(self, source, target):
+        """ True if there is a path from `source` to `target`. """
+        source_id = self.address_ids.get(source)
+        target_id = self.address_ids.get(target)
+
+        if source_id is None or target_id is None:
+            return False
+
+        depths, _ = self.breadth_first(source_id)
+        return depths[target_id] != -1
+
+    def _shortest_usable_path(self, source_id, target_id, usable):
+        depths, parents = self.breadth_first(source_id, usable=usable)
+
+        if depths[target_id] == -1:
+            return None
+
+        return self.tree_path(parents, target_id)
+
+    def k_shortest_paths(self, source_id, target_id, usable, k):
+        """ Yen's algorithm, return up to `k` loopless paths ordered by their
+        length, only the channels accepted by `usable` are followed.
+        """
+        first_path = self._shortest_usable_path(source_id, target_id, usable)
+        if first_path is None:
+            return []
+
+        routes = [first_path]
+        candidates = list()  # heap of (hops, path)
+        seen = set([tuple(first_path)])
+
+        while len(routes) < k:
+            previous = routes[-1]
+
+            for index in range(len(previous) - 1):
+                root = previous[:index + 1]
+
+                # the deviations already taken from this root and the root
+                # itself are removed, so the spur path is new and loopless
+                removed_channels = set(
+                    (route[index], route[index + 1])
+                    for route in routes
+                    if route[:index + 1] == root
+                )
+                removed_nodes = set(root[:-1])
+
+                def spur_usable(sender_id, receiver_id, removed_channels=removed_channels,
+                                removed_nodes=removed_nodes):
+                    if (sender_id, receiver_id) in removed_channels:
+                        return False
+                    if receiver_id in removed_nodes:
+                        return False
+                    return usable(sender_id, receiver_id)
+
+                spur_path = self._shortest_usable_path(previous[index], target_id, spur_usable)
+
+                if spur_path is not None:
+                    path = root[:-1] + spur_path
+
+                    if tuple(path) not in seen:
+                        seen.add(tuple(path))
+                        heapq.heappush(candidates, (len(path), path))
+
+            if not candidates:
+                break
+
+            _, path = heapq.heappop(candidates)
+            routes.append(path)
+
+        return routes
+
+    def get_best_routes(self, source, target, amount, max_routes=None):
+        """ Compute the routes from `source` to `target` that can be used to
+        transfer `amount`.
+
+        Same as `ChannelGraph.get_best_routes`, Yen's algorithm is run over
+        the arrays with the unusable channels masked out.
+
+        Returns:
+            List[list]: Up to `max_routes` paths, ordered by the number of hops
+            and then by the largest known capacity along the path.
+        """
+        if not isaddress(source) or not isaddress(target):
+            raise ValueError('both source and target must be valid addresses')
+
+        if max_routes is None:
+            max_routes = self.max_routes
+
+        source_id = self.address_ids.get(source)
+        target_id = self.address_ids.get(target)
+
+        if source_id is None or target_id is None or source_id == target_id:
+            return []
+
+        get_capacity, closed = self.get_capacity, self.closed
+
+        def usable(sender_id, receiver_id):
+            if closed and (min(sender_id, receiver_id), max(sender_id, receiver_id)) in closed:
+                return False
+
+            capacity = get_capacity(sender_id, receiver_id)
+            return capacity is None or capacity >= amount
+
+        routes = self.k_shortest_paths(source_id, target_id, usable, max_routes)
+
+        def route_order(path):
+            capacities = [
+                get_capacity(sender_id, receiver_id)
+                for sender_id, receiver_id in zip(path[:-1], path[1:])
+            ]
+            known_capacities = [
+                capacity
+                for capacity in capacities
+                if capacity is not None
+            ]
+            bottleneck = min(known_capacities) if known_capacities else 0
+            return (len(path), -bottleneck)
+
+        routes.sort(key=route_order)
         return [
-            path
-            for path in all_paths.values()
-            if len(path) == num_hops + 1
+            [self.addresses[node_id] for node_id in route]
+            for route in routes
         ]
+
+
+class RouteCache(object):
+    """ Caches the routes and the connectivity of a channel graph.
+
+    The routes are cached by (source, target) without the capacity pruning,
+    the capacities change with every transfer and are checked when the
+    routes are used. An entry is only invalidated when a channel along one
+    of its routes is removed or closed, a new or reopened channel can create
+    a shorter route for any pair so it clears the whole cache.
+
+    At most `max_entries` pairs are cached, the least recently used one is
+    evicted first.
+
+    The connected components are labeled once and merged when channels are
+    added, they are only recomputed after a channel is removed.
+    """
+
+    max_entries = 1024
+
+    def __init__(self, channelgraph):
+        self.channelgraph = channelgraph
+        channelgraph.callbacks.append(self.on_change)
+
+        self.routes = OrderedDict()  #: (source, target) -> routes, least recently used first
+        self.channel_routes = dict()  #: channel -> set of (source, target) using it
+        self.hits = 0
+        self.misses = 0
+
+        self.components = None  #: address -> label, None if it must be recomputed
+        self.component_members = None  #: label -> list of addresses
+
+    @staticmethod
+    def channel_key(address1, address2):
+        return (min(address1, address2), max(address1, address2))
+
+    def on_change(self, kind, address1, address2):
+        if kind == 'capacity':
+            return
+
+        if kind == 'added':
+            self.clear_routes()
+            self.join_components(address1, address2)
+            return
+
+        if kind == 'opened':
+            self.clear_routes()
+            return
+
+        for key in self.channel_routes.pop(self.channel_key(address1, address2), ()):
+            self.discard(key)
+
+        if kind == 'removed':
+            self.components = None
+            self.component_members = None
+
+    def clear_routes(self):
+        self.routes.clear()
+        self.channel_routes.clear()
+
+    def discard(self, key):
+        routes = self.routes.pop(key, None)
+
+        for path in routes or ():
+            for channel in zip(path[:-1], path[1:]):
+                keys = self.channel_routes.get(self.channel_key(*channel))
+
+                if keys is not None:
+                    keys.discard(key)
+
+    def get_routes(self, source, target):
+        """ Return the routes from `source` to `target` that use only open
+        channels, regardless of their capacity.
+        """
+        key = (source, target)
+        routes = self.routes.pop(key, None)
+
+        if routes is not None:
+            # reinserted as the most recently used
+            self.routes[key] = routes
+            self.hits += 1
+            return routes
+
+        self.misses += 1
+        routes = self.channelgraph.get_best_routes(source, target, 0)
+
+        if len(self.routes) >= self.max_entries:
+            self.discard(next(iter(self.routes)))
+
+        self.routes[key] = routes
+        for path in routes:
+            for channel in zip(path[:-1], path[1:]):
+                self.channel_routes.setdefault(self.channel_key(*channel), set()).add(key)
+
+        return routes
+
+    def get_best_routes(self, source, target, amount, max_routes=None):
+        """ Same as `get_best_routes` of the channel graph, the graph is only
+        searched if the routes are not cached or if none of them can transfer
+        `amount`.
+        """
+        capacity = self.channelgraph.capacity
+        ranked = list()
+
+        for path in self.get_routes(source, target):
+            known_capacities = [
+                channel_capacity
+                for channel_capacity in (
+                    capacity(sender, receiver)
+                    for sender, receiver in zip(path[:-1], path[1:])
+                )
+                if channel_capacity is not None
+            ]
+
+            if known_capacities and min(known_capacities) < amount:
+                continue
+
+            bottleneck = min(known_capacities) if known_capacities else 0
+            ranked.append(((len(path), -bottleneck), path))
+
+        if not ranked:
+            return self.channelgraph.get_best_routes(source, target, amount, max_routes)
+
+        ranked.sort(key=lambda item: item[0])
+        return [path for _, path in ranked[:max_routes]]
+
+    def has_path(self, source, target):
+        """ True if there is a path from `source` to `target`. """
+        if self.components is None:
+            self.components = self.channelgraph.component_labels()
+            self.component_members = dict()
+
+            for address, label in self.components.items():
+                self.component_members.setdefault(label, list()).append(address)
+
+        label = self.components.get(source)
+        return label is not None and label == self.components.get(target)
+
+    def join_components(self, address1, address2):
+        if self.components is None:
+            return
+
+        components, members = self.components, self.component_members
+        label1 = components.get(address1)
+        label2 = components.get(address2)
+
+        if label1 is None and label2 is None:
+            label = object()
+            components[address1] = components[address2] = label
+            members[label] = [address1, address2]
+
+        elif label1 is None or label2 is None:
+            label = label2 if label1 is None else label1
+            address = address1 if label1 is None else address2
+            components[address] = label
+            members[label].append(address)
+
+        elif label1 != label2:
+            # relabel the smaller component
+            if len(members[label1]) < len(members[label2]):
+                label1, label2 = label2, label1
+
+            for address in members[label2]:
+                components[address] = label1
+
+            members[label1].extend(members.pop(label2))
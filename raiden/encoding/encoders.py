@@ -1,11 +1,19 @@
 # -*- coding: utf8 -*-
-import codecs
+import struct
 import sys
-
-from rlp.utils import int_to_big_endian
+from binascii import hexlify, unhexlify
 
 PY2 = sys.version_info.major == 2
 
+# struct handles the sizes of the native integer types without a round trip
+# through an hex string
+FIXED_SIZE_INTEGER = {
+    1: struct.Struct('>B'),
+    2: struct.Struct('>H'),
+    4: struct.Struct('>I'),
+    8: struct.Struct('>Q'),
+}
+
 
 __all__ = ('integer',)
 
@@ -28,12 +36,22 @@ class integer(object):  # pylint: disable=invalid-name
 
     if PY2:
         @staticmethod
-        def encode(value, length):  # pylint: disable=unused-argument
-            return int_to_big_endian(value)
+        def encode(value, length):
+            hex_value = '%x' % value
+
+            if len(hex_value) > length * 2:
+                raise ValueError('value {} does not fit in {} bytes'.format(value, length))
+
+            return unhexlify(hex_value.zfill(length * 2))
 
         @staticmethod
         def decode(value):
-            return int(codecs.encode(value, 'hex'), 16)
+            fixed = FIXED_SIZE_INTEGER.get(len(value))
+
+            if fixed is not None:
+                return fixed.unpack(value)[0]
+
+            return int(hexlify(value), 16)
     else:
         @staticmethod
         def encode(value, length):
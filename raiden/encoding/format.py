@@ -1,4 +1,5 @@
 # -*- coding: utf8 -*-
+import struct
 from collections import namedtuple, Counter
 
 try:  # py3k
@@ -85,6 +86,27 @@ def namedbuffer(buffer_name, fields_spec):  # noqa (ignore ciclomatic complexity
     # big endian format
     fields_format = '>' + ''.join(field.format_string for field in fields_spec)
 
+    # The codec reads and writes every field as a raw byte string in a single
+    # call, the encoders are applied on top of it. Paddings are skipped.
+    codec = struct.Struct('>' + ''.join(
+        '{}x'.format(field.size_bytes)
+        if field.name.startswith('pad_')
+        else '{}s'.format(field.size_bytes)
+        for field in fields_spec
+    ))
+    values_tuple = namedtuple('{}_values'.format(buffer_name), fields)
+    field_names = frozenset(fields)
+
+    decoders = [
+        (index, name_field[name].encoder.decode)
+        for index, name in enumerate(fields)
+        if name_field[name].encoder
+    ]
+    encoders = [
+        (name, name_field[name].size_bytes, name_field[name].encoder)
+        for name in fields
+    ]
+
     def __init__(self, data):
         if len(data) < size:
             raise ValueError('data buffer is too small')
@@ -127,16 +149,74 @@ def namedbuffer(buffer_name, fields_spec):  # noqa (ignore ciclomatic complexity
         else:
             super(self.__class__, self).__setattr__(name, value)
 
+    def unpack(self):
+        ''' Decodes all the fields with a single call.
+
+        Returns:
+            namedtuple: The decoded values, in the same order as `fields`.
+        '''
+        values = list(codec.unpack_from(self.data))
+
+        for index, decode in decoders:
+            values[index] = decode(values[index])
+
+        return values_tuple._make(values)
+
+    def pack(self, **values):
+        ''' Encodes the given fields and writes them with a single call,
+        fields that are not given keep their current content and the padding
+        is zeroed.
+        '''
+        if not field_names.issuperset(values):
+            unknown = set(values) - field_names
+            raise ValueError('unknown fields {}'.format(', '.join(sorted(unknown))))
+
+        current = None
+        packed = list()
+
+        for index, (name, size_bytes, encoder) in enumerate(encoders):
+            if name not in values:
+                if current is None:
+                    current = codec.unpack_from(self.data)
+                packed.append(current[index])
+                continue
+
+            value = values[name]
+            if encoder:
+                encoder.validate(value)
+                value = encoder.encode(value, size_bytes)
+            elif not isinstance(value, bytes):
+                # struct only accepts strings, values sliced from another
+                # buffer can be bytearrays
+                value = bytes(value)
+
+            length = len(value)
+            if length > size_bytes:
+                raise ValueError('value with length {length} for {attr} is to big'.format(
+                    length=length,
+                    attr=name,
+                ))
+            elif length < size_bytes:
+                # struct pads strings on the right, the fields are padded on the left
+                value = b'\x00' * (size_bytes - length) + value
+
+            packed.append(value)
+
+        codec.pack_into(self.data, 0, *packed)
+
     attributes = {
         '__init__': __init__,
         '__slots__': ('data',),
         '__getattr__': __getattr__,
         '__setattr__': __setattr__,
+        'pack': pack,
+        'unpack': unpack,
 
         'fields': fields,
         'fields_spec': fields_spec,
         'name': buffer_name,
         'format': fields_format,
+        'codec': codec,
         'size': size,
     }
 
@@ -42,6 +42,8 @@ MEDIATEDTRANSFER_CMDID = 7
 CANCELTRANSFER_CMDID = 8
 TRANSFERTIMEOUT_CMDID = 9
 CONFIRMTRANSFER_CMDID = 10
+ENVELOPE_CMDID = 11
+CUMULATIVEACK_CMDID = 12
 
 ACK = to_bigendian(ACK_CMDID)
 PING = to_bigendian(PING_CMDID)
@@ -54,6 +56,8 @@ MEDIATEDTRANSFER = to_bigendian(MEDIATEDTRANSFER_CMDID)
 CANCELTRANSFER = to_bigendian(CANCELTRANSFER_CMDID)
 TRANSFERTIMEOUT = to_bigendian(TRANSFERTIMEOUT_CMDID)
 CONFIRMTRANSFER = to_bigendian(CONFIRMTRANSFER_CMDID)
+ENVELOPE = to_bigendian(ENVELOPE_CMDID)
+CUMULATIVEACK = to_bigendian(CUMULATIVEACK_CMDID)
 
 
 # pylint: disable=invalid-name
@@ -240,10 +244,107 @@ CMDID_MESSAGE = {
 }
 
 
+# An envelope carries a sequence of messages in a single datagram, it has a
+# variable size so it is not a namedbuffer:
+#
+#   [cmdid][pad(3)] followed by [length (2 bytes)][message] for each message
+ENVELOPE_HEADER = ENVELOPE + b'\x00' * 3
+envelope_length = struct.Struct('>H')
+
+
+def wrap_envelope(messages_data):
+    ''' Pack the encoded messages `messages_data` into a single envelope. '''
+    parts = [ENVELOPE_HEADER]
+
+    for data in messages_data:
+        parts.append(envelope_length.pack(len(data)))
+        parts.append(data)
+
+    return b''.join(parts)
+
+
+def unwrap_envelope(data):
+    ''' Returns the list of encoded messages packed in the envelope `data`,
+    these are slices of `data` and are not copied if it is a memoryview.
+    '''
+    if data[:1] != ENVELOPE:
+        raise ValueError('data is not an envelope')
+
+    messages_data = list()
+    data_length = len(data)
+    start = len(ENVELOPE_HEADER)
+
+    while start < data_length:
+        end = start + envelope_length.size
+        if end > data_length:
+            raise ValueError('truncated envelope')
+
+        length, = envelope_length.unpack(data[start:end])
+
+        start, end = end, end + length
+        if end > data_length:
+            raise ValueError('truncated envelope')
+
+        messages_data.append(data[start:end])
+        start = end
+
+    return messages_data
+
+
+# A cumulative ack echoes the hashes of several messages from the same peer:
+#
+#   [cmdid][pad(3)][sender] followed by [echo] for each message
+CUMULATIVEACK_HEADER = CUMULATIVEACK + b'\x00' * 3
+CUMULATIVEACK_ECHOES_START = len(CUMULATIVEACK_HEADER) + sender.size_bytes
+
+
+def wrap_cumulative_ack(sender_address, echoes):
+    ''' Pack `echoes` sent by `sender_address` into a cumulative ack. '''
+    if len(sender_address) != sender.size_bytes:
+        raise ValueError('invalid sender')
+
+    if any(len(echo_) != echo.size_bytes for echo_ in echoes):
+        raise ValueError('invalid echo')
+
+    return b''.join([CUMULATIVEACK_HEADER, sender_address] + list(echoes))
+
+
+def unwrap_cumulative_ack(data):
+    ''' Returns the sender and the list of echoes of the cumulative ack `data`. '''
+    if data[:1] != CUMULATIVEACK:
+        raise ValueError('data is not a cumulative ack')
+
+    start = CUMULATIVEACK_ECHOES_START
+    if len(data) < start or (len(data) - start) % echo.size_bytes:
+        raise ValueError('invalid cumulative ack size')
+
+    view = memoryview(data)
+    sender_address = view[len(CUMULATIVEACK_HEADER):start].tobytes()
+    echoes = [
+        view[position:position + echo.size_bytes].tobytes()
+        for position in range(start, len(data), echo.size_bytes)
+    ]
+
+    return sender_address, echoes
+
+
+def as_view(data):
+    ''' Return `data` in a form that can be sliced without copying.
+
+    Indexing a bytearray returns integers instead of characters, so these are
+    wrapped in a memoryview, strings and memoryviews are used as-is.
+    '''
+    if isinstance(data, bytearray):
+        return memoryview(data)
+    return data
+
+
 def wrap_and_validate(data):
     ''' Try to decode data into a message and validate the signature, might
     return None if the data is invalid.
     '''
+    data = as_view(data)
+
     try:
         first_byte = data[0]
     except KeyError:
@@ -261,10 +362,14 @@ def wrap_and_validate(data):
         log.error('trying to decode invalid message')
 
     assert message_type.fields_spec[-1].name == 'signature', 'signature is not the last field'
-    message_data = message.data[:-signature.size_bytes]
+    # the signed data and the signature are views of the datagram, the signed
+    # data is hashed in place
+    view = memoryview(message.data)
+    message_data = view[:-signature.size_bytes]
+    message_signature = view[-signature.size_bytes:].tobytes()
 
     try:
-        publickey = recover_publickey(message_data, message.signature)
+        publickey = recover_publickey(message_data, message_signature)
     except ValueError:
         log.error('invalid signature')
 
@@ -273,6 +378,8 @@ def wrap_and_validate(data):
 
 def wrap(data):
     ''' Try to decode data into a message, might return None if the data is invalid. '''
+    data = as_view(data)
+
     try:
         first_byte = data[0]
     except KeyError:
@@ -2,14 +2,16 @@
 from c_secp256k1 import ecdsa_recover_compact as c_ecdsa_recover_compact
 from c_secp256k1 import ecdsa_sign_compact as c_ecdsa_sign_compact
 
-from raiden.utils import sha3
+from raiden.utils import keccak, sha3
 
 
 def recover_publickey(messagedata, signature):
     if len(signature) != 65:
         raise ValueError('invalid signature')
 
-    message_hash = sha3(messagedata)
+    # keccak hashes buffers in place, `messagedata` can be a view of the
+    # received datagram
+    message_hash = keccak(messagedata)
     publickey = c_ecdsa_recover_compact(message_hash, signature)
 
     return publickey
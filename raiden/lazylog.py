@@ -0,0 +1,194 @@
+# -*- coding: utf8 -*-
+""" Logging for the message hot path.
+
+The `slogging` loggers format the message before checking if any handler
+will emit it, the arguments are usually built with `str.format` and `pex`
+before the call is even made. `LazyLogger` checks the level first and hands
+the arguments untouched to the handlers, the record is only formatted if it
+is emitted, and `AsyncHandler` moves the formatting and the writing to a
+background greenlet.
+"""
+import logging
+import os
+import sys
+
+import gevent
+from gevent.queue import Queue, Full
+from ethereum import slogging
+
+from raiden.utils import pex
+
+__all__ = (
+    'Hex',
+    'LazyLogger',
+    'AsyncHandler',
+    'install_async_handlers',
+)
+
+# the frames of this module are skipped to find the caller, as `logging` does
+_srcfile = os.path.normcase(os.path.splitext(__file__)[0] + '.py')
+
+
+def find_caller():
+    """ Return the file name, line number and function name of the first
+    frame outside of this module.
+    """
+    frame = sys._getframe(1)  # pylint: disable=protected-access
+
+    while frame is not None:
+        code = frame.f_code
+
+        if os.path.normcase(code.co_filename) != _srcfile:
+            return code.co_filename, frame.f_lineno, code.co_name
+
+        frame = frame.f_back
+
+    return '(unknown file)', 0, '(unknown function)'
+
+
+class Hex(object):
+    """ Defers `pex(data)` until the record is formatted. """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return pex(self.data)
+
+    __repr__ = __str__
+
+
+class LazyLogger(object):
+    """ Wraps a logger, the messages use the `%` syntax and are only formatted
+    by the handlers that emit them.
+
+    The arguments are kept by reference until the record is formatted, with
+    an `AsyncHandler` that happens later on, so they must not be mutated
+    after the call.
+
+    A call can be tagged with a `category` to be sampled, only one in
+    `sample_rates[category]` of these calls is logged.
+    """
+
+    def __init__(self, logger, sample_rates=None):
+        self.logger = logger
+
+        #: category -> N, log one in N calls
+        self.sample_rates = dict(sample_rates or {})
+        self.sample_counters = dict()
+
+    def set_sample_rate(self, category, rate):
+        """ Log one in `rate` of the calls for `category`, a rate of 1
+        disables sampling.
+        """
+        if rate < 1:
+            raise ValueError('rate must be a positive number')
+
+        self.sample_rates[category] = rate
+        self.sample_counters.pop(category, None)
+
+    def sample(self, category):
+        """ Return True if this call for `category` must be logged. """
+        rate = self.sample_rates.get(category)
+
+        if rate is None or rate == 1:
+            return True
+
+        count = self.sample_counters.get(category, 0)
+        self.sample_counters[category] = count + 1
+        return count % rate == 0
+
+    def log(self, level, msg, *args, **kwargs):
+        logger = self.logger
+
+        if not logger.isEnabledFor(level):
+            return
+
+        category = kwargs.get('category')
+        if category is not None and not self.sample(category):
+            return
+
+        # slogging formats the json events itself
+        if getattr(logger, 'log_json', False):
+            logger.log(level, msg % args)
+            return
+
+        # only the calls that are logged pay for the frame walk
+        pathname, lineno, func = find_caller()
+        record = logger.makeRecord(logger.name, level, pathname, lineno, msg, args, None, func)
+        logger.handle(record)
+
+    def debug(self, msg, *args, **kwargs):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log(logging.WARNING, msg, *args, **kwargs)
+
+    warn = warning
+
+    def error(self, msg, *args, **kwargs):
+        self.log(logging.ERROR, msg, *args, **kwargs)
+
+
+class AsyncHandler(logging.Handler):
+    """ Queues the records and emits them with `handler` from a background
+    greenlet.
+
+    The records are dropped if more than `maxsize` are waiting, the logging
+    must not block nor grow without bounds while the node is busy.
+    """
+
+    def __init__(self, handler, maxsize=10000):
+        super(AsyncHandler, self).__init__(handler.level)
+        self.handler = handler
+        self.queue = Queue(maxsize)
+        self.dropped = 0
+        self.greenlet = None
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+            return
+
+        if self.greenlet is None:
+            self.greenlet = gevent.spawn(self._run)
+
+    def _run(self):
+        for record in self.queue:
+            self.handler.handle(record)
+
+    def flush(self):
+        """ Emit the queued records. """
+        while not self.queue.empty():
+            self.handler.handle(self.queue.get())
+
+        self.handler.flush()
+
+    def close(self):
+        self.flush()
+
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+
+        self.handler.close()
+        super(AsyncHandler, self).close()
+
+
+def install_async_handlers(logger=None, maxsize=10000):
+    """ Replace the handlers of `logger`, the slogging root logger by
+    default, by `AsyncHandler`s wrapping them.
+    """
+    if logger is None:
+        logger = slogging.getLogger()
+
+    for handler in list(logger.handlers):
+        if not isinstance(handler, AsyncHandler):
+            logger.removeHandler(handler)
+            logger.addHandler(AsyncHandler(handler, maxsize))
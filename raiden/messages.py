@@ -1,14 +1,13 @@
 # -*- coding: utf8 -*-
 # Copyright (c) 2015 Heiko Hees
-import warnings
-
 from raiden.encoding import messages, signing
 from raiden.encoding.format import buffer_for
-from raiden.utils import sha3, ishash, big_endian_to_int, pex
+from raiden.utils import keccak, sha3, ishash, big_endian_to_int, pex
 
 __all__ = (
     'BaseError',
     'Ack',
+    'CumulativeAck',
     'Ping',
     # 'Rejected',
     'SecretRequest',
@@ -56,11 +55,28 @@ class MessageHashable(object):
 class Message(MessageHashable):
     # pylint: disable=no-member
 
+    # The canonical encoding and it's hash are cached once the message is
+    # signed or decoded, changing any public attribute invalidates them. A
+    # decoded message keeps a view of the received buffer, it is only copied
+    # if the encoding is requested.
+    _encoded = None
+    _hash = None
+
+    def __setattr__(self, name, value):
+        if not name.startswith('_'):
+            self.__dict__['_encoded'] = None
+            self.__dict__['_hash'] = None
+
+        super(Message, self).__setattr__(name, value)
+
     @property
     def hash(self):
-        warnings.warn('Expensive comparison called')
-        packed = self.packed()
-        return sha3(packed.data)
+        if self._hash is None:
+            encoded = self._encoded
+            if encoded is None:
+                encoded = self.encode()
+            self._hash = keccak(encoded)
+        return self._hash
 
     def __eq__(self, other):
         return isinstance(other, self.__class__) and self.hash == other.hash
@@ -72,21 +88,31 @@ class Message(MessageHashable):
         return not self.__eq__(other)
 
     def __repr__(self):
-        packed = self.packed()
-
+        # the hash is cached for the messages that are sent or received
         return '<{klass} [{content}]>'.format(
             klass=self.__class__.__name__,
-            content=pex(packed.data),
+            content=pex(self.hash),
         )
 
     @classmethod
     def decode(cls, packed):
         packed = messages.wrap(packed)
-        return cls.unpack(packed)
+        message = cls.unpack(packed)
+        message._encoded = packed.data  # pylint: disable=protected-access
+        return message
 
     def encode(self):
-        packed = self.packed()
-        return bytes(packed.data)
+        encoded = self._encoded
+
+        if encoded is None:
+            packed = self.packed()
+            encoded = packed.data
+
+        if not isinstance(encoded, bytes):
+            encoded = memoryview(encoded).tobytes()
+
+        self._encoded = encoded
+        return encoded
 
     def packed(self):
         klass = messages.CMDID_MESSAGE[self.cmdid]
@@ -120,6 +146,7 @@ class SignedMessage(Message):
 
         self.sender = signing.address_from_key(public_key)
         self.signature = packed.signature
+        self._encoded = bytes(packed.data)
 
         return self
 
@@ -134,6 +161,7 @@ class SignedMessage(Message):
         packed, public_key = result
         message = cls.unpack(packed)  # pylint: disable=no-member
         message.sender = signing.address_from_key(public_key)
+        message._encoded = packed.data  # pylint: disable=protected-access
         return message
 
 
@@ -152,14 +180,43 @@ class Ack(Message):
 
     @staticmethod
     def unpack(packed):
+        values = packed.unpack()
         return Ack(
-            packed.sender,
-            packed.echo,
+            values.sender,
+            values.echo,
         )
 
     def pack(self, packed):
-        packed.echo = self.echo
-        packed.sender = self.sender
+        packed.pack(
+            echo=self.echo,
+            sender=self.sender,
+        )
+
+
+class CumulativeAck(Message):
+    """ Acknowledges several messages from the same peer at once, it's the
+    compact form of a sequence of `Ack`s.
+
+    Like `Ack` it's not signed, the echoes cannot be forged without knowing
+    the messages.
+    """
+    cmdid = messages.CUMULATIVEACK
+
+    def __init__(self, sender, echoes):
+        self.sender = sender
+        self.echoes = tuple(echoes)
+
+    @classmethod
+    def decode(cls, data):
+        sender, echoes = messages.unwrap_cumulative_ack(data)
+        cumulative_ack = cls(sender, echoes)
+        cumulative_ack._encoded = data  # pylint: disable=protected-access
+        return cumulative_ack
+
+    def encode(self):
+        if self._encoded is None:
+            self._encoded = messages.wrap_cumulative_ack(self.sender, self.echoes)
+        return super(CumulativeAck, self).encode()
 
 
 class Ping(SignedMessage):
@@ -172,13 +229,16 @@ class Ping(SignedMessage):
 
     @staticmethod
     def unpack(packed):
-        ping = Ping(packed.nonce)
-        ping.signature = packed.signature
+        values = packed.unpack()
+        ping = Ping(values.nonce)
+        ping.signature = values.signature
         return ping
 
     def pack(self, packed):
-        packed.nonce = self.nonce
-        packed.signature = self.signature
+        packed.pack(
+            nonce=self.nonce,
+            signature=self.signature,
+        )
 
 
 # class Rejected(SignedMessage):
@@ -220,13 +280,16 @@ class SecretRequest(SignedMessage):
 
     @staticmethod
     def unpack(packed):
-        secret_request = SecretRequest(packed.hashlock)
-        secret_request.signature = packed.signature
+        values = packed.unpack()
+        secret_request = SecretRequest(values.hashlock)
+        secret_request.signature = values.signature
         return secret_request
 
     def pack(self, packed):
-        packed.hashlock = self.hashlock
-        packed.signature = self.signature
+        packed.pack(
+            hashlock=self.hashlock,
+            signature=self.signature,
+        )
 
 
 class Secret(SignedMessage):
@@ -246,13 +309,16 @@ class Secret(SignedMessage):
 
     @staticmethod
     def unpack(packed):
-        secret = Secret(packed.secret)
-        secret.signature = packed.signature
+        values = packed.unpack()
+        secret = Secret(values.secret)
+        secret.signature = values.signature
         return secret
 
     def pack(self, packed):
-        packed.secret = self.secret
-        packed.signature = self.signature
+        packed.pack(
+            secret=self.secret,
+            signature=self.signature,
+        )
 
 
 class DirectTransfer(SignedMessage):
@@ -296,26 +362,29 @@ class DirectTransfer(SignedMessage):
 
     @staticmethod
     def unpack(packed):
+        values = packed.unpack()
         transfer = DirectTransfer(
-            packed.nonce,
-            packed.asset,
-            packed.balance,
-            packed.recipient,
-            packed.locksroot,
-            packed.secret,
+            values.nonce,
+            values.asset,
+            values.balance,
+            values.recipient,
+            values.locksroot,
+            values.secret,
         )
-        transfer.signature = packed.signature
+        transfer.signature = values.signature
 
         return transfer
 
     def pack(self, packed):
-        packed.nonce = self.nonce
-        packed.asset = self.asset
-        packed.balance = self.balance
-        packed.recipient = self.recipient
-        packed.locksroot = self.locksroot
-        packed.secret = self.secret
-        packed.signature = self.signature
+        packed.pack(
+            nonce=self.nonce,
+            asset=self.asset,
+            balance=self.balance,
+            recipient=self.recipient,
+            locksroot=self.locksroot,
+            secret=self.secret,
+            signature=self.signature,
+        )
 
 
 class Lock(MessageHashable):
@@ -349,9 +418,11 @@ class Lock(MessageHashable):
     def as_bytes(self):
         if self._asbytes is None:
             packed = messages.Lock(buffer_for(messages.Lock))
-            packed.amount = self.amount
-            packed.expiration = self.expiration
-            packed.hashlock = self.hashlock
+            packed.pack(
+                amount=self.amount,
+                expiration=self.expiration,
+                hashlock=self.hashlock,
+            )
 
             self._asbytes = packed.data
 
@@ -359,12 +430,12 @@ class Lock(MessageHashable):
 
     @classmethod
     def from_bytes(cls, serialized):
-        packed = messages.Lock(serialized)
+        values = messages.Lock(serialized).unpack()
 
         return cls(
-            packed.amount,
-            packed.expiration,
-            packed.hashlock,
+            values.amount,
+            values.expiration,
+            values.hashlock,
         )
 
 
@@ -423,36 +494,38 @@ class LockedTransfer(SignedMessage):
 
     @staticmethod
     def unpack(packed):
+        values = packed.unpack()
         lock = Lock(
-            packed.amount,
-            packed.expiration,
-            packed.hashlock,
+            values.amount,
+            values.expiration,
+            values.hashlock,
         )
 
         locked_transfer = LockedTransfer(
-            packed.nonce,
-            packed.asset,
-            packed.balance,
-            packed.recipient,
-            packed.locksroot,
+            values.nonce,
+            values.asset,
+            values.balance,
+            values.recipient,
+            values.locksroot,
             lock,
         )
-        locked_transfer.signature = packed.signature
+        locked_transfer.signature = values.signature
         return locked_transfer
 
     def pack(self, packed):
-        packed.nonce = self.nonce
-        packed.asset = self.asset
-        packed.balance = self.balance
-        packed.recipient = self.recipient
-        packed.locksroot = self.locksroot
-
         lock = self.lock
-        packed.amount = lock.amount
-        packed.expiration = lock.expiration
-        packed.hashlock = lock.hashlock
 
-        packed.signature = self.signature
+        packed.pack(
+            nonce=self.nonce,
+            asset=self.asset,
+            balance=self.balance,
+            recipient=self.recipient,
+            locksroot=self.locksroot,
+            amount=lock.amount,
+            expiration=lock.expiration,
+            hashlock=lock.hashlock,
+            signature=self.signature,
+        )
 
 
 class MediatedTransfer(LockedTransfer):
@@ -497,42 +570,44 @@ class MediatedTransfer(LockedTransfer):
 
     @staticmethod
     def unpack(packed):
+        values = packed.unpack()
         lock = Lock(
-            packed.amount,
-            packed.expiration,
-            packed.hashlock,
+            values.amount,
+            values.expiration,
+            values.hashlock,
         )
 
         mediated_transfer = MediatedTransfer(
-            packed.nonce,
-            packed.asset,
-            packed.balance,
-            packed.recipient,
-            packed.locksroot,
+            values.nonce,
+            values.asset,
+            values.balance,
+            values.recipient,
+            values.locksroot,
             lock,
-            packed.target,
-            packed.initiator,
-            packed.fee,
+            values.target,
+            values.initiator,
+            values.fee,
         )
-        mediated_transfer.signature = packed.signature
+        mediated_transfer.signature = values.signature
         return mediated_transfer
 
     def pack(self, packed):
-        packed.nonce = self.nonce
-        packed.asset = self.asset
-        packed.balance = self.balance
-        packed.recipient = self.recipient
-        packed.locksroot = self.locksroot
-        packed.target = self.target
-        packed.initiator = self.initiator
-        packed.fee = self.fee
-
         lock = self.lock
-        packed.amount = lock.amount
-        packed.expiration = lock.expiration
-        packed.hashlock = lock.hashlock
 
-        packed.signature = self.signature
+        packed.pack(
+            nonce=self.nonce,
+            asset=self.asset,
+            balance=self.balance,
+            recipient=self.recipient,
+            locksroot=self.locksroot,
+            target=self.target,
+            initiator=self.initiator,
+            fee=self.fee,
+            amount=lock.amount,
+            expiration=lock.expiration,
+            hashlock=lock.hashlock,
+            signature=self.signature,
+        )
 
 
 class CancelTransfer(LockedTransfer):
@@ -543,36 +618,38 @@ class CancelTransfer(LockedTransfer):
 
     @staticmethod
     def unpack(packed):
+        values = packed.unpack()
         lock = Lock(
-            packed.amount,
-            packed.expiration,
-            packed.hashlock,
+            values.amount,
+            values.expiration,
+            values.hashlock,
         )
 
         locked_transfer = CancelTransfer(
-            packed.nonce,
-            packed.asset,
-            packed.balance,
-            packed.recipient,
-            packed.locksroot,
+            values.nonce,
+            values.asset,
+            values.balance,
+            values.recipient,
+            values.locksroot,
             lock,
         )
-        locked_transfer.signature = packed.signature
+        locked_transfer.signature = values.signature
         return locked_transfer
 
     def pack(self, packed):
-        packed.nonce = self.nonce
-        packed.asset = self.asset
-        packed.balance = self.balance
-        packed.recipient = self.recipient
-        packed.locksroot = self.locksroot
-
         lock = self.lock
-        packed.amount = lock.amount
-        packed.expiration = lock.expiration
-        packed.hashlock = lock.hashlock
 
-        packed.signature = self.signature
+        packed.pack(
+            nonce=self.nonce,
+            asset=self.asset,
+            balance=self.balance,
+            recipient=self.recipient,
+            locksroot=self.locksroot,
+            amount=lock.amount,
+            expiration=lock.expiration,
+            hashlock=lock.hashlock,
+            signature=self.signature,
+        )
 
 
 class TransferTimeout(SignedMessage):
@@ -593,17 +670,20 @@ class TransferTimeout(SignedMessage):
 
     @staticmethod
     def unpack(packed):
+        values = packed.unpack()
         transfer_timeout = TransferTimeout(
-            packed.echo,
-            packed.hashlock,
+            values.echo,
+            values.hashlock,
         )
-        transfer_timeout.signature = packed.signature
+        transfer_timeout.signature = values.signature
         return transfer_timeout
 
     def pack(self, packed):
-        packed.echo = self.echo
-        packed.hashlock = self.hashlock
-        packed.signature = self.signature
+        packed.pack(
+            echo=self.echo,
+            hashlock=self.hashlock,
+            signature=self.signature,
+        )
 
 
 class ConfirmTransfer(SignedMessage):
@@ -616,19 +696,23 @@ class ConfirmTransfer(SignedMessage):
 
     @staticmethod
     def unpack(packed):
+        values = packed.unpack()
         confirm_transfer = ConfirmTransfer(
-            packed.hashlock,
+            values.hashlock,
         )
-        confirm_transfer.signature = packed.signature
+        confirm_transfer.signature = values.signature
         return confirm_transfer
 
     def pack(self, packed):
-        packed.hashlock = self.hashlock
-        packed.signature = self.signature
+        packed.pack(
+            hashlock=self.hashlock,
+            signature=self.signature,
+        )
 
 
 CMDID_TO_CLASS = {
     messages.ACK: Ack,
+    messages.CUMULATIVEACK: CumulativeAck,
     messages.PING: Ping,
     # REJECTED: Rejected,
     messages.SECRETREQUEST: SecretRequest,
@@ -645,5 +729,6 @@ CMDID_TO_CLASS = {
 
 
 def decode(data):
+    data = messages.as_view(data)
     klass = CMDID_TO_CLASS[data[0]]
     return klass.decode(data)
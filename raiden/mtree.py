@@ -1,17 +1,45 @@
-from utils import keccak
+from bisect import bisect_left, insort
+
+try:
+    from sha3 import keccak_256
+except ImportError:
+    from utils import keccak_256
 
 
 def hash_pair(s1, s2):
     if s1 > s2:
         s2, s1 = s1, s2
-    return keccak(s1 + s2)
+    return keccak_256(s1 + s2).digest()
+
+
+def keccak_pairs(buf, count):
+    """ Default backend for `merkleroot`, hash the first `count` 64 byte
+    blocks of the bytearray `buf` with `hash_pair` and write the digest of
+    the block `i` in place at `buf[i * 32:i * 32 + 32]`.
+
+    The digest of a block only overwrites blocks that were already hashed.
+    A backend receives a whole level at once, so an implementation that
+    hashes many blocks per call can be plugged in instead.
+    """
+    view = memoryview(buf)
+
+    for i in range(count):
+        start = i * 64
+        middle = start + 32
+        first = view[start:middle].tobytes()
+        second = view[middle:start + 64].tobytes()
+
+        if first > second:
+            view[i * 32:i * 32 + 32] = keccak_256(second + first).digest()
+        else:
+            view[i * 32:i * 32 + 32] = keccak_256(first + second).digest()
 
 
 class NoHash32Error(Exception):
     pass
 
 
-def merkleroot(lst, proof=[], first=True):
+def merkleroot_reference(lst, proof=None, first=True):
     """
     lst: list of hashes
     proof: empty or with the element for which a proof shall be built, proof will be in proof
@@ -20,6 +48,9 @@ def merkleroot(lst, proof=[], first=True):
     if on all of [element] + proof is recursively hash_pair applied one gets the root.
 
     returns: merkleroot
+
+    This is the straightforward recursive implementation, kept as the
+    reference for `merkleroot`.
     """
     if first:
         lst = build_lst(lst)
@@ -44,13 +75,59 @@ def merkleroot(lst, proof=[], first=True):
         if h == searching:
             proof.append(h)
     if len(out) > 1:
-        return merkleroot(out, proof, False)
+        return merkleroot_reference(out, proof, False)
     else:
         if searching:
             proof.pop()  # pop root
         return out[0]
 
 
+def merkleroot(lst, proof=None, hash_pairs=keccak_pairs):
+    """
+    lst: list of hashes
+    proof: empty or with the element for which a proof shall be built, proof will be in proof
+    hash_pairs: backend used to hash all the pairs of a level in place, see `keccak_pairs`
+
+    Iterative version of `merkleroot_reference` with the same results. The
+    leaves are copied once into a contiguous buffer, every level is hashed
+    with a single backend call in place at the front of the same buffer, only
+    the root and the proof are copied out of it.
+
+    returns: merkleroot
+    """
+    leaves = build_lst(lst)
+    if not leaves:
+        return ''
+
+    searching = proof.pop() if proof else None
+    if searching is not None:
+        idx = bisect_left(leaves, searching)
+        assert idx < len(leaves) and leaves[idx] == searching
+
+    buf = bytearray(b''.join(leaves))
+    count = len(leaves)
+
+    while count > 1:
+        pairs = count // 2
+
+        if searching is not None:
+            sibling = idx ^ 1
+            if sibling < count:
+                proof.append(bytes(buf[sibling * 32:sibling * 32 + 32]))
+            idx //= 2
+
+        hash_pairs(buf, pairs)
+
+        # the odd element is promoted to the next level, it's after the
+        # hashed blocks and was not overwritten
+        if count % 2:
+            buf[pairs * 32:pairs * 32 + 32] = buf[(count - 1) * 32:count * 32]
+
+        count = (count + 1) // 2
+
+    return bytes(buf[:32])
+
+
 def build_lst(lst):
     _lst = set()
     for e in lst:
@@ -76,3 +153,377 @@ def get_proof(lst, proof_for, root=None):
     if root:
         assert root == r
     return proof
+
+
+def check_multiproof(proof, root, elements, indexes, leaf_count):
+    """ Check a proof created by `MerkleTree.get_multiproof`.
+
+    Args:
+        proof (List[hash]): The sibling hashes, in the order they were emitted.
+        root (hash): The expected merkle root.
+        elements (List[hash]): The leaves that are being proven.
+        indexes (List[int]): The position of each leaf in the sorted leaves.
+        leaf_count (int): The number of leaves in the tree.
+    """
+    proof = list(proof)
+    nodes = dict(zip(indexes, elements))
+    length = leaf_count
+
+    while length > 1:
+        parents = dict()
+
+        for idx in sorted(nodes):
+            parent = idx // 2
+            if parent in parents:
+                continue
+
+            sibling = idx ^ 1
+            if sibling >= length:
+                parents[parent] = nodes[idx]
+            elif sibling in nodes:
+                parents[parent] = hash_pair(nodes[idx], nodes[sibling])
+            elif proof:
+                parents[parent] = hash_pair(nodes[idx], proof.pop(0))
+            else:
+                return False
+
+        nodes = parents
+        length = (length + 1) // 2
+
+    return not proof and nodes.get(0) == root
+
+
+class MerkleTree(object):
+    """ Merkle tree that keeps all of its internal nodes.
+
+    The leaves are kept sorted and unique, the tree produces the same root as
+    `merkleroot` over the same elements. On `add` and `remove` only the nodes
+    to the right of the changed leaf are rehashed, the left part of every
+    layer is reused.
+
+    The position of a leaf is its rank, which is what the peers and the
+    netting contract agree on, so a change at the leaf `k` of `n` shifts all
+    the leaves after it and costs about `n - k` hashes: O(log n) for the
+    last leaf, `n / 2` on average for a random hashlock and `n` for the
+    first one, against the `n - 1` of a `merkleroot`. See
+    `raiden/benchmark/speed_mtree.py`.
+    """
+
+    def __init__(self, lst=None):
+        self.layers = [build_lst(lst or [])]  #: layers[0] are the leaves, layers[-1] the root
+        self.version = 0  #: incremented on every change
+        self._proofs = dict()  #: element -> (index, siblings), the valid levels of the proofs
+        self._update(0)
+
+    def copy(self):
+        """ Return an independent tree with the same nodes, nothing is hashed. """
+        tree = MerkleTree()
+        tree.layers = [list(layer) for layer in self.layers]
+        return tree
+
+    def __contains__(self, element):
+        leaves = self.layers[0]
+        idx = bisect_left(leaves, element)
+        return idx < len(leaves) and leaves[idx] == element
+
+    def __len__(self):
+        return len(self.layers[0])
+
+    def __iter__(self):
+        return iter(self.layers[0])
+
+    @property
+    def leaves(self):
+        return self.layers[0]
+
+    @property
+    def root(self):
+        if not self.layers[0]:
+            return ''
+        return self.layers[-1][0]
+
+    def add(self, element):
+        """ Add `element` to the leaves, adding an existing element is a no-op. """
+        if len(element) != 32:
+            raise NoHash32Error()
+
+        leaves = self.layers[0]
+        idx = bisect_left(leaves, element)
+
+        if idx < len(leaves) and leaves[idx] == element:
+            return
+
+        leaves.insert(idx, element)
+        self._update(idx)
+
+    def remove(self, element):
+        """ Remove `element` from the leaves.
+
+        Raises:
+            ValueError: If `element` is not a leaf.
+        """
+        leaves = self.layers[0]
+        idx = bisect_left(leaves, element)
+
+        if idx == len(leaves) or leaves[idx] != element:
+            raise ValueError('element not in tree')
+
+        del leaves[idx]
+        self._update(idx)
+
+    def remove_many(self, elements):
+        """ Remove all of `elements` from the leaves rehashing the tree once.
+
+        Raises:
+            ValueError: If any of the elements is not a leaf.
+        """
+        elements = set(elements)
+        if not elements:
+            return
+
+        leaves = self.layers[0]
+        if any(element not in self for element in elements):
+            raise ValueError('element not in tree')
+
+        start = bisect_left(leaves, min(elements))
+        leaves[start:] = [
+            leaf
+            for leaf in leaves[start:]
+            if leaf not in elements
+        ]
+        self._update(start)
+
+    def get_proof(self, element):
+        """ Return the proof for `element`, the format is the same as `get_proof`. """
+        return self.get_proofs([element])[0]
+
+    def get_proofs(self, elements):
+        """ Return the proofs for all of `elements`.
+
+        Proofs are read from the stored layers without hashing. The siblings
+        of every level are cached, a change only drops the levels that read a
+        rehashed node and these are read again on the next call, see
+        `_invalidate_proofs`.
+
+        Raises:
+            ValueError: If any of the elements is not a leaf.
+        """
+        layers = self.layers
+        leaves = layers[0]
+        depth = len(layers) - 1
+        proofs = list()
+
+        for element in elements:
+            cached = self._proofs.get(element)
+
+            if cached is None:
+                idx = bisect_left(leaves, element)
+                if idx == len(leaves) or leaves[idx] != element:
+                    raise ValueError('element not in tree')
+
+                cached = self._proofs[element] = (idx, list())
+
+            idx, siblings = cached
+
+            # None stands for a level without sibling, the node was promoted
+            for level in range(len(siblings), depth):
+                layer = layers[level]
+                sibling = (idx >> level) ^ 1
+                siblings.append(layer[sibling] if sibling < len(layer) else None)
+
+            proofs.append(siblings)
+
+        # `check_proof` consumes the list, always return copies
+        return [
+            [node for node in levels if node is not None]
+            for levels in proofs
+        ]
+
+    def get_multiproof(self, elements):
+        """ Return a single proof for all of `elements`.
+
+        Siblings that are shared by the paths of multiple elements, or that
+        can be computed from the elements themselves, are included only once.
+
+        Returns:
+            Tuple[List[int], List[hash]]: The position of each element in the
+                sorted leaves and the sibling hashes, see `check_multiproof`.
+
+        Raises:
+            ValueError: If any of the elements is not a leaf.
+        """
+        leaves = self.layers[0]
+        indexes = list()
+
+        for element in elements:
+            idx = bisect_left(leaves, element)
+            if idx == len(leaves) or leaves[idx] != element:
+                raise ValueError('element not in tree')
+            indexes.append(idx)
+
+        proof = list()
+        known = sorted(set(indexes))
+
+        for layer in self.layers[:-1]:
+            known_set = set(known)
+
+            for idx in known:
+                sibling = idx ^ 1
+                if sibling < len(layer) and sibling not in known_set:
+                    proof.append(layer[sibling])
+
+            known = sorted(set(idx // 2 for idx in known))
+
+        return indexes, proof
+
+    def root_with(self, include=None, exclude=None):
+        """ Return the root the tree would have with `include` added and
+        `exclude` removed, the tree itself is not changed.
+
+        Only the nodes to the right of the first changed leaf are hashed, the
+        unchanged prefix of each layer is read from the current tree.
+
+        Raises:
+            ValueError: If `exclude` is not a leaf.
+        """
+        changed = self._changed_leaves(include, exclude)
+
+        if changed is None:
+            return self.root
+
+        start, suffix = changed
+        return self._root_with_suffix(start, suffix)
+
+    def _changed_leaves(self, include, exclude):
+        """ Return `(start, suffix)` such that the leaves with `include` and
+        without `exclude` are `leaves[:start] + suffix`, or None if these are
+        the current leaves.
+        """
+        leaves = self.layers[0]
+        start = len(leaves)
+
+        include_idx = exclude_idx = None
+
+        if include:
+            if len(include) != 32:
+                raise NoHash32Error()
+
+            include_idx = bisect_left(leaves, include)
+            if include_idx < len(leaves) and leaves[include_idx] == include:
+                include_idx = None
+            else:
+                start = include_idx
+
+        if exclude:
+            exclude_idx = bisect_left(leaves, exclude)
+            if exclude_idx == len(leaves) or leaves[exclude_idx] != exclude:
+                raise ValueError('element not in tree')
+            start = min(start, exclude_idx)
+
+        if include_idx is None and exclude_idx is None:
+            return None
+
+        suffix = leaves[start:]
+
+        if exclude_idx is not None:
+            del suffix[exclude_idx - start]
+
+        if include_idx is not None:
+            insort(suffix, include)
+
+        return start, suffix
+
+    def _root_with_suffix(self, start, suffix):
+        """ Return the root of the leaves `leaves[:start] + suffix`, hashing
+        only the suffix of each layer.
+        """
+        layers = self.layers
+        depth = 0
+        layer = layers[0]
+        length = start + len(suffix)
+
+        while length > 1:
+            parent_start = start // 2
+            parent_suffix = []
+
+            for i in range(parent_start * 2, length, 2):
+                first = layer[i] if i < start else suffix[i - start]
+
+                if i + 1 < length:
+                    second = layer[i + 1] if i + 1 < start else suffix[i + 1 - start]
+                    parent_suffix.append(hash_pair(first, second))
+                else:
+                    parent_suffix.append(first)
+
+            depth += 1
+            layer = layers[depth] if depth < len(layers) else []
+            start = parent_start
+            suffix = parent_suffix
+            length = start + len(suffix)
+
+        if length == 0:
+            return ''
+
+        if start:
+            return layer[0]
+
+        return suffix[0]
+
+    def _update(self, start):
+        """ Rehash the nodes that depend on the leaves from `start` onwards,
+        that is the suffix of every layer from `start >> depth`.
+        """
+        self.version += 1
+        layers = self.layers
+        first_changed = start
+
+        depth = 0
+        while len(layers[depth]) > 1:
+            layer = layers[depth]
+
+            if depth + 1 == len(layers):
+                layers.append([])
+            parent = layers[depth + 1]
+
+            start //= 2
+            del parent[start:]
+
+            for i in range(start * 2, len(layer) - 1, 2):
+                parent.append(hash_pair(layer[i], layer[i + 1]))
+
+            if len(layer) % 2:
+                parent.append(layer[-1])
+
+            depth += 1
+
+        del layers[depth + 1:]
+
+        self._invalidate_proofs(first_changed)
+
+    def _invalidate_proofs(self, start):
+        """ Drop the cached proof levels that read a node rehashed by
+        `_update(start)`.
+
+        The leaves from `start` onwards moved, their proofs are dropped. For
+        the other leaves the sibling read on a level is stale if it is in the
+        rehashed suffix of that layer, the proof is cut at the first such
+        level, the lower levels are still valid.
+        """
+        depth = len(self.layers) - 1
+        moved = list()
+
+        for element, (idx, siblings) in self._proofs.iteritems():
+            if idx >= start:
+                moved.append(element)
+                continue
+
+            valid = min(len(siblings), depth)
+            for level in range(valid):
+                if (idx >> level) ^ 1 >= start >> level:
+                    valid = level
+                    break
+
+            del siblings[valid:]
+
+        for element in moved:
+            del self._proofs[element]
@@ -27,6 +27,11 @@ class BlockChainService(object):
         self.host_port = host_port
         self.registry_address = registry_address
 
+        # the callbacks for the channel events, see BlockChainServiceMock
+        self.channelnew_callbacks = list()
+        self.deposit_callbacks = list()
+        self.close_callbacks = list()
+
     # pylint: disable=no-self-use,invalid-name,too-many-arguments
     def next_block(self):
         raise NotImplementedError()
@@ -98,6 +103,19 @@ class BlockChainServiceMock(object):
         self.asset_hashchannel = dict()
         self.asset_address = dict()
 
+        #: callbacks called with (asset_address, netting_contract_address,
+        #: address1, address2) when a netting contract is created
+        self.channelnew_callbacks = list()
+
+        #: callbacks called with (asset_address, netting_contract_address,
+        #: participant_address, deposit) when a participant deposits, the
+        #: deposit is the participant's total
+        self.deposit_callbacks = list()
+
+        #: callbacks called with (asset_address, netting_contract_address,
+        #: address1, address2) when a netting contract is closed
+        self.close_callbacks = list()
+
     def next_block(self):
         """ Equivalent to the mining of a new block.
 
@@ -147,6 +165,10 @@ class BlockChainServiceMock(object):
 
         channel = NettingChannelContract(asset_address, netcontract_address, peer1, peer2)
         hash_channel[netcontract_address] = channel
+
+        for callback in self.channelnew_callbacks:
+            callback(asset_address, netcontract_address, peer1, peer2)
+
         return netcontract_address
 
     @property
@@ -215,6 +237,10 @@ class BlockChainServiceMock(object):
 
         contract.deposit(our_address, amount, self.block_number)
 
+        deposit = contract.participants[our_address]['deposit']
+        for callback in self.deposit_callbacks:
+            callback(asset_address, netting_contract_address, our_address, deposit)
+
     def partner(self, asset_address, netting_contract_address, our_address):
         hash_channel = self.asset_hashchannel[asset_address]
         contract = hash_channel[netting_contract_address]
@@ -257,6 +283,10 @@ class BlockChainServiceMock(object):
                 None,
             )
 
+        address1, address2 = contract.participants.keys()
+        for callback in self.close_callbacks:
+            callback(asset_address, netting_contract_address, address1, address2)
+
     def settle(self, asset_address, netting_contract_address):
         hash_channel = self.asset_hashchannel[asset_address]
         contract = hash_channel[netting_contract_address]
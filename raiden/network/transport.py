@@ -3,15 +3,38 @@
 This module contains the classes responsable to implement the network
 communication.
 """
+import errno
+import os
+import socket
+import struct
+import tempfile
+
 import gevent
 from gevent.server import DatagramServer
+from gevent.socket import wait_read, wait_write
 from ethereum import slogging
 
+from raiden.encoding.messages import (
+    ACK,
+    CUMULATIVEACK,
+    ENVELOPE,
+    SECRET,
+    SECRETREQUEST,
+    Ack,
+    Secret,
+    SecretRequest,
+    unwrap_cumulative_ack,
+    unwrap_envelope,
+)
+from raiden.raiden_protocol import DuplicateCache
 from raiden.raiden_service import RaidenProtocol
-from raiden.utils import pex, sha3
+from raiden.utils import keccak, pex, sha3, shard_for
 
 log = slogging.get_logger('raiden.network.transport')  # pylint: disable=invalid-name
 
+# not exposed by the socket module of python 2, this is the value for linux
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
 
 class UDPTransport(object):
     """ Node communication using the UDP protocol. """
@@ -46,6 +69,387 @@ class UDPTransport(object):
         assert isinstance(proto, RaidenProtocol)
         self.protocol = proto
 
+    def stop(self):
+        self.server.stop()
+
+
+class BatchedUDPTransport(object):
+    """ Node communication using the UDP protocol, reading and writing the
+    datagrams in batches.
+
+    A single greenlet drains the socket every time it becomes readable and
+    hands the whole batch to the protocol as memoryviews, the datagrams are
+    not copied on the way to the decoder. The datagrams sent during one
+    iteration of the event loop are queued and written together.
+    """
+
+    batch_size = 64
+    buffer_size = RaidenProtocol.max_message_size
+
+    def __init__(self, host, port, protocol=None):
+        self.protocol = protocol
+
+        self.socket = self.create_socket(host, port)
+        self.host, self.port = self.socket.getsockname()
+
+        self.send_queue = list()
+
+        self.receiver = gevent.spawn(
+            self._receive_batches,
+            self.socket,
+            self.handle_batch,
+            self.buffer_size,
+        )
+
+    def create_socket(self, host, port):  # pylint: disable=no-self-use
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((host, port))
+        sock.setblocking(False)
+        return sock
+
+    def _receive_batches(self, sock, handle_batch, buffer_size):
+        fileno = sock.fileno()
+
+        # the datagrams are handed over as views of the buffer and decoded in
+        # place, the decoded messages keep the views, so the buffer is reused
+        # only if nothing was received into it
+        buffer_ = bytearray(buffer_size)
+
+        while True:
+            wait_read(fileno)
+
+            batch = list()
+            while len(batch) < self.batch_size:
+                try:
+                    nbytes, address = sock.recvfrom_into(buffer_)
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+
+                # the datagram did not fit in the buffer and was truncated
+                if nbytes == buffer_size:
+                    log.error('dropping datagram bigger than {} bytes'.format(buffer_size))
+                    continue
+
+                batch.append((memoryview(buffer_)[:nbytes], address))
+                buffer_ = bytearray(buffer_size)
+
+            if batch:
+                handle_batch(batch)
+
+    def handle_batch(self, batch):
+        gevent.spawn(self.receive_batch, batch)
+
+    def receive_batch(self, batch):
+        self.protocol.receive_batch([data for data, _ in batch])
+
+        # enable debugging using the DummyNetwork callbacks
+        for data, host_port in batch:
+            DummyTransport.track_recv(self.protocol.raiden, host_port, data)
+
+    def send(self, sender, host_port, bytes_):
+        """ Queue `bytes_` to be sent to `host_port`.
+
+        Args:
+            sender (address): The address of the running node.
+            host_port (Tuple[(str, int)]): Tuple with the host name and port number.
+            bytes_ (bytes): The bytes that are going to be sent throught the wire.
+        """
+        self.send_queue.append((bytes_, host_port))
+
+        if len(self.send_queue) == 1:
+            gevent.spawn(self._send_batch)
+
+        # enable debugging using the DummyNetwork callbacks
+        DummyTransport.network.track_send(sender, host_port, bytes_)
+
+    def _send_batch(self):
+        queue, self.send_queue = self.send_queue, list()
+
+        for bytes_, host_port in queue:
+            while True:
+                try:
+                    self.socket.sendto(bytes_, host_port)
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        wait_write(self.socket.fileno())
+                        continue
+
+                    # only this datagram is lost, the peer will retry the message
+                    log.error('could not send to {}:{}: {}'.format(host_port[0], host_port[1], e))
+
+                break
+
+    def register(self, proto, host, port):  # pylint: disable=unused-argument
+        assert isinstance(proto, RaidenProtocol)
+        self.protocol = proto
+
+    def stop(self):
+        self.receiver.kill()
+        self.socket.close()
+
+
+def routing_keys(data):
+    """ Return the keys used to find the shard that handles the message
+    `data`: the hashes echoed by the Acks and the hashlock of the Secrets and
+    SecretRequests.
+    """
+    cmdid = data[:1]
+
+    try:
+        if cmdid == ACK:
+            return [memoryview(Ack(data).echo).tobytes()]
+
+        if cmdid == CUMULATIVEACK:
+            return unwrap_cumulative_ack(data)[1]
+
+        if cmdid == SECRETREQUEST:
+            return [memoryview(SecretRequest(data).hashlock).tobytes()]
+
+        if cmdid == SECRET:
+            return [sha3(memoryview(Secret(data).secret).tobytes())]
+    except ValueError:
+        # the protocol of the peer's owner rejects it
+        pass
+
+    return []
+
+
+class ShardedUDPTransport(BatchedUDPTransport):
+    """ Transport for one of the `shards` processes that serve the same node.
+
+    All the processes bind the node's port with SO_REUSEPORT, the kernel
+    spreads the datagrams among them. Each process owns the peers that
+    `shard_for` assigns to it, it runs only the channels with these peers and
+    forwards the datagrams from and to the other peers to their owner through
+    a unix socket, so the state of a channel is only changed by one process.
+
+    The envelopes are split and each message is routed on its own. An Ack, a
+    SecretRequest or a Secret can refer to a message or a transfer of another
+    process, the owner of the peer keeps the claims of the other processes,
+    see `claim`, and forwards these messages to the claimant only.
+    """
+
+    # the forwarded datagrams are prefixed with their kind, the shard that
+    # forwarded them and the address of the peer that sent them or that
+    # should receive them:
+    #
+    #   [kind][shard][port (2 bytes)][host length][host]
+    forward_header = struct.Struct('>BBHB')
+    FORWARD_RECEIVED = 0  # from a peer of the shard, can be claimed by another
+    FORWARD_SEND = 1
+    FORWARD_REQUEST = 2
+    FORWARD_REPLY = 3
+    FORWARD_CLAIM = 4
+    FORWARD_CLAIMED = 5  # from a peer of the forwarding shard, claimed by this one
+
+    # the claims are kept for the retries of the messages and the duration of
+    # the transfers
+    claims_size = 100000
+    claims_ttl = 600.
+
+    def __init__(self, host, port, protocol=None, shard=0, shards=1, forward_dir=None):
+        if not 0 <= shard < shards:
+            raise ValueError('shard must be in the range [0, {})'.format(shards))
+
+        self.shard = shard
+        self.shards = shards
+        self.shard_cache = dict()  # host_port: shard
+
+        #: message hash or hashlock -> shard that handles the messages of the
+        #: peers of this shard that refer to it
+        self.claims = DuplicateCache(self.claims_size, self.claims_ttl)
+
+        #: callbacks called with the shard and the data of the requests and
+        #: replies forwarded by the other shards, see `forward_request`
+        self.request_callbacks = list()
+        self.reply_callbacks = list()
+
+        forward_dir = forward_dir or tempfile.gettempdir()
+        self.forward_paths = [
+            os.path.join(forward_dir, 'raiden-{}-{}-{}.sock'.format(host, port, index))
+            for index in range(shards)
+        ]
+
+        super(ShardedUDPTransport, self).__init__(host, port, protocol)
+
+        path = self.forward_paths[shard]
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self.forward_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.forward_socket.bind(path)
+        self.forward_socket.setblocking(False)
+
+        # room for a whole datagram and the longest prefix
+        forward_buffer_size = self.buffer_size + self.forward_header.size + 255
+
+        self.forwarder = gevent.spawn(
+            self._receive_batches,
+            self.forward_socket,
+            self.handle_forwarded_batch,
+            forward_buffer_size,
+        )
+
+    def create_socket(self, host, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        sock.setblocking(False)
+        return sock
+
+    def get_shard(self, host_port):
+        shard = self.shard_cache.get(host_port)
+
+        if shard is None:
+            shard = self.shard_cache[host_port] = shard_for(host_port, self.shards)
+
+        return shard
+
+    def handle_batch(self, batch):
+        owned = list()
+
+        for datagram, host_port in batch:
+            for data in self.split(datagram, host_port):
+                shard = self.get_shard(host_port)
+
+                if shard == self.shard:
+                    self.route(data, host_port, owned)
+                else:
+                    prefixed = self.prefix(self.FORWARD_RECEIVED, host_port) + data.tobytes()
+                    self.forward(shard, prefixed)
+
+        if owned:
+            super(ShardedUDPTransport, self).handle_batch(owned)
+
+    def route(self, data, host_port, owned):
+        """ Append the message `data` from a peer of this shard to `owned`,
+        unless it was claimed by other shards, then forward it to them.
+        """
+        # the echoes of a cumulative ack can be claimed by several shards
+        shards = set(self.claims.get(key, self.shard) for key in routing_keys(data))
+
+        for shard in shards or [self.shard]:
+            if shard == self.shard:
+                owned.append((data, host_port))
+            else:
+                prefixed = self.prefix(self.FORWARD_CLAIMED, host_port) + data.tobytes()
+                self.forward(shard, prefixed)
+
+    @staticmethod
+    def split(datagram, host_port):
+        """ Return the messages in `datagram`, it can be an envelope. """
+        if datagram[:1] != ENVELOPE:
+            return [datagram]
+
+        try:
+            return unwrap_envelope(datagram)
+        except ValueError as e:
+            log.error('dropping envelope from {}:{}: {}'.format(host_port[0], host_port[1], e))
+            return []
+
+    def send(self, sender, host_port, bytes_):
+        """ Send `bytes_` through the process that owns `host_port`. """
+        shard = self.get_shard(host_port)
+
+        if shard == self.shard:
+            super(ShardedUDPTransport, self).send(sender, host_port, bytes_)
+        else:
+            self.forward(shard, self.prefix(self.FORWARD_SEND, host_port) + bytes_)
+
+            # enable debugging using the DummyNetwork callbacks
+            DummyTransport.network.track_send(sender, host_port, bytes_)
+
+    def claim(self, host_port, key):
+        """ Have the messages from `host_port` that refer to `key`, a
+        hashlock, handled by this shard.
+
+        The messages sent through another shard are claimed with their hash
+        and their hashlock by that shard, this is needed for the messages the
+        peer sends before being sent anything, e.g. the SecretRequest of the
+        target of a transfer.
+        """
+        shard = self.get_shard(host_port)
+
+        if shard != self.shard:
+            self.forward(shard, self.prefix(self.FORWARD_CLAIM, host_port) + key)
+
+    def forward_request(self, shard, data):
+        """ Hand `data` to the `request_callbacks` of `shard`. """
+        self.forward(shard, self.prefix(self.FORWARD_REQUEST, ('', 0)) + data)
+
+    def forward_reply(self, shard, data):
+        """ Hand `data` to the `reply_callbacks` of `shard`. """
+        self.forward(shard, self.prefix(self.FORWARD_REPLY, ('', 0)) + data)
+
+    def prefix(self, kind, host_port):
+        host, port = host_port
+        host = host.encode('idna')
+        return self.forward_header.pack(kind, self.shard, port, len(host)) + host
+
+    def forward(self, shard, data):
+        try:
+            self.forward_socket.sendto(data, self.forward_paths[shard])
+        except socket.error as e:
+            # the process is not running or is not keeping up, the peer will
+            # retry the message
+            log.error('could not forward to shard {}: {}'.format(shard, e))
+
+    def handle_forwarded_batch(self, batch):
+        header_size = self.forward_header.size
+        owned = list()
+
+        for data, _ in batch:
+            kind, shard, port, host_length = self.forward_header.unpack(data[:header_size])
+            start = header_size + host_length
+            host_port = (data[header_size:start].tobytes(), port)
+            payload = data[start:]
+
+            if kind == self.FORWARD_RECEIVED:
+                self.route(payload, host_port, owned)
+            elif kind == self.FORWARD_CLAIMED:
+                owned.append((payload, host_port))
+            elif kind == self.FORWARD_SEND:
+                self.forward_send(shard, payload, host_port)
+            elif kind == self.FORWARD_CLAIM:
+                self.claims[payload.tobytes()] = shard
+            else:
+                if kind == self.FORWARD_REQUEST:
+                    callbacks = self.request_callbacks
+                else:
+                    callbacks = self.reply_callbacks
+
+                for callback in callbacks:
+                    gevent.spawn(callback, shard, payload.tobytes())
+
+        if owned:
+            super(ShardedUDPTransport, self).handle_batch(owned)
+
+    def forward_send(self, shard, datagram, host_port):
+        """ Send `datagram` for `shard`, the Acks and the Secrets for its
+        messages are forwarded to it.
+        """
+        for data in self.split(datagram, host_port):
+            if data[:1] not in (ACK, CUMULATIVEACK):
+                self.claims[keccak(data)] = shard
+
+                for key in routing_keys(data):
+                    self.claims[key] = shard
+
+        self.send_queue.append((datagram, host_port))
+        if len(self.send_queue) == 1:
+            gevent.spawn(self._send_batch)
+
+    def stop(self):
+        super(ShardedUDPTransport, self).stop()
+        self.forwarder.kill()
+        self.forward_socket.close()
+
+        path = self.forward_paths[self.shard]
+        if os.path.exists(path):
+            os.unlink(path)
+
 
 class DummyNetwork(object):
     """ Store global state for an in process network, this won't use a real
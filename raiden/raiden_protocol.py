@@ -1,13 +1,177 @@
 # -*- coding: utf8 -*-
-import gevent
+import heapq
+import time
 
+import gevent
+from gevent.event import AsyncResult, Event
 from ethereum import slogging
 
 from raiden import messages
-from raiden.utils import isaddress, sha3, pex
-from raiden.messages import Ack, Secret, BaseError
+from raiden.encoding.messages import (
+    ACK,
+    CUMULATIVEACK,
+    ENVELOPE,
+    ENVELOPE_HEADER,
+    as_view,
+    envelope_length,
+    unwrap_envelope,
+    wrap_envelope,
+)
+from raiden.lazylog import Hex, LazyLogger
+from raiden.utils import isaddress, keccak, pex
+from raiden.messages import Ack, CumulativeAck, Secret, BaseError
 
 log = slogging.get_logger(__name__)  # pylint: disable=invalid-name
+lazylog = LazyLogger(log)  # pylint: disable=invalid-name
+
+
+class PendingMessage(object):
+    """ A message waiting for it's Ack. """
+    __slots__ = (
+        'receiver_address',
+        'host_port',
+        'msg',
+        'data',
+        'tries',
+        'sent_at',
+        'async_result',
+    )
+
+    def __init__(self, receiver_address, host_port, msg, data, tries):
+        self.receiver_address = receiver_address
+        self.host_port = host_port
+        self.msg = msg
+        self.data = data
+        self.tries = tries  #: number of transmissions left
+        self.sent_at = None  #: time of the last transmission
+        self.async_result = AsyncResult()
+
+
+class RoundTripTime(object):
+    """ Round trip time estimation and retransmission timeout for a single
+    peer, following RFC 6298.
+
+    Args:
+        initial_rto (float): The timeout used until the first sample.
+        min_rto (float): Lower bound for the computed timeout.
+        max_rto (float): Upper bound for the timeout, including the backoff.
+    """
+    alpha = 1. / 8
+    beta = 1. / 4
+    k = 4
+    granularity = 0.001  #: clock granularity in seconds
+
+    def __init__(self, initial_rto, min_rto, max_rto):
+        self.srtt = None  #: smoothed round trip time
+        self.rttvar = None  #: round trip time variation
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+
+    def update(self, sample):
+        """ Add a new round trip time measurement. """
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2.
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - sample)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * sample
+
+        rto = self.srtt + max(self.granularity, self.k * self.rttvar)
+        self.rto = min(max(rto, self.min_rto), self.max_rto)
+
+    def backoff(self, retransmissions):
+        """ Returns the timeout for a message that was already retransmitted
+        `retransmissions` times, doubling it for every retransmission.
+        """
+        return min(self.rto * 2 ** retransmissions, self.max_rto)
+
+
+class DuplicateCache(object):
+    """ Bounded cache of the Acks sent, used to answer retransmissions of
+    messages that were already handled.
+
+    The entries are kept in two generations, once the current generation
+    holds half of `size` entries or is `ttl / 2` seconds old it becomes the
+    previous one and the old previous generation is evicted. Every entry is
+    kept for at least `ttl / 2` seconds, unless `size / 2` newer entries are
+    added, and for at most `ttl` seconds.
+
+    An entry younger than `min_age` seconds is never evicted, if `size / 2`
+    entries are added faster than that the current generation grows past
+    the bound instead.
+
+    Args:
+        size (int): Bound for the number of entries, see `min_age`.
+        ttl (float): Upper bound for the age of the entries, in seconds.
+        min_age (float): Lower bound for the age of the evicted entries, at
+            most `ttl / 2`.
+    """
+
+    def __init__(self, size, ttl, min_age=0):
+        if size < 2:
+            raise ValueError('size must be at least 2')
+
+        if min_age > ttl / 2.:
+            raise ValueError('min_age must be at most ttl / 2')
+
+        self.size = size
+        self.ttl = ttl
+        self.min_age = min_age
+
+        self.current = dict()
+        self.previous = dict()
+        self.rotated_at = time.time()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+    def __contains__(self, key):
+        self.expire()
+        return key in self.current or key in self.previous
+
+    def get(self, key, default=None):
+        self.expire()
+
+        value = self.current.get(key, self.previous.get(key, default))
+        if value is default:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return value
+
+    def __setitem__(self, key, value):
+        self.expire()
+
+        # the previous generation is as old as the last rotation
+        full = len(self.current) >= self.size // 2
+        if full and time.time() - self.rotated_at >= self.min_age:
+            self.rotate()
+
+        self.previous.pop(key, None)
+        self.current[key] = value
+
+    def rotate(self):
+        self.evictions += len(self.previous)
+        self.previous = self.current
+        self.current = dict()
+        self.rotated_at = time.time()
+
+    def expire(self):
+        """ Drop the generations that are older than the ttl. """
+        elapsed = time.time() - self.rotated_at
+
+        if elapsed >= self.ttl:
+            # both generations are too old
+            self.rotate()
+            self.rotate()
+        elif elapsed >= self.ttl / 2.:
+            self.rotate()
 
 
 class RaidenProtocol(object):
@@ -16,98 +180,392 @@ class RaidenProtocol(object):
     each message sent or received is stored by hash
     if message is received twice, resent previous answer
     if there is no response to a message, message gets repeated max N times
+
+    All the retransmissions are driven by a single greenlet, the pending
+    messages are kept in a heap ordered by the time of the next try.
+
+    The interval between tries is adapted to each peer from the time it takes
+    for the Acks to arrive, `try_interval` is used until the first Ack.
     """
 
     try_interval = 1.
+    min_try_interval = 0.1
+    max_try_interval = 60.
     max_tries = 5
     max_message_size = 1200
     repeat_messages = False  # default for testing, w/o packet loss
 
+    # when set, the messages for the same host are held for up to
+    # `batch_delay` seconds and sent together in one envelope
+    batch_delay = None
+
+    # when set, the Acks for the same host are held for up to `ack_delay`
+    # seconds and merged into a CumulativeAck, or sent along the next message
+    # to the host. It needs to be shorter than `min_try_interval`.
+    ack_delay = None
+    max_cumulative_acks = 32
+
+    # the Acks need to be kept for longer than the peers retry a message,
+    # `max_acks` is exceeded instead of evicting an Ack younger than that
+    max_acks = 10000
+    ack_ttl = 4 * max_tries * max_try_interval
+
     def __init__(self, transport, discovery, raiden):
         self.transport = transport
         self.discovery = discovery
         self.raiden = raiden
 
-        self.tries = dict()  # msg hash: count_tries
-        self.sent_acks = dict()  # msghash: Ack
+        self.pending = dict()  # msghash: PendingMessage
+        self.sent_acks = DuplicateCache(  # msghash: (receiver_address, Ack)
+            self.max_acks,
+            self.ack_ttl,
+            min_age=self.max_tries * self.max_try_interval,
+        )
+        self.round_trips = dict()  # address: RoundTripTime
+
+        # heap of (time of the next try, msghash), entries for acked messages
+        # are removed lazily when they are popped
+        self.retry_queue = list()
+        self.retry_wakeup = Event()
+        self.retry_greenlet = None
+
+        self.send_queues = dict()  # host_port: [encoded messages]
+        self.send_timers = dict()  # host_port: greenlet that flushes the queue
+        self.ack_queues = dict()  # host_port: [echoes]
+        self.ack_timers = dict()  # host_port: greenlet that flushes the Acks
 
     def send(self, receiver_address, msg):
+        """ Send `msg` to `receiver_address` and keep retrying until it is
+        acknowledged or `max_tries` is exhausted.
+
+        Returns:
+            AsyncResult: Set to True once the message is acknowledged, fails
+                with an exception if the receiver does not reply.
+        """
         assert isaddress(receiver_address)
         assert not isinstance(msg, (Ack, BaseError)), msg
 
+        msghash = msg.hash
+
+        # the same message is already on it's way
+        if msghash in self.pending:
+            return self.pending[msghash].async_result
+
         host_port = self.discovery.get(receiver_address)
         data = msg.encode()
-        msghash = sha3(data)
-        self.tries[msghash] = self.max_tries
 
-        log.info('SENDING {} > {} : [{}] {}'.format(
-            pex(self.raiden.address),
-            pex(receiver_address),
-            pex(msghash),
+        lazylog.info(
+            'SENDING %s > %s : [%s] %s',
+            Hex(self.raiden.address),
+            Hex(receiver_address),
+            Hex(msghash),
             msg,
-        ))
+            category='send',
+        )
 
         assert len(data) < self.max_message_size
 
-        def repeater():
-            while self.tries.get(msghash, 0) > 0:
-                if not self.repeat_messages and self.tries[msghash] < self.max_tries:
-                    raise Exception('DEACTIVATED MSG resents {} {}'.format(
-                        pex(receiver_address),
-                        msg,
-                    ))
+        pending = PendingMessage(receiver_address, host_port, msg, data, self.max_tries)
+        self.pending[msghash] = pending
+
+        try:
+            self.transmit(msghash, pending)
+        except Exception:
+            del self.pending[msghash]
+            raise
+
+        return pending.async_result
+
+    def get_round_trip(self, receiver_address):
+        """ Returns the round trip time estimation for `receiver_address`. """
+        round_trip = self.round_trips.get(receiver_address)
+
+        if round_trip is None:
+            round_trip = RoundTripTime(
+                self.try_interval,
+                self.min_try_interval,
+                self.max_try_interval,
+            )
+            self.round_trips[receiver_address] = round_trip
+
+        return round_trip
 
-                self.tries[msghash] -= 1
-                self.transport.send(self.raiden, host_port, data)
-                gevent.sleep(self.try_interval)
+    def transmit(self, msghash, pending):
+        """ Send the message and schedule it's next try. """
+        pending.tries -= 1
+        pending.sent_at = time.time()
 
-            # Each sent msg must be acked. When msg is acked its hash is removed from self.tries
-            if msghash in self.tries:
+        # piggy-back the delayed Acks for the same host
+        ack_data = self.pop_acks(pending.host_port)
+        envelope_size = len(ENVELOPE_HEADER) + 2 * envelope_length.size
+        if ack_data is None:
+            self.send_raw(pending.host_port, pending.data)
+        elif envelope_size + len(ack_data) + len(pending.data) < self.max_message_size:
+            self.send_raw(pending.host_port, wrap_envelope([ack_data, pending.data]))
+        else:
+            self.send_raw(pending.host_port, ack_data)
+            self.send_raw(pending.host_port, pending.data)
+
+        retransmissions = self.max_tries - pending.tries - 1
+        round_trip = self.get_round_trip(pending.receiver_address)
+        deadline = pending.sent_at + round_trip.backoff(retransmissions)
+        if not self.retry_queue or deadline < self.retry_queue[0][0]:
+            self.retry_wakeup.set()
+        heapq.heappush(self.retry_queue, (deadline, msghash))
+
+        if self.retry_greenlet is None:
+            self.retry_greenlet = gevent.spawn(self._run_retries)
+
+    def _run_retries(self):
+        retry_queue = self.retry_queue
+
+        while True:
+            if not retry_queue:
+                self.retry_wakeup.wait()
+                self.retry_wakeup.clear()
+                continue
+
+            deadline, msghash = retry_queue[0]
+            timeout = deadline - time.time()
+
+            if timeout > 0:
+                self.retry_wakeup.wait(timeout)
+                self.retry_wakeup.clear()
+                continue
+
+            heapq.heappop(retry_queue)
+            pending = self.pending.get(msghash)
+
+            # the message was acknowledged in the meantime
+            if pending is None:
+                continue
+
+            if not self.repeat_messages:
+                self.fail(msghash, Exception('DEACTIVATED MSG resents {} {}'.format(
+                    pex(pending.receiver_address),
+                    pending.msg,
+                )))
+            elif pending.tries > 0:
+                try:
+                    self.transmit(msghash, pending)
+                except Exception as e:  # pylint: disable=broad-except
+                    # don't let a failing transport stop the other retries
+                    self.fail(msghash, e)
+            else:
                 # FIXME: suspend node + recover from the failure
-                raise RuntimeError('Node does not reply')
+                self.fail(msghash, RuntimeError('Node does not reply'))
+
+    def fail(self, msghash, exception):
+        """ Give up on the message `msghash`. """
+        pending = self.pending.pop(msghash)
+
+        log.error('MESSAGE FAILED {} > {} : [{}] {}'.format(
+            pex(self.raiden.address),
+            pex(pending.receiver_address),
+            pex(msghash),
+            exception,
+        ))
 
-        return gevent.spawn(repeater)
+        pending.async_result.set_exception(exception)
 
     def send_ack(self, receiver_address, msg):
         assert isinstance(msg, (Ack, BaseError))
         assert isaddress(receiver_address)
 
         host_port = self.discovery.get(receiver_address)
+
+        if self.ack_delay and isinstance(msg, Ack):
+            lazylog.info(
+                'DELAYING ACK %s > %s : [echo=%s]',
+                Hex(self.raiden.address),
+                Hex(receiver_address),
+                Hex(msg.echo),
+                category='ack',
+            )
+
+            self.queue_ack(host_port, msg.echo)
+            self.sent_acks[msg.echo] = (receiver_address, msg)
+            return
+
         data = msg.encode()
-        msghash = sha3(data)
+        msghash = msg.hash
 
-        log.info('SENDING ACK {} > {} : [{}] [echo={}] {}'.format(
-            pex(self.raiden.address),
-            pex(receiver_address),
-            pex(msghash),
-            pex(msg.echo),
+        lazylog.info(
+            'SENDING ACK %s > %s : [%s] [echo=%s] %s',
+            Hex(self.raiden.address),
+            Hex(receiver_address),
+            Hex(msghash),
+            Hex(msg.echo),
             msg,
-        ))
+            category='ack',
+        )
 
-        self.transport.send(self.raiden, host_port, msg.encode())
+        self.send_raw(host_port, data)
         self.sent_acks[msg.echo] = (receiver_address, msg)
 
+    def queue_ack(self, host_port, echo):
+        queue = self.ack_queues.get(host_port)
+
+        if queue is None:
+            queue = self.ack_queues[host_port] = list()
+            self.ack_timers[host_port] = gevent.spawn_later(
+                self.ack_delay,
+                self.flush_acks,
+                host_port,
+            )
+
+        if echo not in queue:
+            queue.append(echo)
+
+        if len(queue) >= self.max_cumulative_acks:
+            self.flush_acks(host_port)
+
+    def pop_acks(self, host_port):
+        """ Returns the delayed Acks for `host_port` encoded as a single
+        message, or None if there are none.
+        """
+        echoes = self.ack_queues.pop(host_port, None)
+
+        # sent before the delay, the timer would flush the next Acks early
+        timer = self.ack_timers.pop(host_port, None)
+        if timer is not None and timer is not gevent.getcurrent():
+            timer.kill(block=False)
+
+        if not echoes:
+            return None
+
+        if len(echoes) == 1:
+            ack = Ack(self.raiden.address, echoes[0])
+        else:
+            ack = CumulativeAck(self.raiden.address, echoes)
+
+        return ack.encode()
+
+    def flush_acks(self, host_port):
+        """ Send the Acks delayed for `host_port`. """
+        ack_data = self.pop_acks(host_port)
+
+        if ack_data is not None:
+            self.send_raw(host_port, ack_data)
+
+    def send_raw(self, host_port, data):
+        """ Send the encoded message `data`, or queue it to be sent in an
+        envelope if batching is enabled.
+        """
+        if not self.batch_delay:
+            self.transport.send(self.raiden, host_port, data)
+            return
+
+        queue = self.send_queues.get(host_port)
+
+        # the envelope would be too big, send what is queued first
+        if queue is not None:
+            size = len(ENVELOPE_HEADER) + sum(
+                envelope_length.size + len(queued)
+                for queued in queue
+            )
+
+            if size + envelope_length.size + len(data) >= self.max_message_size:
+                self.flush(host_port)
+                queue = None
+
+        if queue is None:
+            queue = self.send_queues[host_port] = list()
+            self.send_timers[host_port] = gevent.spawn_later(
+                self.batch_delay,
+                self.flush,
+                host_port,
+            )
+
+        queue.append(data)
+
+    def flush(self, host_port):
+        """ Send the messages queued for `host_port`. """
+        queue = self.send_queues.pop(host_port, None)
+
+        # flushed before the delay, the timer would flush the next queue early
+        timer = self.send_timers.pop(host_port, None)
+        if timer is not None and timer is not gevent.getcurrent():
+            timer.kill(block=False)
+
+        if not queue:
+            return
+
+        if len(queue) == 1:
+            data = queue[0]
+        else:
+            data = wrap_envelope(queue)
+
+        self.transport.send(self.raiden, host_port, data)
+
+    def receive_batch(self, batch):
+        """ Handle a batch of datagrams, a bad datagram doesn't stop the
+        others from being handled.
+        """
+        for data in batch:
+            try:
+                self.receive(data)
+            except Exception:  # pylint: disable=broad-except
+                log.exception('failed to handle a datagram')
+
     def receive(self, data):
+        """ Handle the datagram `data`, it can be a string, a bytearray or a
+        memoryview.
+
+        The datagram is not copied, the envelopes are sliced, the message hash
+        and the signature are computed and the fields are decoded from views
+        of `data`.
+        """
         assert len(data) < self.max_message_size
 
-        msghash = sha3(data)
+        if data[:1] == ENVELOPE:
+            # a bad message doesn't stop the others from being handled
+            for message_data in unwrap_envelope(memoryview(data)):
+                try:
+                    self.receive(message_data)
+                except Exception:  # pylint: disable=broad-except
+                    log.exception('failed to handle a message of an envelope')
+            return
+
+        data = as_view(data)
+        msghash = keccak(data)
 
         # check if we handled this message already, if so repeat Ack
-        if msghash in self.sent_acks:
-            return self.send_ack(*self.sent_acks[msghash])
+        sent_ack = self.sent_acks.get(msghash)
+        if sent_ack is not None:
+            return self.send_ack(*sent_ack)
 
         # We ignore the sending endpoint as this can not be known w/ UDP
-        msg = messages.decode(data)
+        cmdid = data[0]
+        msg = messages.CMDID_TO_CLASS[cmdid].decode(data)
 
         # handle Acks
-        if isinstance(msg, Ack):
-            log.debug('ACK MSGHASH RECEIVED {} [echo={}]'.format(
-                pex(self.raiden.address),
-                pex(msg.echo)
-            ))
+        if cmdid == ACK:
+            self.on_ack(msg.echo)
+            return
 
-            del self.tries[msg.echo]
+        if cmdid == CUMULATIVEACK:
+            for echo in msg.echoes:
+                self.on_ack(echo)
             return
 
         assert isinstance(msg, Secret) or msg.sender
-        self.raiden.on_message(msg, msghash)
+        self.raiden.dispatch(cmdid, msg, msghash)
+
+    def on_ack(self, echo):
+        lazylog.debug(
+            'ACK MSGHASH RECEIVED %s [echo=%s]',
+            Hex(self.raiden.address),
+            Hex(echo),
+            category='ack',
+        )
+
+        pending = self.pending.pop(echo, None)
+        if pending is not None:
+            # Karn's algorithm, the Ack of a retransmitted message is
+            # ambiguous and is not used as a sample
+            if pending.tries == self.max_tries - 1:
+                round_trip = self.get_round_trip(pending.receiver_address)
+                round_trip.update(time.time() - pending.sent_at)
+
+            pending.async_result.set(True)
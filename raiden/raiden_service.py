@@ -1,17 +1,29 @@
 # -*- coding: utf8 -*-
+import itertools
+import struct
+
 from ethereum import slogging
-import networkx as nx
 
 from raiden.assetmanager import AssetManager
-from raiden.channelgraph import ChannelGraph
+from raiden.channelgraph import ChannelGraph, CompactChannelGraph
 from raiden.channel import Channel, ChannelEndState
 from raiden import messages
+from raiden.encoding.messages import SECRET, SECRETREQUEST
+from raiden.lazylog import Hex, LazyLogger
 from raiden.raiden_protocol import RaidenProtocol
 from raiden.transfermanager import TransferManager
-from raiden.utils import privtoaddr, isaddress, pex
+from raiden.utils import (
+    big_endian_to_int,
+    int_to_big_endian,
+    isaddress,
+    pex,
+    privtoaddr,
+    shard_for,
+)
 
 
 log = slogging.get_logger(__name__)  # pylint: disable=invalid-name
+lazylog = LazyLogger(log)  # pylint: disable=invalid-name
 
 # TODO: reevaluate names of Custom Exceptions
 # base error for raiden"
@@ -51,6 +63,13 @@ class RaidenAPI(object):
         if not self.raiden.has_path(asset_address, target):
             raise NoPathError('No path to address found')
         assert asset_address in self.assets
+
+        # the first channel of the route is run by another shard
+        shard = self.raiden.transfer_shard(asset_address, amount, target)
+        if shard != self.raiden.shard:
+            self.raiden.forward_transfer(shard, asset_address, amount, target, callback)
+            return
+
         transfer_manager = self.raiden.assetmanagers[asset_address].transfermanager
         assert isinstance(transfer_manager, TransferManager)
         transfer_manager.transfer(amount, target, callback=callback)
@@ -81,23 +100,206 @@ class RaidenAPI(object):
         return address
 
 
+class HashlockIndex(object):
+    """ Node wide mapping from a hashlock to the channels and tasks using it.
+
+    The channels are kept up-to-date by the `LockedTransfers` callbacks and the
+    tasks by the `TransferManager`, so that a message with a hashlock can be
+    dispatched without looking at every channel of every asset.
+    """
+
+    def __init__(self):
+        self.channels = dict()  #: hashlock -> set of (asset_address, channel)
+        self.tasks = dict()  #: hashlock -> set of (asset_address, task)
+
+    def register_channel(self, asset_address, channel):
+        """ Track the locks of both ends of `channel`. """
+        entry = (asset_address, channel)
+
+        def on_lock_changed(hashlock, added):
+            if added:
+                self.channels.setdefault(hashlock, set()).add(entry)
+
+            # the same hashlock can be locked in both directions, e.g. by a
+            # CancelTransfer, keep the entry until both ends released it
+            elif hashlock not in channel.our_state.locked and \
+                    hashlock not in channel.partner_state.locked:
+                self._discard(self.channels, hashlock, entry)
+
+        channel.our_state.locked.callbacks.append(on_lock_changed)
+        channel.partner_state.locked.callbacks.append(on_lock_changed)
+
+    def add_task(self, asset_address, task):
+        self.tasks.setdefault(task.hashlock, set()).add((asset_address, task))
+
+    def remove_task(self, asset_address, task):
+        self._discard(self.tasks, task.hashlock, (asset_address, task))
+
+    def knows(self, hashlock):
+        """ True if a channel or a task is using `hashlock`. """
+        return hashlock in self.channels or hashlock in self.tasks
+
+    def get_channels(self, hashlock):
+        """ Return a list of `(asset_address, channel)` with a lock for `hashlock`. """
+        return list(self.channels.get(hashlock, ()))
+
+    def get_tasks(self, hashlock):
+        """ Return a list of `(asset_address, task)` for `hashlock`. """
+        return list(self.tasks.get(hashlock, ()))
+
+    @staticmethod
+    def _discard(mapping, hashlock, entry):
+        entries = mapping.get(hashlock)
+
+        if entries is not None:
+            entries.discard(entry)
+
+            if not entries:
+                del mapping[hashlock]
+
+
 class RaidenService(object):
 
     """ Runs a service on a node """
 
+    # a transfer requested to another shard: request id, asset, target and
+    # amount, the id 0 asks for no reply
+    shard_request = struct.Struct('>I20s20s32s')
+    # the result of a requested transfer: request id and success
+    shard_reply = struct.Struct('>I?')
+
     def __init__(self, chain, privkey, transport, discovery, config):
         self.chain = chain
         self.config = config
         self.privkey = privkey  # or config['privkey']
         self.address = privtoaddr(privkey)
+        self.discovery = discovery
         self.protocol = RaidenProtocol(transport, discovery, self)
         transport.protocol = self.protocol
+
+        # the node can be served by several processes, see
+        # `ShardedUDPTransport`, this one runs only the channels with the
+        # partners of its shard
+        self.shard = config.get('shard', 0)
+        self.shards = config.get('shards', 1)
+        self.partner_shards = dict()  #: partner address -> shard
+        self.shard_callbacks = dict()  #: request id -> callback of a forwarded transfer
+        self.shard_request_ids = itertools.count(1)
+
+        if self.shards > 1:
+            transport.request_callbacks.append(self.on_shard_request)
+            transport.reply_callbacks.append(self.on_shard_reply)
+
         self.assetmanagers = dict()
+        self.hashlock_index = HashlockIndex()
         self.api = RaidenAPI(self)
 
+        #: cmdid -> handler, looked up by the protocol for every message
+        self.message_handlers = self.build_message_handlers()
+
+        #: callbacks called with (msg, msghash) before and after a message is
+        #: handled, useful for instrumentation
+        self.pre_dispatch_hooks = list()
+        self.post_dispatch_hooks = list()
+
+        # keep the channel graphs up-to-date with the blockchain
+        chain.channelnew_callbacks.append(self.on_channelnew_event)
+        chain.deposit_callbacks.append(self.on_deposit_event)
+        chain.close_callbacks.append(self.on_close_event)
+
     def __repr__(self):
         return '<{} {}>'.format(self.__class__.__name__, pex(self.address))
 
+    def stop(self):
+        """ Release the resources of the channels. """
+        for asset_manager in self.assetmanagers.values():
+            for channel in asset_manager.channels.values():
+                channel.stop()
+
+    def shard_of(self, partner_address):
+        """ Return the shard that runs the channels with `partner_address`. """
+        shard = self.partner_shards.get(partner_address)
+
+        if shard is None:
+            host_port = self.discovery.get(partner_address)
+            shard = self.partner_shards[partner_address] = shard_for(host_port, self.shards)
+
+        return shard
+
+    def owns(self, partner_address):
+        """ True if this process runs the channels with `partner_address`. """
+        return self.shards == 1 or self.shard_of(partner_address) == self.shard
+
+    def transfer_shard(self, asset_address, amount, target):
+        """ Return the shard that should start a transfer of `amount` to
+        `target`, the one that runs the first channel of the best route.
+        """
+        asset_manager = self.assetmanagers[asset_address]
+
+        if self.shards == 1 or asset_manager.get_best_routes(target, amount):
+            return self.shard
+
+        # the capacities of the channels run by the other shards are only
+        # known from the deposits
+        for route in asset_manager.routecache.get_best_routes(self.address, target, amount):
+            if len(route) > 1:
+                return self.shard_of(route[1])
+
+        return self.shard
+
+    def forward_transfer(self, shard, asset_address, amount, target, callback=None):
+        """ Ask `shard` to start a transfer of `amount` to `target`,
+        `callback` is called with `(None, success)` once it replied.
+        """
+        request_id = 0
+        if callback is not None:
+            request_id = next(self.shard_request_ids)
+            self.shard_callbacks[request_id] = callback
+
+        data = self.shard_request.pack(
+            request_id,
+            asset_address,
+            target,
+            int_to_big_endian(amount).rjust(32, b'\x00'),
+        )
+        self.protocol.transport.forward_request(shard, data)
+
+    def on_shard_request(self, shard, data):
+        request_id, asset_address, target, amount = self.shard_request.unpack(data)
+        success = False
+
+        try:
+            asset_manager = self.assetmanagers.get(asset_address)
+
+            if asset_manager is None:
+                log.error('transfer requested for an unknown asset {}'.format(
+                    pex(asset_address),
+                ))
+            else:
+                # started here even if it fails, forwarding it again could
+                # loop between the shards
+                transfermanager = asset_manager.transfermanager
+                success = transfermanager.transfer(big_endian_to_int(amount), target)
+        finally:
+            if request_id:
+                reply = self.shard_reply.pack(request_id, bool(success))
+                self.protocol.transport.forward_reply(shard, reply)
+
+    def on_shard_reply(self, shard, data):  # pylint: disable=unused-argument
+        request_id, success = self.shard_reply.unpack(data)
+        callback = self.shard_callbacks.pop(request_id, None)
+
+        if callback is not None:
+            callback(None, success)
+
+    def claim_hashlock(self, hashlock, address):
+        """ Have the messages from `address` about `hashlock` handled by this
+        shard, for the messages that can arrive before anything was sent to
+        `address`.
+        """
+        if self.shards > 1:
+            self.protocol.transport.claim(self.discovery.get(address), hashlock)
+
     def setup_asset(self, asset_address, reveal_timeout):
         """ Initialize a `AssetManager`, and for each open channel that this
         node has create a corresponding `Channel`.
@@ -127,7 +329,11 @@ class RaidenService(object):
         """ Return the AssetManager for the given `asset_address`. """
         if asset_address not in self.assetmanagers:
             edges = self.chain.addresses_by_asset(asset_address)
-            channel_graph = ChannelGraph(edges)
+
+            if self.config.get('compact_channelgraph'):
+                channel_graph = CompactChannelGraph(edges)
+            else:
+                channel_graph = ChannelGraph(edges)
 
             asset_manager = AssetManager(self, asset_address, channel_graph)
             self.assetmanagers[asset_address] = asset_manager
@@ -135,7 +341,9 @@ class RaidenService(object):
         return self.assetmanagers[asset_address]
 
     def setup_channel(self, asset_manager, asset_address, nettingcontract_address, reveal_timeout):
-        """ Initialize the Channel for the given netting contract. """
+        """ Initialize the Channel for the given netting contract, unless it
+        is run by another shard.
+        """
 
         channel_details = self.chain.netting_contract_detail(
             asset_address,
@@ -143,6 +351,9 @@ class RaidenService(object):
             self.address,
         )
 
+        if not self.owns(channel_details['partner_address']):
+            return
+
         our_state = ChannelEndState(
             self.address,
             channel_details['our_balance'],
@@ -160,34 +371,127 @@ class RaidenService(object):
             our_state,
             partner_state,
             reveal_timeout,
+            transfer_log_dir=self.config.get('transfer_log_dir'),
         )
 
         asset_manager.add_channel(channel_details['partner_address'], channel)
 
+    def on_channelnew_event(self, asset_address, netting_contract_address,
+                            address1, address2):
+        asset_manager = self.assetmanagers.get(asset_address)
+
+        if asset_manager is not None:
+            asset_manager.channelgraph.add_channel(address1, address2)
+
+            # one of our channels, it must be usable as soon as it's routable
+            if self.address in (address1, address2):
+                partner_address = address2 if address1 == self.address else address1
+
+                if partner_address not in asset_manager.channels:
+                    self.setup_channel(
+                        asset_manager,
+                        asset_address,
+                        netting_contract_address,
+                        self.config['reveal_timeout'],
+                    )
+
+    def on_deposit_event(self, asset_address, netting_contract_address,
+                         participant_address, deposit):
+        """ The deposit is the only capacity known for the channels of other
+        nodes, the capacity of our channels is refreshed before routing.
+        """
+        asset_manager = self.assetmanagers.get(asset_address)
+
+        if asset_manager is not None:
+            partner_address = self.chain.partner(
+                asset_address,
+                netting_contract_address,
+                participant_address,
+            )
+
+            channelgraph = asset_manager.channelgraph
+            channelgraph.add_channel(participant_address, partner_address)
+            channelgraph.update_capacity(participant_address, partner_address, deposit)
+
+            if participant_address == self.address:
+                channel = asset_manager.channels.get(partner_address)
+                if channel is not None:
+                    channel.our_state.update_deposit(deposit)
+
+            elif partner_address == self.address:
+                channel = asset_manager.channels.get(participant_address)
+                if channel is not None:
+                    channel.partner_state.update_deposit(deposit)
+
+    def on_close_event(self, asset_address, netting_contract_address,
+                       address1, address2):
+        # pylint: disable=unused-argument
+        asset_manager = self.assetmanagers.get(asset_address)
+
+        if asset_manager is not None:
+            asset_manager.channelgraph.remove_channel(address1, address2)
+
     def has_path(self, asset, target):
         assetmanager = self.assetmanagers.get(asset)
         if assetmanager is not None:
-            channel = assetmanager.channelgraph.graph
-            if target in channel.nodes():
-                return nx.has_path(channel, self.address, target)
+            return assetmanager.routecache.has_path(self.address, target)
         return False
 
     def sign(self, msg):
         assert isinstance(msg, messages.SignedMessage)
         return msg.sign(self.privkey)
 
+    def build_message_handlers(self):
+        """ Return the mapping from a cmdid to the method handling the
+        message, named `on_<message class name>`.
+
+        The Acks are handled by the protocol and have no handler.
+        """
+        handlers = dict()
+
+        for cmdid, klass in messages.CMDID_TO_CLASS.items():
+            method = getattr(self, 'on_%s' % klass.__name__.lower(), None)
+
+            if method is not None:
+                handlers[cmdid] = method
+
+        return handlers
+
     def on_message(self, msg, msghash):
-        log.debug('ON MESSAGE {} {}'.format(pex(self.address), msg))
-        method = 'on_%s' % msg.__class__.__name__.lower()
+        self.dispatch(msg.cmdid, msg, msghash)
+
+    def dispatch(self, cmdid, msg, msghash):
+        """ Handle the decoded message `msg` and acknowledge it.
+
+        Args:
+            cmdid (bytes): The first byte of the encoded message.
+            msg (Message): The decoded message.
+            msghash (bytes): The hash of the encoded message.
+        """
+        lazylog.debug('ON MESSAGE %s %s', Hex(self.address), msg, category='dispatch')
+
+        # a peer of this shard can send a Secret of a transfer run by another
+        # one before the claim arrived, it is neither handled nor acknowledged
+        # here so that the peer retries it
+        if self.shards > 1 and cmdid in (SECRET, SECRETREQUEST) and \
+                not self.hashlock_index.knows(msg.hashlock):
+            lazylog.debug('UNKNOWN HASHLOCK %s %s', Hex(self.address), msg, category='dispatch')
+            return
+
+        for hook in self.pre_dispatch_hooks:
+            hook(msg, msghash)
+
         # update activity monitor (which also does pings to all addresses in channels)
-        getattr(self, method)(msg)
+        self.message_handlers[cmdid](msg)
         self.protocol.send_ack(msg.sender, messages.Ack(self.address, msghash))
 
+        for hook in self.post_dispatch_hooks:
+            hook(msg, msghash)
+
     def on_message_failsafe(self, msg, msghash):
-        method = 'on_%s' % msg.__class__.__name__.lower()
         # update activity monitor (which also does pings to all addresses in channels)
         try:
-            getattr(self, method)(msg)
+            self.message_handlers[msg.cmdid](msg)
         except messages.BaseError as error:
             self.protocol.send_ack(msg.sender, error)
         else:
@@ -223,17 +527,21 @@ class RaidenService(object):
             # TransferTimeout, Secret, SecretRequest, ConfirmTransfer
             hashlock = msg.hashlock
 
-        for asset_manager in self.assetmanagers.values():
-            if hashlock in asset_manager.transfermanager.transfertasks:
-                asset_manager.transfermanager.transfertasks[hashlock].on_event(msg)
-                return True
+        for _, task in self.hashlock_index.get_tasks(hashlock):
+            task.on_event(msg)
+            return True
 
     on_secretrequest = on_transfertimeout = on_canceltransfer = on_event_for_transfertask
 
     def on_secret(self, msg):
         self.on_event_for_transfertask(msg)
-        for asset_manager in self.assetmanagers.values():
-            asset_manager.on_secret(msg)
+
+        assets = set(
+            asset_address
+            for asset_address, _ in self.hashlock_index.get_channels(msg.hashlock)
+        )
+        for asset_address in assets:
+            self.assetmanagers[asset_address].on_secret(msg)
 
     def on_transferrequest(self, msg):
         asset_manager = self.assetmanagers[msg.asset]
@@ -68,6 +68,14 @@ class MediatedTransferTask(Task):
     # B: MediatedTransfer > C2
     # C2: MediatedTransfer > D
 
+    # time allowed to every hop to handle the transfer and forward it, in
+    # addition to the time spent on the network
+    hop_processing_time = 1.
+
+    # the timeout derived from the round trip time is never shorter than this
+    # fraction of `msg_timeout`
+    min_msg_timeout_ratio = 0.25
+
     def __init__(self, transfermanager, amount, target, hashlock, expiration,
                  originating_transfer=None, secret=None):  # fee!
         import transfermanager as transfermanagermodule
@@ -129,7 +137,7 @@ class MediatedTransferTask(Task):
                 lpex(path),
             ))
 
-            msg_timeout = self.raiden.config['msg_timeout']
+            msg_timeout = self.get_msg_timeout(path)
 
             # timeout not dependent on expiration (canceltransfer/transfertimeout msgs),
             # but should be set shorter than the expiration
@@ -187,10 +195,9 @@ class MediatedTransferTask(Task):
         """ Yield a two-tuple (path, channel) that can be used to mediate the
         transfer. The result is ordered from the best to worst path.
         """
-        available_paths = self.assetmanager.channelgraph.get_shortest_paths(
-            self.raiden.address,
-            self.target,
-        )
+        # the routes are already filtered by the status of the channels and
+        # by our funds, we can't intermediate the transfer without them
+        available_paths = self.assetmanager.get_best_routes(self.target, self.amount)
 
         for path in available_paths:
             assert path[0] == self.raiden.address
@@ -200,13 +207,6 @@ class MediatedTransferTask(Task):
             partner = path[1]
             channel = self.assetmanager.channels[partner]
 
-            if not channel.isopen:
-                continue
-
-            # we can't intermediate the transfer if we don't have enough funds
-            if self.amount > channel.distributable:
-                continue
-
             # Our partner won't accept a locked transfer that can expire after
             # the settlement period, otherwise the secret could be revealed
             # after channel is settled and he would lose the asset, or before
@@ -272,6 +272,28 @@ class MediatedTransferTask(Task):
             return True
         return None
 
+    def get_msg_timeout(self, path):
+        """ How long to wait for a response to a transfer sent along `path`.
+
+        Once an Ack from the next hop was timed the timeout is derived from
+        it's retransmission timeout, allowing every remaining hop to use all
+        the tries and `hop_processing_time`. Only the round trip time of the
+        next hop is known, so the result is kept between
+        `min_msg_timeout_ratio * msg_timeout` and `msg_timeout`.
+        """
+        msg_timeout = self.raiden.config['msg_timeout']
+
+        protocol = self.raiden.protocol
+        round_trip = protocol.round_trips.get(path[1])
+
+        if round_trip is None or round_trip.srtt is None:
+            return msg_timeout
+
+        hops = len(path) - 1
+        timeout = hops * (round_trip.rto * protocol.max_tries + self.hop_processing_time)
+
+        return min(msg_timeout, max(timeout, self.min_msg_timeout_ratio * msg_timeout))
+
     def send_transfer_and_wait(self, recipient, transfer, path, msg_timeout):
         """ Send `transfer` to `recipient` and wait for the response.
 
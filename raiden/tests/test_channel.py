@@ -3,7 +3,9 @@ import pytest
 
 from ethereum import slogging
 
-from raiden.messages import DirectTransfer
+from raiden.channel import InvalidLocksRoot, LockedTransfers, TransferHistory
+from raiden.messages import DirectTransfer, Lock
+from raiden.mtree import merkleroot
 from raiden.tests.utils.network import create_network
 from raiden.tests.utils.transfer import assert_synched_channels
 from raiden.utils import sha3
@@ -128,6 +130,10 @@ def test_locked_transfer():
         channel1, balance1, [],
     )
 
+    asset_address = channel0.asset_address
+    assert app0.raiden.hashlock_index.get_channels(hashlock) == [(asset_address, channel0)]
+    assert app1.raiden.hashlock_index.get_channels(hashlock) == [(asset_address, channel1)]
+
     channel0.claim_locked(secret)
     channel1.claim_locked(secret)
 
@@ -137,6 +143,9 @@ def test_locked_transfer():
         channel1, balance1 + amount, [],
     )
 
+    assert not app0.raiden.hashlock_index.get_channels(hashlock)
+    assert not app1.raiden.hashlock_index.get_channels(hashlock)
+
 
 def test_interwoven_transfers(num=100):  # pylint: disable=too-many-locals
     """ Can keep doing transaction even if not all secrets have been released. """
@@ -300,3 +309,243 @@ def test_register_invalid_transfer():
         channel0, balance0, [transfer1.lock],
         channel1, balance1, []
     )
+
+
+def test_expired_locks():
+    """ Expired locks are dropped by the sender once the block number passes
+    their expiration, and by the receiver with the next transfer.
+    """
+    apps = create_network(num_nodes=2, num_assets=1, channels_per_node=1)
+    app0, app1 = apps  # pylint: disable=unbalanced-tuple-unpacking
+    chain = app0.raiden.chain
+
+    channel0 = app0.raiden.assetmanagers.values()[0].channels.values()[0]
+    channel1 = app1.raiden.assetmanagers.values()[0].channels.values()[0]
+
+    balance0 = channel0.balance
+    balance1 = channel1.balance
+
+    amount = 10
+    short_expiration = chain.block_number + 5
+    long_expiration = chain.block_number + 15
+
+    locks = []
+    for expiration, secret in zip([short_expiration, short_expiration, long_expiration], 'abc'):
+        locked_transfer = channel0.create_lockedtransfer(
+            amount=amount,
+            expiration=expiration,
+            hashlock=sha3(secret),
+        )
+        app0.raiden.sign(locked_transfer)
+        channel0.register_transfer(locked_transfer)
+        channel1.register_transfer(locked_transfer)
+        locks.append(locked_transfer.lock)
+
+    assert_synched_channels(
+        channel0, balance0, locks,
+        channel1, balance1, [],
+    )
+
+    for _ in range(short_expiration - chain.block_number + 1):
+        chain.next_block()
+
+    # the sender waits for the partner's view of the chain to catch up
+    direct_transfer = channel0.create_directtransfer(amount)
+    assert direct_transfer.locksroot == channel1.our_state.locked.root
+
+    for _ in range(channel0.expiration_margin):
+        chain.next_block()
+
+    # the next transfer prunes the expired locks on both ends
+    direct_transfer = channel0.create_directtransfer(amount)
+    app0.raiden.sign(direct_transfer)
+    channel0.register_transfer(direct_transfer)
+    channel1.register_transfer(direct_transfer)
+
+    assert_synched_channels(
+        channel0, balance0 - amount, locks[2:],
+        channel1, balance1 + amount, [],
+    )
+    assert channel0.distributable == balance0 - 2 * amount
+
+
+def test_transfer_history(tmpdir):
+    """ Only the latest transfer and transfers with pending locks are kept in
+    memory, the log file has all of them.
+    """
+    apps = create_network(num_nodes=2, num_assets=1, channels_per_node=1)
+    app0, app1 = apps  # pylint: disable=unbalanced-tuple-unpacking
+
+    channel0 = app0.raiden.assetmanagers.values()[0].channels.values()[0]
+    channel1 = app1.raiden.assetmanagers.values()[0].channels.values()[0]
+
+    history = TransferHistory(str(tmpdir.join('history.log')))
+    channel0.partner_state.locked.callbacks.append(history.on_lock_changed)
+
+    expiration = app0.raiden.chain.block_number + 15
+    secret = 'secret'
+
+    locked_transfer = channel0.create_lockedtransfer(10, expiration, sha3(secret))
+    app0.raiden.sign(locked_transfer)
+    channel0.register_transfer(locked_transfer)
+    channel1.register_transfer(locked_transfer)
+    history.append(locked_transfer)
+
+    sent = [locked_transfer]
+    for _ in range(3):
+        direct_transfer = channel0.create_directtransfer(1)
+        app0.raiden.sign(direct_transfer)
+        channel0.register_transfer(direct_transfer)
+        channel1.register_transfer(direct_transfer)
+        history.append(direct_transfer)
+        sent.append(direct_transfer)
+
+    assert len(channel0.sent_transfers) == len(channel1.received_transfers) == 4
+    assert channel0.sent_transfers[-1] is sent[-1]
+    assert channel0.sent_transfers[0] is locked_transfer
+    assert list(channel0.sent_transfers) == [locked_transfer, sent[-1]]
+
+    with pytest.raises(IndexError):
+        channel0.sent_transfers[1]  # pylint: disable=pointless-statement
+
+    channel0.claim_locked(secret)
+    channel1.claim_locked(secret)
+
+    assert list(channel0.sent_transfers) == [sent[-1]]
+    assert list(history) == [sent[-1]]
+
+    # compacted transfers are read back from the log
+    for position, transfer in enumerate(sent):
+        assert history[position] == transfer
+
+    history.close()
+
+    # the channel state is not restored on a restart, neither is the history
+    restarted = TransferHistory(str(tmpdir.join('history.log')))
+    assert len(restarted) == 0
+    assert tmpdir.join('history.log').size() == 0
+
+    direct_transfer = channel0.create_directtransfer(1)
+    app0.raiden.sign(direct_transfer)
+    restarted.append(direct_transfer)
+    restarted.append(sent[0])
+
+    assert len(restarted) == 2
+    assert restarted[0] == direct_transfer
+    assert restarted[1] is sent[0]
+    restarted.close()
+
+
+class LaggingChain(object):
+    """ A view of `chain` that is `lag` blocks behind. """
+
+    def __init__(self, chain, lag):
+        self.chain = chain
+        self.lag = lag
+
+    @property
+    def block_number(self):
+        return self.chain.block_number - self.lag
+
+    def __getattr__(self, name):
+        return getattr(self.chain, name)
+
+
+@pytest.mark.parametrize('lag', [-1, 1])
+def test_expired_locks_block_skew(lag):
+    """ The receiver accepts a locksroot without the locks that expired in
+    its view of the chain, and only those.
+    """
+    apps = create_network(num_nodes=2, num_assets=1, channels_per_node=1)
+    app0, app1 = apps  # pylint: disable=unbalanced-tuple-unpacking
+    chain = app0.raiden.chain
+
+    channel0 = app0.raiden.assetmanagers.values()[0].channels.values()[0]
+    channel1 = app1.raiden.assetmanagers.values()[0].channels.values()[0]
+    channel1.chain = LaggingChain(chain, lag)
+
+    balance0 = channel0.balance
+    balance1 = channel1.balance
+
+    amount = 10
+    expiration = chain.block_number + 5
+
+    expiring_transfer = channel0.create_lockedtransfer(amount, expiration, sha3('expiring'))
+    app0.raiden.sign(expiring_transfer)
+    channel0.register_transfer(expiring_transfer)
+    channel1.register_transfer(expiring_transfer)
+
+    # the lock just expired for the sender
+    for _ in range(expiration - chain.block_number + channel0.expiration_margin + 1):
+        chain.next_block()
+
+    locked_transfer = channel0.create_lockedtransfer(amount, chain.block_number + 15, sha3('new'))
+    app0.raiden.sign(locked_transfer)
+    channel0.register_transfer(locked_transfer)
+    channel1.register_transfer(locked_transfer)
+
+    assert_synched_channels(
+        channel0, balance0, [locked_transfer.lock],
+        channel1, balance1, [],
+    )
+
+
+def test_unexpired_lock_dropped():
+    """ A locksroot without a lock that didn't expire is rejected. """
+    apps = create_network(num_nodes=2, num_assets=1, channels_per_node=1)
+    app0, app1 = apps  # pylint: disable=unbalanced-tuple-unpacking
+    chain = app0.raiden.chain
+
+    channel0 = app0.raiden.assetmanagers.values()[0].channels.values()[0]
+    channel1 = app1.raiden.assetmanagers.values()[0].channels.values()[0]
+
+    expiration = chain.block_number + 5
+    expiring_transfer = channel0.create_lockedtransfer(10, expiration, sha3('expiring'))
+    app0.raiden.sign(expiring_transfer)
+    channel0.register_transfer(expiring_transfer)
+    channel1.register_transfer(expiring_transfer)
+
+    # the sender has a chain view ahead of the receiver's
+    channel0.chain = LaggingChain(chain, -channel0.expiration_margin - 1)
+    for _ in range(expiration - chain.block_number):
+        chain.next_block()
+
+    locked_transfer = channel0.create_lockedtransfer(10, chain.block_number + 15, sha3('new'))
+    app0.raiden.sign(locked_transfer)
+
+    with pytest.raises(InvalidLocksRoot):
+        channel1.register_transfer(locked_transfer)
+
+    assert expiring_transfer.lock.hashlock in channel1.our_state.locked
+
+
+class PendingTransfer(object):  # pylint: disable=too-few-public-methods
+    """ The part of a transfer used by `LockedTransfers`. """
+
+    def __init__(self, lock):
+        self.lock = lock
+
+
+def test_find_pruned_bounded():
+    """ Only the latest expirations are tried to match a pruned locksroot. """
+    locked = LockedTransfers()
+    locks = [Lock(10, expiration, sha3(str(expiration))) for expiration in range(1, 21)]
+    for lock in locks:
+        locked.add(PendingTransfer(lock))
+
+    def root_without(count):
+        return merkleroot(sha3(lock.as_bytes) for lock in locks[count:])
+
+    # nothing expired, nothing could have been dropped
+    assert locked.find_pruned(root_without(1), 1) is None
+
+    assert locked.find_pruned(root_without(20), 30) == 21
+    assert locked.find_pruned(root_without(15), 30) == 16
+
+    # the sender would lag more than `max_pruned_candidates` expirations
+    assert locked.find_pruned(root_without(20 - LockedTransfers.max_pruned_candidates), 30) is None
+    assert locked.find_pruned(sha3('bad'), 30) is None
+
+    # nothing is changed by the search
+    assert len(locked) == 20
+    assert locked.root == root_without(0)
@@ -0,0 +1,330 @@
+# -*- coding: utf8 -*-
+import random
+
+import gevent
+import networkx
+import pytest
+
+from raiden.channelgraph import ChannelGraph, CompactChannelGraph, RouteCache
+from raiden.tests.utils.network import create_sequential_network
+from raiden.utils import sha3
+
+
+def make_address(name):
+    return sha3(name)[:20]
+
+
+A, B, C, D, E = [make_address(name) for name in 'abcde']
+
+graph_classes = pytest.mark.parametrize('graph_class', [ChannelGraph, CompactChannelGraph])
+
+
+@graph_classes
+def test_best_routes(graph_class):
+    #   A - B - D
+    #   |       |
+    #   C ----- E
+    graph = graph_class([(A, B), (B, D), (A, C), (C, E), (E, D)])
+
+    assert graph.get_best_routes(A, D, 10) == [[A, B, D], [A, C, E, D]]
+    assert graph.get_best_routes(A, D, 10, max_routes=1) == [[A, B, D]]
+
+    # the capacity is directional
+    graph.update_capacity(A, B, 5)
+    graph.update_capacity(B, A, 100)
+    assert graph.get_best_routes(A, D, 10) == [[A, C, E, D]]
+    assert graph.get_best_routes(A, D, 5) == [[A, B, D], [A, C, E, D]]
+    assert graph.get_best_routes(B, A, 10) == [[B, A], [B, D, E, C, A]]
+
+    graph.update_status(C, E, isopen=False)
+    assert graph.get_best_routes(A, D, 10) == []
+    assert graph.get_best_routes(A, D, 5) == [[A, B, D]]
+
+
+@graph_classes
+def test_best_routes_order(graph_class):
+    #   A - B - D
+    #    \     /
+    #      C -
+    graph = graph_class([(A, B), (B, D), (A, C), (C, D)])
+
+    graph.update_capacity(A, B, 10)
+    graph.update_capacity(A, C, 50)
+    assert graph.get_best_routes(A, D, 10) == [[A, C, D], [A, B, D]]
+
+    graph.update_capacity(A, B, 100)
+    assert graph.get_best_routes(A, D, 10) == [[A, B, D], [A, C, D]]
+
+
+def test_routing_graph_view():
+    """ The routing graph is a view, the updates are seen without rebuilding it. """
+    graph = ChannelGraph([(A, B), (B, C)])
+    routing_graph = graph.routing_graph(10)
+
+    assert routing_graph.has_edge(A, B) and routing_graph.has_edge(B, A)
+
+    graph.update_capacity(A, B, 5)
+    assert not routing_graph.has_edge(A, B)
+    assert routing_graph.has_edge(B, A)
+
+    graph.update_status(B, C, isopen=False)
+    assert not routing_graph.has_edge(B, C) and not routing_graph.has_edge(C, B)
+
+
+def test_compact_graph():
+    random.seed(7)
+
+    addresses = [make_address(str(number)) for number in range(50)]
+    edges = [tuple(random.sample(addresses, 2)) for _ in range(80)]
+
+    graph = ChannelGraph(edges)
+    compact = CompactChannelGraph(edges)
+
+    for source in addresses[:10]:
+        for target in addresses:
+            if source == target:
+                continue
+
+            assert compact.has_path(source, target) == graph.has_path(source, target)
+
+            if graph.has_path(source, target):
+                assert sorted(compact.get_shortest_paths(source, target)) == \
+                    sorted(graph.get_shortest_paths(source, target))
+            else:
+                with pytest.raises(networkx.NetworkXNoPath):
+                    list(compact.get_shortest_paths(source, target))
+
+        for num_hops in (1, 2, 3):
+            paths = compact.get_paths_of_length(source, num_hops)
+            expected = graph.get_paths_of_length(source, num_hops)
+
+            # any shortest path is valid, compare the targets
+            assert sorted(path[-1] for path in paths) == sorted(path[-1] for path in expected)
+            for path in paths:
+                assert len(path) == num_hops + 1
+                assert path[0] == source
+                assert all(compact.has_channel(*edge) for edge in zip(path[:-1], path[1:]))
+
+
+@graph_classes
+def test_paths_of_length(graph_class):
+    #   A - B - D
+    #   |       |
+    #   C ----- E
+    graph = graph_class([(A, B), (B, D), (A, C), (C, E), (E, D)])
+
+    assert graph.get_paths_of_length(A, 0) == [[A]]
+    assert sorted(graph.get_paths_of_length(A, 1)) == sorted([[A, B], [A, C]])
+    assert sorted(path[-1] for path in graph.get_paths_of_length(A, 2)) == sorted([D, E])
+    assert graph.get_paths_of_length(A, 3) == []
+
+    assert graph.get_nodes_at_distance(A, 2) == {D, E}
+    assert graph.get_nodes_at_distance(D, 1) == {B, E}
+
+    # the paths are found lazily, one level at a time
+    paths = graph.iter_paths_of_length(A, 1)
+    assert len(next(paths)) == 2
+
+    with pytest.raises(networkx.NodeNotFound):
+        graph.get_paths_of_length(make_address('unknown'), 1)
+
+
+@graph_classes
+def test_incremental_updates(graph_class):
+    graph = graph_class([(A, B), (B, C)])
+    version = graph.version
+
+    graph.add_channel(C, D)
+    assert graph.version > version
+    assert graph.has_channel(D, C)
+    assert list(graph.get_shortest_paths(A, D)) == [[A, B, C, D]]
+
+    version = graph.version
+    graph.add_channel(D, C)
+    assert graph.version == version
+
+    graph.update_capacity(A, B, 10)
+    assert graph.version > version
+
+    version = graph.version
+    graph.update_capacity(A, B, 10)
+    assert graph.version == version
+
+    graph.remove_channel(B, C)
+    assert graph.version > version
+    assert not graph.has_channel(B, C)
+    assert not graph.has_path(A, D)
+
+    graph.add_channel(B, C)
+    assert graph.has_path(A, D)
+    assert graph.get_best_routes(A, D, 10) == [[A, B, C, D]]
+
+
+def test_compact_graph_rebuild():
+    addresses = [make_address(str(number)) for number in range(200)]
+    graph = CompactChannelGraph(zip(addresses[:-1], addresses[1:]))
+
+    # enough changes to trigger a rebuild of the arrays
+    for address1, address2 in zip(addresses[:-2], addresses[2:]):
+        graph.add_channel(address1, address2)
+    graph.remove_channel(addresses[0], addresses[1])
+
+    # the arrays were rebuilt with some of the new channels
+    assert len(graph.neighbours) > 2 * len(addresses)
+    assert graph.extra_count * 8 <= len(graph.neighbours)
+
+    assert not graph.has_channel(addresses[0], addresses[1])
+    assert graph.has_channel(addresses[0], addresses[2])
+    assert len(next(graph.get_shortest_paths(addresses[0], addresses[-1]))) == 101
+
+
+def test_compact_graph_capacities():
+    """ The capacities are kept in an array aligned with the channels and
+    survive a rebuild.
+    """
+    addresses = [make_address(str(number)) for number in range(200)]
+    graph = CompactChannelGraph(zip(addresses[:-1], addresses[1:]))
+
+    graph.update_capacity(addresses[0], addresses[1], 10)
+    graph.update_capacity(addresses[1], addresses[0], 2 ** 200)
+    assert graph.capacity(addresses[0], addresses[1]) == 10
+    assert graph.capacity(addresses[1], addresses[0]) == 2 ** 200
+    assert graph.capacity(addresses[1], addresses[2]) is None
+    assert not graph.extra_capacities
+
+    graph.add_channel(addresses[0], addresses[2])
+    graph.update_capacity(addresses[0], addresses[2], 7)
+    assert graph.extra_capacities
+
+    # enough changes to trigger a rebuild of the arrays
+    for address1, address2 in zip(addresses[1:-2], addresses[3:]):
+        graph.add_channel(address1, address2)
+
+    id0, id2 = graph.address_ids[addresses[0]], graph.address_ids[addresses[2]]
+    assert graph.edge_position(id0, id2) is not None
+    assert not graph.extra_capacities
+    assert graph.capacity(addresses[0], addresses[1]) == 10
+    assert graph.capacity(addresses[1], addresses[0]) == 2 ** 200
+    assert graph.capacity(addresses[0], addresses[2]) == 7
+
+    graph.remove_channel(addresses[0], addresses[1])
+    graph.add_channel(addresses[0], addresses[1])
+    assert graph.capacity(addresses[0], addresses[1]) is None
+
+
+def test_blockchain_events():
+    asset = make_address('asset')
+    app0, app1, app2, app3 = create_sequential_network(4, deposit=100, asset=asset)
+    address0, address2, address3 = app0.raiden.address, app2.raiden.address, app3.raiden.address
+    chain = app0.raiden.chain
+    asset_manager0 = app0.raiden.assetmanagers[asset]
+    asset_manager2 = app2.raiden.assetmanagers[asset]
+
+    assert not asset_manager0.channelgraph.has_channel(address0, address2)
+
+    # our new channels are registered together with the edge
+    netting_address = chain.new_netting_contract(asset, address0, address2)
+    assert asset_manager0.channelgraph.has_channel(address0, address2)
+    assert address2 in asset_manager0.channels
+    assert address0 in asset_manager2.channels
+    assert app1.raiden.assetmanagers[asset].channelgraph.has_channel(address0, address2)
+
+    chain.deposit(asset, netting_address, address0, 50)
+    chain.deposit(asset, netting_address, address2, 5)
+    assert asset_manager0.channels[address2].balance == 50
+    assert asset_manager2.channels[address0].partner_state.balance == 50
+
+    # the remote capacities come from the deposits
+    assert asset_manager2.channelgraph.get_best_routes(address2, address0, 10) == [
+        [address2, app1.raiden.address, address0],
+    ]
+
+    # the new channel is the shortest route and can be used right away
+    assert asset_manager0.get_best_routes(address3, 10)[0] == [address0, address2, address3]
+
+    app0.raiden.api.transfer(asset, 10, address3)
+    gevent.sleep(1)
+
+    assert asset_manager0.channels[address2].balance == 40
+    assert asset_manager2.channels[address0].balance == 15
+    assert app3.raiden.assetmanagers[asset].channels[address2].balance == 110
+
+    chain.close(asset, netting_address, address0, [], [])
+    assert not asset_manager0.channelgraph.has_channel(address0, address2)
+
+
+def test_routes_skip_unknown_channels():
+    """ A route is only used if this node manages its first channel. """
+    asset = make_address('asset')
+    app0, app1, app2 = create_sequential_network(3, deposit=100, asset=asset)
+    asset_manager0 = app0.raiden.assetmanagers[asset]
+
+    target = app2.raiden.address
+    assert asset_manager0.get_best_routes(target, 10)
+
+    del asset_manager0.channels[app1.raiden.address]
+    assert asset_manager0.get_best_routes(target, 10) == []
+
+
+@graph_classes
+def test_route_cache(graph_class):
+    #   F - A - B - D
+    #       |       |
+    #       C ----- E
+    F = make_address('f')  # pylint: disable=invalid-name
+    graph = graph_class([(A, B), (B, D), (A, C), (C, E), (E, D), (F, A)])
+    cache = RouteCache(graph)
+
+    assert cache.get_best_routes(A, D, 10) == [[A, B, D], [A, C, E, D]]
+    assert cache.misses == 1
+
+    # the capacities are checked on every lookup without searching the graph
+    graph.update_capacity(A, B, 5)
+    assert cache.get_best_routes(A, D, 10) == [[A, C, E, D]]
+    assert cache.get_best_routes(A, D, 5) == [[A, B, D], [A, C, E, D]]
+    assert cache.misses == 1
+
+    # closing a channel only invalidates the routes using it
+    assert cache.get_best_routes(A, F, 1) == [[A, F]]
+    graph.update_status(B, D, isopen=False)
+    assert (A, D) not in cache.routes
+    assert (A, F) in cache.routes
+    assert cache.get_best_routes(A, D, 1) == [[A, C, E, D]]
+
+    graph.update_status(B, D, isopen=True)
+    assert not cache.routes
+
+
+@graph_classes
+def test_route_cache_components(graph_class):
+    graph = graph_class([(A, B), (C, D)])
+    cache = RouteCache(graph)
+
+    assert cache.has_path(A, B)
+    assert not cache.has_path(A, D)
+    assert not cache.has_path(A, E)
+
+    graph.add_channel(B, C)
+    assert cache.has_path(A, D)
+
+    graph.add_channel(D, E)
+    assert cache.has_path(A, E)
+
+    graph.remove_channel(B, C)
+    assert not cache.has_path(A, E)
+    assert cache.has_path(C, E)
+
+
+def test_route_cache_eviction():
+    graph = ChannelGraph([(A, B), (B, C), (C, D)])
+    cache = RouteCache(graph)
+    cache.max_entries = 2
+
+    cache.get_routes(A, B)
+    cache.get_routes(A, C)
+    cache.get_routes(A, B)
+
+    # (A, C) is the least recently used
+    cache.get_routes(A, D)
+    assert list(cache.routes) == [(A, B), (A, D)]
+    assert (A, C) not in cache.channel_routes[RouteCache.channel_key(B, C)]
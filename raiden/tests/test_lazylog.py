@@ -0,0 +1,108 @@
+# -*- coding: utf8 -*-
+import logging
+import os
+import sys
+
+import gevent
+from ethereum import slogging
+
+from raiden.lazylog import AsyncHandler, LazyLogger
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super(RecordingHandler, self).__init__()
+        self.messages = []
+        self.records = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+        self.records.append(record)
+
+
+class Formatted(object):
+    """ Counts how many times it was formatted. """
+    count = 0
+
+    def __str__(self):
+        Formatted.count += 1
+        return 'formatted'
+
+
+def test_lazy_logger():
+    logger = slogging.get_logger('test.lazylog')
+    handler = RecordingHandler()
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    try:
+        lazylog = LazyLogger(logger)
+        Formatted.count = 0
+
+        logger.setLevel(logging.INFO)
+        lazylog.debug('disabled %s', Formatted())
+        assert Formatted.count == 0
+        assert handler.messages == []
+
+        lazylog.info('enabled %s', Formatted())
+        assert Formatted.count == 1
+        assert handler.messages == ['enabled formatted']
+
+        lazylog.set_sample_rate('transfer', 3)
+        for number in range(7):
+            lazylog.info('transfer %s', number, category='transfer')
+
+        assert handler.messages[1:] == ['transfer 0', 'transfer 3', 'transfer 6']
+    finally:
+        logger.removeHandler(handler)
+        logger.propagate = True
+
+
+def test_lazy_logger_caller():
+    logger = slogging.get_logger('test.lazylog.caller')
+    handler = RecordingHandler()
+    logger.addHandler(handler)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+
+    try:
+        lazylog = LazyLogger(logger)
+        lineno = sys._getframe().f_lineno + 1  # pylint: disable=protected-access
+        lazylog.info('from the test')
+        lazylog.log(logging.INFO, 'from log')
+
+        first, second = handler.records
+        assert os.path.splitext(first.pathname)[0] == os.path.splitext(__file__)[0]
+        assert first.lineno == lineno
+        assert first.funcName == 'test_lazy_logger_caller'
+        assert second.lineno == lineno + 1
+    finally:
+        logger.removeHandler(handler)
+        logger.propagate = True
+
+
+def test_async_handler():
+    handler = RecordingHandler()
+    async_handler = AsyncHandler(handler, maxsize=2)
+
+    logger = slogging.get_logger('test.lazylog.async')
+    logger.addHandler(async_handler)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+
+    try:
+        lazylog = LazyLogger(logger)
+        lazylog.info('first %s', Formatted())
+        lazylog.info('second')
+        lazylog.info('dropped')
+
+        # nothing is formatted nor written by the caller
+        assert handler.messages == []
+        assert async_handler.dropped == 1
+
+        gevent.sleep(0)
+        assert handler.messages == ['first formatted', 'second']
+    finally:
+        logger.removeHandler(async_handler)
+        async_handler.close()
+        logger.propagate = True
@@ -1,5 +1,8 @@
 # -*- coding: utf8 -*-
-from raiden.messages import Ping, Ack, decode, Lock, MediatedTransfer
+import pytest
+
+from raiden.encoding.messages import unwrap_envelope, wrap_envelope
+from raiden.messages import Ping, Ack, CumulativeAck, decode, Lock, MediatedTransfer
 from raiden.utils import privtoaddr, sha3
 
 PRIVKEY = 'x' * 32
@@ -66,3 +69,75 @@ def test_mediated_transfer():
     mediated_transfer.sign(PRIVKEY)
     decoded_mediated_transfer = decode(mediated_transfer.encode())
     assert decoded_mediated_transfer == mediated_transfer
+
+
+def test_cached_encoding():
+    ping = Ping(nonce=0).sign(PRIVKEY)
+    data = ping.encode()
+    assert ping.encode() is data
+    assert ping.hash == sha3(data)
+
+    decoded_ping = decode(data)
+    assert decoded_ping.encode() == data
+    assert decoded_ping.hash == ping.hash
+    assert decoded_ping == ping
+    assert len({ping, decoded_ping}) == 1
+
+    # mutating a field invalidates the cached encoding
+    decoded_ping.nonce = 1
+    assert decoded_ping.encode() != data
+    assert decoded_ping.hash != ping.hash
+    assert decoded_ping != ping
+
+
+def test_decode_from_buffer():
+    ping = Ping(nonce=0).sign(PRIVKEY)
+    ack = Ack(ADDRESS, sha3(PRIVKEY))
+    buffer_ = bytearray(wrap_envelope([ping.encode(), ack.encode()]))
+
+    ping_view, ack_view = unwrap_envelope(memoryview(buffer_))
+    assert isinstance(ping_view, memoryview)
+
+    decoded_ping = decode(ping_view)
+    assert decoded_ping.sender == ADDRESS
+    assert decoded_ping.hash == ping.hash
+    assert decoded_ping.encode() == ping.encode()
+    assert isinstance(decoded_ping.encode(), bytes)
+
+    assert decode(ack_view) == ack
+    assert decode(bytearray(ping.encode())) == ping
+
+
+def test_envelope():
+    ping = Ping(nonce=0).sign(PRIVKEY)
+    ack = Ack(ADDRESS, sha3(PRIVKEY))
+
+    data = wrap_envelope([ping.encode(), ack.encode()])
+    assert len(data) < len(ping.encode()) + len(ack.encode()) + 10
+
+    ping_data, ack_data = unwrap_envelope(data)
+    assert decode(ping_data) == ping
+    assert decode(ack_data) == ack
+
+    with pytest.raises(ValueError):
+        unwrap_envelope(data[:-1])
+
+    with pytest.raises(ValueError):
+        unwrap_envelope(ping.encode())
+
+
+def test_cumulative_ack():
+    echoes = [sha3(str(nonce)) for nonce in range(3)]
+    cumulative_ack = CumulativeAck(ADDRESS, echoes)
+
+    data = cumulative_ack.encode()
+    assert len(data) == 4 + 20 + 3 * 32
+
+    decoded_ack = decode(data)
+    assert isinstance(decoded_ack, CumulativeAck)
+    assert decoded_ack.sender == ADDRESS
+    assert decoded_ack.echoes == tuple(echoes)
+    assert decoded_ack == cumulative_ack
+
+    with pytest.raises(ValueError):
+        decode(data[:-1])
@@ -1,7 +1,18 @@
 # -*- coding: utf8 -*-
+import random
+
 import pytest
 
-from raiden.mtree import merkleroot, check_proof, get_proof, NoHash32Error
+from raiden.mtree import (
+    merkleroot,
+    merkleroot_reference,
+    check_proof,
+    check_multiproof,
+    get_proof,
+    keccak_pairs,
+    MerkleTree,
+    NoHash32Error,
+)
 from raiden.utils import keccak
 
 
@@ -105,6 +116,167 @@ def test_many(num=10):
         assert r == r0
 
 
+def test_reference(num=70):
+    assert merkleroot_reference([]) == merkleroot([]) == ''
+
+    for nummi in range(1, num + 1):
+        values = [keccak(str(i)) for i in range(nummi)]
+        root = merkleroot_reference(values)
+        assert merkleroot(values) == root
+
+        for value in values:
+            proof = [value]
+            reference_proof = [value]
+            merkleroot(values, proof)
+            merkleroot_reference(values, reference_proof)
+            assert proof == reference_proof
+            assert check_proof(proof, root, value)
+
+
+def test_hash_pairs_in_place(num=13):
+    """ Every level is hashed in the buffer of the leaves. """
+    values = [keccak(str(i)) for i in range(num)]
+    buffers = []
+
+    def recording_pairs(buf, count):
+        buffers.append(buf)
+        keccak_pairs(buf, count)
+
+    assert merkleroot(values, hash_pairs=recording_pairs) == merkleroot_reference(values)
+    assert len(buffers) == 4  # 13, 7, 4, 2 nodes
+    assert all(buf is buffers[0] for buf in buffers)
+
+
+def test_tree_empty():
+    tree = MerkleTree()
+    assert tree.root == ''
+    assert not len(tree)
+
+
+def test_tree_matches_merkleroot(num=33):
+    values = [keccak(str(i)) for i in range(num)]
+    tree = MerkleTree()
+
+    for i, value in enumerate(values):
+        tree.add(value)
+        assert tree.root == merkleroot(values[:i + 1])
+
+    tree.add(values[0])  # duplicates are ignored
+    assert tree.root == merkleroot(values)
+
+    for i, value in enumerate(values):
+        tree.remove(value)
+        assert tree.root == merkleroot(values[i + 1:])
+
+    assert tree.layers == [[]]
+
+
+def test_tree_init():
+    values = [keccak(str(i)) for i in range(10)]
+    tree = MerkleTree(values + [''])
+    assert tree.root == merkleroot(values)
+    assert values[3] in tree
+
+    with pytest.raises(ValueError):
+        tree.remove(keccak('missing'))
+
+    with pytest.raises(NoHash32Error):
+        tree.add('not32bytes')
+
+
+def test_tree_root_with(num=17):
+    values = [keccak(str(i)) for i in range(num)]
+    extra = keccak('extra')
+
+    for size in range(num + 1):
+        tree = MerkleTree(values[:size])
+        version = tree.version
+
+        assert tree.root_with() == tree.root
+        assert tree.root_with(extra) == merkleroot(values[:size] + [extra])
+
+        for value in values[:size]:
+            others = [v for v in values[:size] if v != value]
+            assert tree.root_with(None, value) == merkleroot(others)
+            assert tree.root_with(extra, value) == merkleroot(others + [extra])
+            assert tree.root_with(value) == tree.root
+
+        # speculative roots don't touch the tree
+        assert tree.version == version
+        assert tree.root == merkleroot(values[:size])
+
+    with pytest.raises(ValueError):
+        MerkleTree(values).root_with(None, extra)
+
+
+def test_tree_proofs(num=17):
+    values = [keccak(str(i)) for i in range(num)]
+
+    for size in range(1, num + 1):
+        tree = MerkleTree(values[:size])
+
+        for value, proof in zip(values[:size], tree.get_proofs(values[:size])):
+            assert proof == get_proof(values[:size], value)
+            assert check_proof(proof, tree.root, value)
+
+        # cached proofs are copies
+        proof = tree.get_proof(values[0])
+        assert check_proof(proof, tree.root, values[0])
+        assert tree.get_proof(values[0]) == get_proof(values[:size], values[0])
+
+    tree.remove(values[0])
+    assert tree.get_proof(values[1]) == get_proof(values[1:], values[1])
+
+    with pytest.raises(ValueError):
+        tree.get_proof(values[0])
+
+
+def test_tree_proofs_invalidation(num=40):
+    """ A change only drops the proof levels that read a rehashed node. """
+    random.seed(3)
+    values = [keccak(str(i)) for i in range(num)]
+    tree = MerkleTree(values[:num // 2])
+
+    for value in values[num // 2:]:
+        tree.get_proofs(list(tree))
+
+        if random.random() < 0.3:
+            tree.remove(random.choice(list(tree)))
+        else:
+            tree.add(value)
+
+        leaves = list(tree)
+        for element, proof in zip(leaves, tree.get_proofs(leaves)):
+            assert proof == get_proof(leaves, element)
+
+    # a new last leaf only changes the nodes to the right of the first one
+    tree = MerkleTree(values[:16])
+    first = tree.leaves[0]
+    tree.get_proof(first)
+
+    tree.add(b'\xff' * 32)
+    assert len(tree._proofs[first][1]) == 4  # pylint: disable=protected-access
+    assert tree.get_proof(first) == get_proof(tree.leaves, first)
+
+
+def test_tree_multiproof(num=17):
+    values = [keccak(str(i)) for i in range(num)]
+    tree = MerkleTree(values)
+
+    for count in range(1, num + 1):
+        elements = values[:count]
+        indexes, proof = tree.get_multiproof(elements)
+        assert check_multiproof(proof, tree.root, elements, indexes, len(tree))
+
+        # shared siblings are sent only once
+        single_proofs = tree.get_proofs(elements)
+        assert len(proof) <= len(set(h for p in single_proofs for h in p))
+
+        if proof:
+            assert not check_multiproof(proof[1:], tree.root, elements, indexes, len(tree))
+        assert not check_multiproof(proof, keccak('x'), elements, indexes, len(tree))
+
+
 def do_test_speed(rounds=100, num_hashes=1000):
     import time
     values = [keccak(str(i)) for i in range(num_hashes)]
@@ -114,5 +286,11 @@ def do_test_speed(rounds=100, num_hashes=1000):
     elapsed = time.time() - st
     print '%d additions per second' % (num_hashes * rounds / elapsed)
 
+    st = time.time()
+    for i in range(rounds):
+        merkleroot_reference(values)
+    elapsed = time.time() - st
+    print '%d additions per second (reference)' % (num_hashes * rounds / elapsed)
+
 if __name__ == '__main__':
     do_test_speed()
@@ -1,6 +1,7 @@
 # -*- coding: utf8 -*-
+import pytest
 
-from raiden.encoding.format import Field, namedbuffer
+from raiden.encoding.format import Field, namedbuffer, pad
 from raiden.encoding.encoders import integer
 
 # pylint: disable=invalid-name
@@ -8,6 +9,9 @@ byte = Field('byte', 1, 'B', None)
 hugeint = Field('huge', 100, '100s', integer(0, 2 ** (8 * 100)))
 SingleByte = namedbuffer('SingleByte', [byte])
 HugeInt = namedbuffer('HugeInt', [hugeint])
+nonce = Field('nonce', 8, '8s', integer(0, 2 ** 64))
+label = Field('label', 8, '8s', None)
+Mixed = namedbuffer('Mixed', [byte, pad(2), nonce, label])
 
 
 def test_byte():
@@ -45,3 +49,38 @@ def test_decoder_long():
     huge = 2 ** (8 * 100) - 1
     packed_data.huge = huge
     assert packed_data.huge == huge
+
+
+def test_pack_unpack():
+    data = bytearray(HugeInt.size)
+    packed_data = HugeInt(data)
+
+    packed_data.pack(huge=2 ** 32)
+    assert packed_data.unpack().huge == 2 ** 32
+    assert packed_data.huge == 2 ** 32
+
+    with pytest.raises(ValueError):
+        packed_data.pack(huge=-1)
+
+    with pytest.raises(ValueError):
+        packed_data.pack(unknown=1)
+
+
+def test_pack_keeps_fields():
+    data = bytearray(Mixed.size)
+    packed_data = Mixed(data)
+
+    packed_data.byte = b'\x07'
+    data[1:3] = b'\xff\xff'
+    packed_data.pack(nonce=1, label=b'raiden')
+
+    assert data[:1] == b'\x07'
+    assert data[1:3] == b'\x00\x00'  # the padding is zeroed
+
+    values = packed_data.unpack()
+    assert values == (b'\x07', 1, b'\x00\x00raiden')
+    assert values.nonce == packed_data.nonce
+    assert values.label == packed_data.label
+
+    with pytest.raises(ValueError):
+        packed_data.pack(label=b'x' * 9)
@@ -1,13 +1,31 @@
 # -*- coding: utf8 -*-
+import copy
+import functools
+import socket
+
 import gevent
+import gevent.socket
+import pytest
 
 from ethereum import slogging
 
-from raiden.messages import Ping, Ack, decode
-from raiden.network.transport import UnreliableTransport, UDPTransport
-from raiden.raiden_protocol import RaidenProtocol
-from raiden.tests.utils.network import create_network
+from raiden.encoding.messages import SECRET, unwrap_envelope, wrap_envelope
+from raiden.messages import Ping, Ack, CumulativeAck, SecretRequest, decode
+from raiden.app import App, INITIAL_PORT
+from raiden.network.discovery import Discovery
+from raiden.network.rpc.client import BlockChainServiceMock
+from raiden.network.transport import (
+    BatchedUDPTransport,
+    ShardedUDPTransport,
+    UnreliableTransport,
+    UDPTransport,
+    shard_for,
+)
+from raiden.raiden_protocol import DuplicateCache, RaidenProtocol, RoundTripTime
+from raiden.tasks import MediatedTransferTask
+from raiden.tests.utils.network import create_network, mk_app
 from raiden.tests.utils.messages import setup_messages_cb
+from raiden.utils import sha3
 
 slogging.configure(':debug')
 
@@ -27,6 +45,23 @@ def test_ping():
     assert decoded.echo == ping.hash
 
 
+def test_dispatch_hooks():
+    apps = create_network(num_nodes=2, num_assets=0, channels_per_node=0)
+    app0, app1 = apps  # pylint: disable=unbalanced-tuple-unpacking
+
+    assert app1.raiden.message_handlers[Ping.cmdid] == app1.raiden.on_ping
+
+    dispatched = []
+    app1.raiden.pre_dispatch_hooks.append(lambda msg, _: dispatched.append(('pre', msg)))
+    app1.raiden.post_dispatch_hooks.append(lambda msg, _: dispatched.append(('post', msg)))
+
+    ping = Ping(nonce=0)
+    app0.raiden.sign(ping)
+    app0.raiden.protocol.send(app1.raiden.address, ping).wait(1)
+
+    assert dispatched == [('pre', ping), ('post', ping)]
+
+
 def test_ping_dropped_message():
     apps = create_network(
         num_nodes=2,
@@ -102,3 +137,625 @@ def test_ping_udp():
     decoded = decode(messages[1])
     assert isinstance(decoded, Ack)
     assert decoded.echo == ping.hash
+
+
+def test_ping_give_up():
+    apps = create_network(
+        num_nodes=2,
+        num_assets=0,
+        channels_per_node=0,
+        transport_class=UnreliableTransport,
+    )
+    app0, app1 = apps  # pylint: disable=unbalanced-tuple-unpacking
+    protocol = app0.raiden.protocol
+
+    try_interval = RaidenProtocol.try_interval
+    UnreliableTransport.droprate = 1  # every message is lost
+    RaidenProtocol.try_interval = 0.01  # doubled on every retry
+    RaidenProtocol.repeat_messages = True
+
+    try:
+        messages = setup_messages_cb()
+
+        ping = Ping(nonce=0)
+        app0.raiden.sign(ping)
+        async_result = protocol.send(app1.raiden.address, ping)
+        assert protocol.send(app1.raiden.address, ping) is async_result
+
+        with pytest.raises(RuntimeError):
+            async_result.get(timeout=1)
+
+        assert len(messages) == RaidenProtocol.max_tries
+        assert not protocol.pending
+    finally:
+        UnreliableTransport.droprate = 2
+        RaidenProtocol.try_interval = try_interval
+        RaidenProtocol.repeat_messages = False
+
+
+def test_ping_async_result():
+    apps = create_network(num_nodes=2, num_assets=0, channels_per_node=0)
+    app0, app1 = apps  # pylint: disable=unbalanced-tuple-unpacking
+    protocol = app0.raiden.protocol
+
+    ping = Ping(nonce=0)
+    app0.raiden.sign(ping)
+    async_result = protocol.send(app1.raiden.address, ping)
+
+    assert async_result.get(timeout=1) is True
+    assert not protocol.pending
+
+    # all the retries are handled by a single greenlet
+    retry_greenlet = protocol.retry_greenlet
+    ping = Ping(nonce=1)
+    app0.raiden.sign(ping)
+    assert protocol.send(app1.raiden.address, ping).get(timeout=1) is True
+    assert protocol.retry_greenlet is retry_greenlet
+
+
+def test_round_trip_time():
+    round_trip = RoundTripTime(initial_rto=1., min_rto=0.1, max_rto=60.)
+    assert round_trip.srtt is None
+    assert round_trip.backoff(0) == 1.
+    assert round_trip.backoff(2) == 4.
+    assert round_trip.backoff(10) == 60.
+
+    round_trip.update(0.5)
+    assert round_trip.srtt == 0.5
+    assert round_trip.rttvar == 0.25
+    assert round_trip.rto == 0.5 + 4 * 0.25
+
+    for _ in range(50):
+        round_trip.update(0.01)
+    assert round_trip.srtt < 0.02
+    assert round_trip.rto == 0.1  # bounded by min_rto
+
+    apps = create_network(num_nodes=2, num_assets=0, channels_per_node=0)
+    app0, app1 = apps  # pylint: disable=unbalanced-tuple-unpacking
+    protocol = app0.raiden.protocol
+
+    ping = Ping(nonce=0)
+    app0.raiden.sign(ping)
+    protocol.send(app1.raiden.address, ping).get(timeout=1)
+
+    round_trip = protocol.round_trips[app1.raiden.address]
+    assert round_trip.srtt is not None
+    assert round_trip.rto >= protocol.min_try_interval
+
+
+class TimeoutTask(object):  # pylint: disable=too-few-public-methods
+    """ The part of a `MediatedTransferTask` used by `get_msg_timeout`. """
+    hop_processing_time = MediatedTransferTask.hop_processing_time
+    min_msg_timeout_ratio = MediatedTransferTask.min_msg_timeout_ratio
+    get_msg_timeout = MediatedTransferTask.get_msg_timeout.im_func
+
+    def __init__(self, raiden):
+        self.raiden = raiden
+
+
+def test_msg_timeout():
+    apps = create_network(num_nodes=2, num_assets=0, channels_per_node=0)
+    app0, app1 = apps  # pylint: disable=unbalanced-tuple-unpacking
+    app0.raiden.config['msg_timeout'] = 100.
+    task = TimeoutTask(app0.raiden)
+
+    path = [app0.raiden.address, app1.raiden.address, 'c' * 20, 'd' * 20]
+    assert task.get_msg_timeout(path) == 100.
+
+    # a fast first link, every hop gets time to handle the transfer
+    round_trip = app0.raiden.protocol.get_round_trip(app1.raiden.address)
+    round_trip.update(2.)
+    max_tries = app0.raiden.protocol.max_tries
+    expected = 3 * (round_trip.rto * max_tries + task.hop_processing_time)
+    assert task.get_msg_timeout(path) == expected
+
+    # but never much shorter than msg_timeout
+    for _ in range(50):
+        round_trip.update(0.001)
+    assert task.get_msg_timeout(path) == 25.
+
+    round_trip.update(60.)
+    assert task.get_msg_timeout(path) == 100.
+
+
+def test_duplicate_cache():
+    cache = DuplicateCache(size=4, ttl=0.2)
+
+    cache['a'] = 1
+    cache['b'] = 2
+    cache['c'] = 3  # rotates, 'a' and 'b' are in the previous generation
+    assert cache.get('a') == 1
+    assert 'b' in cache
+    assert cache.get('x') is None
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 0)
+
+    cache['d'] = 4
+    cache['e'] = 5  # rotates, evicting 'a' and 'b'
+    assert 'a' not in cache
+    assert cache.get('c') == 3
+    assert cache.evictions == 2
+    assert len(cache) <= cache.size
+
+    gevent.sleep(0.25)  # older than the ttl
+    assert cache.get('e') is None
+    assert len(cache) == 0
+    assert cache.evictions == 5
+
+
+def test_duplicate_cache_min_age():
+    """ The entries younger than `min_age` are kept past the size bound. """
+    cache = DuplicateCache(size=4, ttl=0.6, min_age=0.1)
+
+    for key in 'abcd':
+        cache[key] = key
+    assert len(cache) == 4
+
+    # too young to be evicted, the cache grows
+    cache['e'] = 'e'
+    assert len(cache) == 5
+    assert cache.evictions == 0
+
+    gevent.sleep(0.12)
+    cache['f'] = 'f'  # rotates, 'a' to 'e' are in the previous generation
+    cache['g'] = 'g'
+    cache['h'] = 'h'
+    assert 'a' in cache
+    assert cache.evictions == 0
+
+    gevent.sleep(0.12)
+    cache['i'] = 'i'  # rotates, evicting 'a' to 'e'
+    assert 'a' not in cache
+    assert 'f' in cache
+    assert cache.evictions == 5
+
+    with pytest.raises(ValueError):
+        DuplicateCache(size=4, ttl=0.1, min_age=0.1)
+
+
+def test_ping_batched():
+    apps = create_network(num_nodes=2, num_assets=0, channels_per_node=0)
+    app0, app1 = apps  # pylint: disable=unbalanced-tuple-unpacking
+    app0.raiden.protocol.batch_delay = 0.05
+
+    messages = setup_messages_cb()
+
+    ping0 = Ping(nonce=0)
+    ping1 = Ping(nonce=1)
+    app0.raiden.sign(ping0)
+    app0.raiden.sign(ping1)
+    result0 = app0.raiden.protocol.send(app1.raiden.address, ping0)
+    result1 = app0.raiden.protocol.send(app1.raiden.address, ping1)
+
+    assert result0.get(timeout=1) is True
+    assert result1.get(timeout=1) is True
+
+    assert len(messages) == 3  # Envelope(Ping, Ping), Ack, Ack
+    assert unwrap_envelope(messages[0]) == [ping0.encode(), ping1.encode()]
+
+
+class RecordingTransport(object):  # pylint: disable=too-few-public-methods
+    """ Transport stand-in that records the sent datagrams. """
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, sender, host_port, bytes_):  # pylint: disable=unused-argument
+        self.sent.append(bytes_)
+
+
+def test_batch_flushed_early():
+    """ A queue flushed because it's full doesn't leave its timer behind. """
+    transport = RecordingTransport()
+    protocol = RaidenProtocol(transport, None, None)
+    protocol.batch_delay = 0.1
+    host_port = ('127.0.0.1', INITIAL_PORT)
+
+    protocol.send_raw(host_port, b'first')
+    gevent.sleep(0.06)
+
+    # doesn't fit in the envelope, the queue is flushed right away
+    protocol.send_raw(host_port, b'x' * (protocol.max_message_size - 10))
+    assert transport.sent == [b'first']
+
+    # the timer of the first queue is gone
+    gevent.sleep(0.06)
+    assert transport.sent == [b'first']
+
+    gevent.sleep(0.06)
+    assert transport.sent == [b'first', b'x' * (protocol.max_message_size - 10)]
+
+
+def test_acks_flushed_early():
+    """ Acks sent before the delay don't leave their timer behind. """
+    transport = RecordingTransport()
+    protocol = RaidenProtocol(transport, None, None)
+    protocol.raiden = protocol  # the Acks need an address
+    protocol.address = 'x' * 20
+    protocol.ack_delay = 0.1
+    protocol.max_cumulative_acks = 2
+    host_port = ('127.0.0.1', INITIAL_PORT)
+
+    protocol.queue_ack(host_port, 'a' * 32)
+    gevent.sleep(0.06)
+
+    # the queue is full and sent right away
+    protocol.queue_ack(host_port, 'b' * 32)
+    protocol.queue_ack(host_port, 'c' * 32)
+    assert len(transport.sent) == 1
+
+    # the timer of the first queue is gone
+    gevent.sleep(0.06)
+    assert len(transport.sent) == 1
+
+    gevent.sleep(0.06)
+    assert len(transport.sent) == 2
+    assert decode(transport.sent[1]).echo == 'c' * 32
+
+
+def test_envelope_bad_message():
+    """ The messages after a bad one in an envelope are still handled. """
+    apps = create_network(num_nodes=2, num_assets=0, channels_per_node=0)
+    app0, app1 = apps  # pylint: disable=unbalanced-tuple-unpacking
+
+    ping0 = Ping(nonce=0)
+    ping1 = Ping(nonce=1)
+    app0.raiden.sign(ping0)
+    app0.raiden.sign(ping1)
+
+    handled = []
+    app1.raiden.post_dispatch_hooks.append(lambda msg, msghash: handled.append(msg))
+
+    truncated = ping0.encode()[:-10]
+    app1.raiden.protocol.receive(wrap_envelope([truncated, ping0.encode(), ping1.encode()]))
+
+    assert handled == [ping0, ping1]
+
+
+def test_ping_delayed_acks():
+    apps = create_network(num_nodes=2, num_assets=0, channels_per_node=0)
+    app0, app1 = apps  # pylint: disable=unbalanced-tuple-unpacking
+    app0.raiden.protocol.ack_delay = 0.05
+    app1.raiden.protocol.ack_delay = 0.05
+
+    messages = setup_messages_cb()
+
+    pings = [Ping(nonce=nonce) for nonce in range(3)]
+    results = []
+    for ping in pings:
+        app0.raiden.sign(ping)
+        results.append(app0.raiden.protocol.send(app1.raiden.address, ping))
+
+    for result in results:
+        assert result.get(timeout=1) is True
+
+    assert len(messages) == 4  # Ping, Ping, Ping, CumulativeAck
+    cumulative_ack = decode(messages[3])
+    assert isinstance(cumulative_ack, CumulativeAck)
+    assert cumulative_ack.echoes == tuple(ping.hash for ping in pings)
+
+    # the Ack is piggy-backed on the Ping sent in the other direction
+    messages = setup_messages_cb()
+
+    ping0 = Ping(nonce=10)
+    app0.raiden.sign(ping0)
+    result0 = app0.raiden.protocol.send(app1.raiden.address, ping0)
+    gevent.sleep(0.01)
+
+    ping1 = Ping(nonce=11)
+    app1.raiden.sign(ping1)
+    result1 = app1.raiden.protocol.send(app0.raiden.address, ping1)
+
+    assert result0.get(timeout=1) is True
+    assert result1.get(timeout=1) is True
+
+    assert len(messages) == 3  # Ping, Envelope(Ack, Ping), Ack
+    ack_data, ping_data = unwrap_envelope(messages[1])
+    assert decode(ack_data).echo == ping0.hash
+    assert decode(ping_data) == ping1
+
+
+def test_ping_batched_udp():
+    discovery = Discovery()
+    chain = BlockChainServiceMock()
+    app0, app1 = [
+        mk_app(chain, discovery, BatchedUDPTransport, port=INITIAL_PORT + 100 + i)
+        for i in range(2)
+    ]
+
+    try:
+        messages = setup_messages_cb()
+
+        pings = [Ping(nonce=nonce) for nonce in range(3)]
+        results = []
+        for ping in pings:
+            app0.raiden.sign(ping)
+            results.append(app0.raiden.protocol.send(app1.raiden.address, ping))
+
+        for result in results:
+            assert result.get(timeout=1) is True
+
+        assert len(messages) == 6  # Ping, Ping, Ping, Ack, Ack, Ack
+        assert [decode(data) for data in messages[:3]] == pings
+    finally:
+        app0.stop()
+        app1.stop()
+
+
+def test_batched_udp_send_error():
+    """ A datagram that can't be sent doesn't drop the rest of the queue. """
+    transport = BatchedUDPTransport('127.0.0.1', INITIAL_PORT + 150)
+    peer = gevent.socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    try:
+        peer.bind(('127.0.0.1', 0))
+
+        # broadcasting is not enabled on the socket, sendto fails with EACCES
+        transport.send('x' * 20, ('255.255.255.255', INITIAL_PORT), b'lost')
+        transport.send('x' * 20, peer.getsockname(), b'pong')
+
+        with gevent.Timeout(1):
+            assert peer.recvfrom(100) == (b'pong', ('127.0.0.1', INITIAL_PORT + 150))
+    finally:
+        transport.stop()
+        peer.close()
+
+
+class RecordingProtocol(object):
+    """ Protocol stand-in that records the datagrams handed by a transport. """
+    address = 'x' * 20
+
+    def __init__(self):
+        self.raiden = self  # the debugging callbacks need an address
+        self.received = []
+
+    def receive_batch(self, batch):
+        # the transports hand out views of their buffers
+        self.received.extend(memoryview(data).tobytes() for data in batch)
+
+
+def test_sharded_udp(tmpdir):
+    port = INITIAL_PORT + 200
+    protocols = [RecordingProtocol(), RecordingProtocol()]
+    transports = [
+        ShardedUDPTransport(
+            '127.0.0.1',
+            port,
+            protocol,
+            shard=shard,
+            shards=2,
+            forward_dir=str(tmpdir),
+        )
+        for shard, protocol in enumerate(protocols)
+    ]
+
+    def datagram(peer):
+        return 'ping from {}'.format(peer.getsockname()[1])
+
+    # enough peers for both shards
+    peers = list()
+    owners = list()
+    while len(peers) < 8 or set(owners) != {0, 1}:
+        peer = gevent.socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        peers.append(peer)
+        peer.bind(('127.0.0.1', 0))
+        owners.append(shard_for(peer.getsockname(), 2))
+
+    try:
+        for peer in peers:
+            peer.sendto(datagram(peer), ('127.0.0.1', port))
+
+        ack = Ack('y' * 20, 'z' * 32).encode()
+        peers[0].sendto(ack, ('127.0.0.1', port))
+
+        # the messages of an envelope are routed one by one
+        secret = SECRET + b'\x00' * 3 + b'secret'
+        enveloped = b'enveloped ping'
+        peers[1].sendto(wrap_envelope([secret, enveloped]), ('127.0.0.1', port))
+
+        gevent.sleep(0.2)
+
+        for shard, protocol in enumerate(protocols):
+            expected = set(
+                datagram(peer)
+                for peer, owner in zip(peers, owners)
+                if owner == shard
+            )
+
+            # unless claimed, the acks and the secrets go to the peer's owner
+            if owners[0] == shard:
+                expected.add(ack)
+            if owners[1] == shard:
+                expected.update([secret, enveloped])
+
+            assert set(protocol.received) == expected
+            assert len(protocol.received) == len(expected)
+
+        # the datagrams to a peer are sent by it's owner, the peers can be
+        # given by name and the datagrams can have the maximum size
+        pong = b'x' * (RaidenProtocol.max_message_size - 1)
+        for peer in peers:
+            transports[0].send(RecordingProtocol, ('localhost', peer.getsockname()[1]), pong)
+
+        for peer in peers:
+            with gevent.Timeout(1):
+                assert peer.recvfrom(2000) == (pong, ('127.0.0.1', port))
+
+        # the replies of a peer of the shard 1 to the shard 0 go to the shard 0
+        remote = peers[owners.index(1)]
+        remote_host_port = remote.getsockname()
+        for protocol in protocols:
+            del protocol.received[:]
+
+        hashlock = sha3('hashlock')
+        transports[0].claim(remote_host_port, hashlock)
+        transports[0].send(RecordingProtocol, remote_host_port, pong)
+        with gevent.Timeout(1):
+            assert remote.recvfrom(2000)[0] == pong
+
+        secret_request = SecretRequest(hashlock)
+        secret_request.sign(sha3('remote'))
+        secret_request = secret_request.encode()
+
+        ack = Ack('y' * 20, sha3(pong)).encode()
+        cumulative_ack = CumulativeAck('y' * 20, [sha3(pong), 'z' * 32]).encode()
+
+        for data in (ack, cumulative_ack, secret_request):
+            remote.sendto(data, ('127.0.0.1', port))
+        gevent.sleep(0.2)
+
+        # the unclaimed echo of the cumulative ack is for the owner
+        assert sorted(protocols[0].received) == sorted([ack, cumulative_ack, secret_request])
+        assert protocols[1].received == [cumulative_ack]
+    finally:
+        for transport in transports:
+            transport.stop()
+        for peer in peers:
+            peer.close()
+
+
+def mk_sharded_apps(chain, discovery, port, tmpdir, shards=2):
+    """ Create the apps of the `shards` processes of one node. """
+    apps = list()
+
+    for shard in range(shards):
+        config = copy.deepcopy(App.default_config)
+        config.update(
+            host='127.0.0.1',
+            port=port,
+            privkey=sha3('sharded'),
+            shard=shard,
+            shards=shards,
+        )
+        transport_class = functools.partial(
+            ShardedUDPTransport,
+            shard=shard,
+            shards=shards,
+            forward_dir=str(tmpdir),
+        )
+        apps.append(App(config, chain, discovery, transport_class))
+
+    return apps
+
+
+def test_sharded_service(tmpdir):
+    """ Each shard of a node runs only the channels of its partners, a
+    transfer is started by the shard that runs its first channel.
+    """
+    asset = sha3('asset')[:20]
+    port = INITIAL_PORT + 300
+    chain = BlockChainServiceMock()
+    chain.new_channel_manager_contract(asset_address=asset)
+    discovery = Discovery()
+
+    shards = mk_sharded_apps(chain, discovery, port, tmpdir)
+    partners = [
+        mk_app(chain, discovery, UDPTransport, port + 1 + index)
+        for index in range(6)
+    ]
+
+    try:
+        address = shards[0].raiden.address
+        for app in partners:
+            netting_address = chain.new_netting_contract(asset, address, app.raiden.address)
+            chain.deposit(asset, netting_address, address, 100)
+            chain.deposit(asset, netting_address, app.raiden.address, 100)
+
+        for app in shards + partners:
+            app.raiden.setup_asset(asset, app.config['reveal_timeout'])
+
+        owners = dict()
+        for app in partners:
+            owners[app] = shard_for(('127.0.0.1', app.transport.port), 2)
+        assert set(owners.values()) == {0, 1}
+
+        for shard, app in enumerate(shards):
+            channels = app.raiden.assetmanagers[asset].channels
+            assert set(channels) == set(
+                partner.raiden.address
+                for partner in partners
+                if owners[partner] == shard
+            )
+
+        # requested to the shard 0, started by the owner of the channel which
+        # replies with the result
+        results = list()
+        target = next(app for app in partners if owners[app] == 1)
+        shards[0].raiden.api.transfer(
+            asset,
+            10,
+            target.raiden.address,
+            callback=lambda task, success: results.append((task, success)),
+        )
+        gevent.sleep(0.5)
+
+        assert results == [(None, True)]
+        channel = shards[1].raiden.assetmanagers[asset].channels[target.raiden.address]
+        assert channel.balance == 90
+        assert target.raiden.assetmanagers[asset].channels[address].balance == 110
+    finally:
+        for app in shards + partners:
+            app.stop()
+
+
+def test_sharded_mediated_transfer(tmpdir):
+    """ The target of a mediated transfer that is owned by another shard
+    than the first hop sends its SecretRequest to that shard, which forwards
+    it to the initiating shard without handling nor acknowledging it.
+    """
+    asset = sha3('asset')[:20]
+    port = INITIAL_PORT + 400
+    chain = BlockChainServiceMock()
+    chain.new_channel_manager_contract(asset_address=asset)
+    discovery = Discovery()
+
+    def port_of(shard, start):
+        candidate = start
+        while shard_for(('127.0.0.1', candidate), 2) != shard:
+            candidate += 1
+        return candidate
+
+    shards = mk_sharded_apps(chain, discovery, port, tmpdir)
+    mediator_port = port_of(0, port + 1)
+    mediator = mk_app(chain, discovery, UDPTransport, mediator_port)
+    target = mk_app(chain, discovery, UDPTransport, port_of(1, mediator_port + 1))
+
+    try:
+        address = shards[0].raiden.address
+        for first, second in ((address, mediator.raiden.address),
+                              (mediator.raiden.address, target.raiden.address)):
+            netting_address = chain.new_netting_contract(asset, first, second)
+            chain.deposit(asset, netting_address, first, 100)
+            chain.deposit(asset, netting_address, second, 100)
+
+        for app in shards + [mediator, target]:
+            app.raiden.setup_asset(asset, app.config['reveal_timeout'])
+
+        dispatched = [list(), list()]
+        for shard, app in enumerate(shards):
+            app.raiden.pre_dispatch_hooks.append(
+                lambda msg, msghash, messages=dispatched[shard]: messages.append(msg)
+            )
+
+        # requested to the shard 1, the first hop is run by the shard 0
+        results = list()
+        shards[1].raiden.api.transfer(
+            asset,
+            10,
+            target.raiden.address,
+            callback=lambda task, success: results.append(success),
+        )
+        gevent.sleep(1)
+
+        assert results == [True]
+        assert [type(msg) for msg in dispatched[0]] == [SecretRequest]
+        assert dispatched[1] == []
+
+        channel = shards[0].raiden.assetmanagers[asset].channels[mediator.raiden.address]
+        assert channel.balance == 90
+        assert target.raiden.assetmanagers[asset].channels[mediator.raiden.address].balance == 110
+
+        # the Ack of the Secret sent through the shard 1 went to the shard 0
+        assert not shards[0].raiden.protocol.pending
+    finally:
+        for app in shards + [mediator, target]:
+            app.stop()
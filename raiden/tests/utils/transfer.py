@@ -46,6 +46,10 @@ def transfer(initiator_app, target_app, asset, amount):
 
     initiator_app.raiden.api.transfer(asset, amount, target_app.raiden.address)
 
+    # the transfer returns once the first hop is acknowledged, give the secret
+    # time to be revealed along the path
+    sleep(initiator_app, target_app, asset)
+
 
 def direct_transfer(initiator_app, target_app, asset, amount):
     """ Nice to read shortcut to make a DirectTransfer. """
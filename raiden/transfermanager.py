@@ -25,10 +25,12 @@ class TransferManager(object):
     def on_task_started(self, task):
         assert isinstance(task, Task)
         self.transfertasks[task.hashlock] = task
+        self.raiden.hashlock_index.add_task(self.assetmanager.asset_address, task)
 
     def on_task_completed(self, task, success):
         assert isinstance(task, Task)
         del self.transfertasks[task.hashlock]
+        self.raiden.hashlock_index.remove_task(self.assetmanager.asset_address, task)
         for callback in self.on_task_completed_callbacks:
             result = callback(task, success)
             if result is True:
@@ -43,6 +45,9 @@ class TransferManager(object):
             or intermediary channels.
             - Network speed, making the transfer suficiently fast so it doesn't
             timeout.
+
+        Returns:
+            bool: True if the transfer completed.
         """
 
         # either we have a direct channel with `target`
@@ -51,8 +56,8 @@ class TransferManager(object):
             direct_transfer = channel.create_directtransfer(amount, secret=secret)
             self.raiden.sign(direct_transfer)
             channel.register_transfer(direct_transfer, callback=callback)
-            task = self.raiden.protocol.send(direct_transfer.recipient, direct_transfer)
-            task.join()
+            async_result = self.raiden.protocol.send(direct_transfer.recipient, direct_transfer)
+            return bool(async_result.wait())
 
         # or we need to use the network to mediate the transfer
         else:
@@ -76,8 +81,14 @@ class TransferManager(object):
             )
             if callback:
                 self.on_task_completed_callbacks.append(callback)
+
+            # with several shards the SecretRequest of the target can be
+            # received by another one
+            self.raiden.claim_hashlock(hashlock, target)
+
             task.start()
             task.join()
+            return bool(task.value)
 
     def request_transfer(self, amount, target):
         pass
@@ -1,6 +1,7 @@
 # -*- coding: utf8 -*-
 import sys
 
+import gevent.socket
 from Crypto.Hash import keccak as keccaklib
 from ethereum.utils import big_endian_to_int, sha3, int_to_big_endian, privtoaddr
 
@@ -15,6 +16,7 @@ __all__ = (
     'isaddress',
     'pex',
     'lpex',
+    'shard_for',
 )
 
 # hashing
@@ -44,6 +46,18 @@ def lpex(lst):
     return [pex(l) for l in lst]
 
 
+def shard_for(host_port, shards):
+    """ Returns the shard that owns the peer at `host_port`, the result is
+    the same in every process.
+
+    The host is resolved first, a peer registered by its name and the
+    datagrams received from its address belong to the same shard.
+    """
+    host, port = host_port
+    host = gevent.socket.gethostbyname(host)
+    return big_endian_to_int(sha3('{}:{}'.format(host, port))[:8]) % shards
+
+
 def activate_ultratb():
     from IPython.core import ultratb
     sys.excepthook = ultratb.VerboseTB(call_pdb=True, tb_offset=6)